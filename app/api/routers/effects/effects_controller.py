@@ -1,12 +1,14 @@
 import os
+import queue
 from loguru import logger
 from uuid import uuid4
 from blocksnet.models import ServiceType
-from fastapi import APIRouter, BackgroundTasks, Depends
+from fastapi import APIRouter, Depends, HTTPException, Response
 from ...utils import auth, const, decorators
 from . import effects_models as em
 from . import effects_service as es
-from .services import service_type_service as sts
+from . import evaluation_executor as ee
+from .services import project_service as ps, service_type_service as sts, tile_service as ts
 
 router = APIRouter(prefix='/effects', tags=['Effects'])
 
@@ -14,13 +16,20 @@ def on_startup(): # TODO оценка базовых сценариев
     if not os.path.exists(const.DATA_PATH):
         logger.info(f'Creating data folder at {const.DATA_PATH}')
         os.mkdir(const.DATA_PATH)
+    ee.start()
 
-tasks = {}
+def on_shutdown():
+    ee.stop()
 
 @router.get('/service_types')
 def get_service_types(region_id: int) -> list[ServiceType]:
     return sts.get_bn_service_types(region_id)
 
+@router.delete('/service_types')
+def invalidate_service_types(region_id: int | None = None):
+    sts.invalidate_bn_service_types(region_id)
+    return 'oke'
+
 @router.get('/provision_layer')
 @decorators.gdf_to_geojson
 def get_provision_layer(project_scenario_id: int, scale_type: em.ScaleType, service_type_id: int,
@@ -49,24 +58,38 @@ def get_connectivity_layer(project_scenario_id: int, scale_type: em.ScaleType, t
 def get_connectivity_data(project_scenario_id: int, scale_type: em.ScaleType, token: str = Depends(auth.verify_token)):
     return es.get_connectivity_data(project_scenario_id, scale_type, token)
 
-def _evaluate_effects_task(task_id : str, *args, **kwargs):
-    tasks[task_id] = 'pending'
-    try:
-        es.evaluate_effects(*args, **kwargs)
-        tasks[task_id] = 'success'
-    except Exception as e:
-        logger.error(e)
-        tasks[task_id] = 'error'
+@router.get('/{layer_type}/tiles/{z}/{x}/{y}.mvt')
+def get_layer_tile(layer_type: em.LayerType, z: int, x: int, y: int, project_scenario_id: int, scale_type: em.ScaleType,
+                   service_type_id: int | None = None, token: str = Depends(auth.verify_token)):
+    if not ts.is_valid_tile(z, x, y):
+        raise HTTPException(status_code=400, detail='Invalid tile coordinates')
+    if z > const.MAX_TILE_ZOOM:
+        raise HTTPException(status_code=404, detail=f'No tiles above zoom {const.MAX_TILE_ZOOM}')
+    if layer_type == em.LayerType.PROVISION and service_type_id is None:
+        raise HTTPException(status_code=400, detail='service_type_id is required for provision tiles')
+    tile = es.get_layer_tile(layer_type, project_scenario_id, scale_type, z, x, y, token, service_type_id)
+    return Response(content=tile, media_type='application/vnd.mapbox-vector-tile')
 
 @router.post('/evaluate')
-def evaluate(background_tasks: BackgroundTasks, project_scenario_id: int, token: str = Depends(auth.verify_token)):
-    task_id = str(uuid4())
-    background_tasks.add_task(_evaluate_effects_task, task_id, project_scenario_id, token)
+def evaluate(project_scenario_id: int, token: str = Depends(auth.verify_token)):
+    # scenario may have been changed, so project metadata is refetched
+    ps.invalidate_project_info(project_scenario_id)
+    try:
+        task_id = ee.submit(str(uuid4()), project_scenario_id, token)
+    except queue.Full:
+        raise HTTPException(status_code=429, detail='Too many evaluations in queue, try again later')
     return {'task_id' : task_id }
 
+@router.delete('/evaluate')
+def cancel_evaluation(task_id: str, token: str = Depends(auth.verify_token)):
+    if not ee.cancel(task_id, token):
+        raise HTTPException(status_code=404, detail='Task is not waiting or running for this token')
+    return 'oke'
+
 @router.delete('/evaluation')
 def delete_evaluation(project_scenario_id : int):
     try:
+        ps.invalidate_project_info(project_scenario_id)
         es.delete_evaluation(project_scenario_id)
         return 'oke'
     except:
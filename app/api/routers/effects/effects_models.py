@@ -13,6 +13,11 @@ class ScaleType(Enum):
   PROJECT='Проект'
   CONTEXT='Контекст'
 
+class LayerType(Enum):
+  PROVISION='provision'
+  TRANSPORT='transport'
+  CONNECTIVITY='connectivity'
+
 class ChartData(BaseModel):
   name : str
   before : float
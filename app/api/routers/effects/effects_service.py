@@ -1,16 +1,22 @@
+import json
 import os
+import multiprocessing
 import random
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import geopandas as gpd
 import warnings
 import pandas as pd
 import numpy as np
+import shapely
 from urllib3.exceptions import InsecureRequestWarning
 from loguru import logger
-from shapely import intersection
-from blocksnet import (City, WeightedConnectivity, Connectivity, Provision)
-from ...utils import const
+from pydantic import InstanceOf
+from blocksnet import (City, WeightedConnectivity, Connectivity, Provision, ServiceType)
+from ...utils import const, frame_cache, metrics, result_store as rs, task_store, urban_api
+from ...utils.stage_scheduler import Stage, run_stages
 from . import effects_models as em
-from .services import blocksnet_service as bs, project_service as ps, service_type_service as sts
+from .services import blocksnet_service as bs, project_service as ps, service_type_service as sts, tile_service as ts
 
 for warning in [pd.errors.PerformanceWarning, RuntimeWarning, pd.errors.SettingWithCopyWarning, InsecureRequestWarning, FutureWarning]:
     warnings.filterwarnings(action='ignore', category=warning)
@@ -21,292 +27,545 @@ def _get_file_path(project_scenario_id: int, effect_type: em.EffectType, scale_t
     file_path = f'{project_scenario_id}_{effect_type.name}_{scale_type.name}'
     return os.path.join(const.DATA_PATH, f'{file_path}.parquet')
 
-def _get_total_provision(gdf_orig, name):
-    gdf = gdf_orig.copy()
-
-    for column in PROVISION_COLUMNS:
-        new_column = column.replace(f'{name}_', '')
-        gdf = gdf.rename(columns={f'{name}_{column}': new_column})
-
-    return round(Provision.total(gdf), 2)
+def _write_result(gdf: gpd.GeoDataFrame, project_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType):
+    """
+    Write effect layer for selective reads: readers load geometry and the columns they need,
+    so row groups and column statistics let parquet skip everything else
+    """
+    if const.PARQUET_SPATIAL_SORT and len(gdf) > 0:
+        # neighbouring blocks share row groups, index labels are kept for blocks mapping
+        gdf = gdf.iloc[np.argsort(gdf.geometry.hilbert_distance().values, kind='stable')]
+    file_path = _get_file_path(project_scenario_id, effect_type, scale_type)
+    with metrics.span('write_parquet'):
+        rs.write_atomic(file_path, partial(gdf.to_parquet, row_group_size=const.PARQUET_ROW_GROUP_SIZE, write_statistics=True))
+    _write_summary(gdf, project_scenario_id, effect_type, scale_type)
+
+def _get_summary_path(project_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType):
+    file_path = f'{project_scenario_id}_{effect_type.name}_{scale_type.name}'
+    return os.path.join(const.DATA_PATH, f'{file_path}.json')
+
+def _summarize_values(values: pd.Series) -> dict[str, float]:
+    return {
+        'mean': float(np.mean(values)),
+        'median': float(np.median(values)),
+        'min': float(np.min(values)),
+        'max': float(np.max(values))
+    }
 
-def _sjoin_gdfs(gdf_before : gpd.GeoDataFrame, gdf_after : gpd.GeoDataFrame):
-    gdf_before = gdf_before.to_crs(gdf_after.crs)
-    # set i to identify intersections
-    gdf_before['i'] = gdf_before.index
-    gdf_after['i'] = gdf_after.index
-    gdf_sjoin = gdf_after.sjoin(gdf_before, how='left', predicate='intersects', lsuffix='after', rsuffix='before')
-    # filter nans
-    gdf_sjoin = gdf_sjoin[~gdf_sjoin['i_before'].isna()]
-    gdf_sjoin = gdf_sjoin[~gdf_sjoin['i_after'].isna()]
-    # get intersections area and keep largest
-    gdf_sjoin['area'] = gdf_sjoin.apply(lambda s : gdf_before.loc[s['i_before'], 'geometry'].intersection(gdf_after.loc[s['i_after'], 'geometry']).area, axis=1)
-    gdf_sjoin = gdf_sjoin.sort_values(by='area')
-    return gdf_sjoin.drop_duplicates(subset=['i_after'], keep='last')
+def _summarize_provision(df: pd.DataFrame) -> dict[str, float]:
+    # Provision.total of every service type at once
+    names = [column.removesuffix('_provision') for column in df.columns if column.endswith('_provision')]
+    demand = df[[f'{name}_demand' for name in names]].sum().values
+    demand_within = df[[f'{name}_demand_within' for name in names]].sum().values
+    # rounded like charts always showed them
+    return dict(zip(names, np.round(demand_within / demand, 2).tolist()))
+
+EFFECT_SUMMARIES = {
+    em.EffectType.TRANSPORT: lambda df: _summarize_values(df['weighted_connectivity']),
+    em.EffectType.CONNECTIVITY: lambda df: _summarize_values(df['connectivity']),
+    em.EffectType.PROVISION: _summarize_provision
+}
+
+def _write_summary(df: pd.DataFrame, project_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType) -> dict[str, float]:
+    summary = EFFECT_SUMMARIES[effect_type](df)
+    def write(tmp_path: str):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+    rs.write_atomic(_get_summary_path(project_scenario_id, effect_type, scale_type), write)
+    return summary
+
+def _get_summary(project_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType) -> dict[str, float]:
+    summary_path = _get_summary_path(project_scenario_id, effect_type, scale_type)
+    if not os.path.exists(summary_path):
+        # results evaluated before summaries were written alongside them
+        df = pd.read_parquet(_get_file_path(project_scenario_id, effect_type, scale_type))
+        return _write_summary(df, project_scenario_id, effect_type, scale_type)
+    with open(summary_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _get_chart_data(project_scenario_id: int, based_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType,
+                    names_keys: dict[str, str], digits: int) -> list[dict]:
+    _touch_results(project_scenario_id, based_scenario_id)
+    summary_before = _get_summary(based_scenario_id, effect_type, scale_type)
+    summary_after = _get_summary(project_scenario_id, effect_type, scale_type)
+    items = []
+    for name, key in names_keys.items():
+        before = summary_before[key]
+        after = summary_after[key]
+        delta = after - before
+        items.append({
+            'name': name,
+            'before': round(before, digits),
+            'after': round(after, digits),
+            'delta': round(delta, digits)
+        })
+    return items
 
-def get_transport_layer(project_scenario_id: int, scale_type: em.ScaleType, token: str):
-    project_info = ps.get_project_info(project_scenario_id, token)
-    based_scenario_id = ps.get_based_scenario_id(project_info, token)
+def _get_blocks_path(project_scenario_id: int, scale_type: em.ScaleType):
+    return os.path.join(const.DATA_PATH, f'{project_scenario_id}_BLOCKS_{scale_type.name}.parquet')
 
-    # get both files
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.TRANSPORT, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.TRANSPORT, scale_type)
+def _get_snapshot_path(project_scenario_id: int):
+    return os.path.join(const.DATA_PATH, f'{project_scenario_id}_SNAPSHOT.json')
 
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
+def _get_mapping_path(project_scenario_id: int, based_scenario_id: int, scale_type: em.ScaleType):
+    file_path = f'{project_scenario_id}_{based_scenario_id}_MAPPING_{scale_type.name}'
+    return os.path.join(const.DATA_PATH, f'{file_path}.parquet')
 
-    # calculate delta
-    gdf_delta = _sjoin_gdfs(gdf_before, gdf_after)
-    gdf_delta = gdf_delta.rename(columns={
-        'weighted_connectivity_before': 'before',
-        'weighted_connectivity_after': 'after'
-    })[['geometry', 'before', 'after']]
+def _get_result_paths(project_scenario_id: int, based_scenario_id: int) -> list[str]:
+    """
+    Files the evaluation of the scenario writes, as listed in its manifest
+    """
+    paths = [_get_snapshot_path(project_scenario_id)]
+    for scale_type in list(em.ScaleType):
+        paths.append(_get_blocks_path(project_scenario_id, scale_type))
+        if project_scenario_id != based_scenario_id:
+            paths.append(_get_mapping_path(project_scenario_id, based_scenario_id, scale_type))
+        for effect_type in list(em.EffectType):
+            paths.append(_get_file_path(project_scenario_id, effect_type, scale_type))
+            paths.append(_get_summary_path(project_scenario_id, effect_type, scale_type))
+    return paths
+
+def _touch_results(project_scenario_id: int, based_scenario_id: int):
+    # reads keep both scenarios away from eviction
+    for scenario_id in {project_scenario_id, based_scenario_id}:
+        rs.touch(scenario_id)
+
+def _match_blocks(gdf_before : gpd.GeoDataFrame, gdf_after : gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Match every after block with the before block it overlaps the most, the first of equally overlapping before blocks.
+    Returns index labels of matched blocks ordered by overlap area, then by after block position
+    """
+    gdf_before = gdf_before.to_crs(gdf_after.crs)
+    before_geoms = gdf_before.geometry.values.to_numpy()
+    after_geoms = gdf_after.geometry.values.to_numpy()
+    # all intersecting (after, before) pairs as positional indices
+    i_after, i_before = gdf_before.sindex.query(after_geoms, predicate='intersects')
+    pairs = pd.DataFrame({
+        'i_after': i_after,
+        'i_before': i_before,
+        'area': shapely.area(shapely.intersection(after_geoms[i_after], before_geoms[i_before]))
+    })
+    # keep largest intersection per after block, spatial index returns before blocks in no particular order
+    pairs = pairs.sort_values(by=['i_after', 'area', 'i_before'], ascending=[True, False, True], kind='stable')
+    pairs = pairs.drop_duplicates(subset='i_after', keep='first')
+    pairs = pairs.sort_values(by=['area', 'i_after'], kind='stable')
+    return pd.DataFrame({
+        'after': gdf_after.index[pairs['i_after'].values],
+        'before': gdf_before.index[pairs['i_before'].values]
+    })
+
+def _save_blocks_mapping(project_scenario_id: int, based_scenario_id: int, scale_type: em.ScaleType) -> pd.DataFrame:
+    # every effect layer of a scale holds the same blocks, so transport ones are used
+    gdf_before = frame_cache.read_parquet(_get_file_path(based_scenario_id, em.EffectType.TRANSPORT, scale_type), columns=['geometry'])
+    gdf_after = frame_cache.read_parquet(_get_file_path(project_scenario_id, em.EffectType.TRANSPORT, scale_type), columns=['geometry'])
+    mapping = _match_blocks(gdf_before, gdf_after)
+    rs.write_atomic(_get_mapping_path(project_scenario_id, based_scenario_id, scale_type), mapping.to_parquet)
+    return mapping
+
+def _get_blocks_mapping(project_scenario_id: int, based_scenario_id: int, scale_type: em.ScaleType) -> pd.DataFrame:
+    mapping_path = _get_mapping_path(project_scenario_id, based_scenario_id, scale_type)
+    blocks_mtime = max(
+        os.path.getmtime(_get_file_path(scenario_id, em.EffectType.TRANSPORT, scale_type))
+        for scenario_id in [project_scenario_id, based_scenario_id]
+    )
+    # a mapping older than the blocks of either scenario is stale
+    if os.path.exists(mapping_path) and os.path.getmtime(mapping_path) >= blocks_mtime:
+        return frame_cache.read_parquet(mapping_path, geometry=False)
+    return _save_blocks_mapping(project_scenario_id, based_scenario_id, scale_type)
+
+def _delete_blocks_mappings(scenario_id: int):
+    for file_name in os.listdir(const.DATA_PATH):
+        parts = file_name.split('_')
+        if len(parts) == 4 and parts[2] == 'MAPPING' and str(scenario_id) in parts[:2]:
+            rs.remove(os.path.join(const.DATA_PATH, file_name))
+
+def _get_delta_layer(project_scenario_id: int, based_scenario_id: int, effect_type: em.EffectType, scale_type: em.ScaleType, column: str, digits: int):
+    _touch_results(project_scenario_id, based_scenario_id)
+    before_file_path = _get_file_path(based_scenario_id, effect_type, scale_type)
+    after_file_path = _get_file_path(project_scenario_id, effect_type, scale_type)
+
+    gdf_before = frame_cache.read_parquet(before_file_path, columns=['geometry', column])
+    gdf_after = frame_cache.read_parquet(after_file_path, columns=['geometry', column])
+
+    # gather matched blocks values
+    mapping = _get_blocks_mapping(project_scenario_id, based_scenario_id, scale_type)
+    gdf_after = gdf_after.loc[mapping['after']]
+    gdf_delta = gpd.GeoDataFrame({
+        'geometry': gdf_after.geometry.values,
+        'before': gdf_before.loc[mapping['before'], column].values,
+        'after': gdf_after[column].values
+    }, index=gdf_after.index, crs=gdf_after.crs)
     gdf_delta['delta'] = gdf_delta['after'] - gdf_delta['before']
 
     # round digits
     for column in ['before', 'after', 'delta']:
-        gdf_delta[column] = gdf_delta[column].apply(lambda v : round(v,1))
+        gdf_delta[column] = gdf_delta[column].apply(lambda v : round(v,digits))
 
     return gdf_delta
 
-def get_transport_data(project_scenario_id: int, scale_type: em.ScaleType, token: str):
+def get_transport_layer(project_scenario_id: int, scale_type: em.ScaleType, token: str):
     project_info = ps.get_project_info(project_scenario_id, token)
     based_scenario_id = ps.get_based_scenario_id(project_info, token)
+    return _get_delta_layer(project_scenario_id, based_scenario_id, em.EffectType.TRANSPORT, scale_type, 'weighted_connectivity', 1)
 
-    # get both files
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.TRANSPORT, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.TRANSPORT, scale_type)
-
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
+def get_transport_data(project_scenario_id: int, scale_type: em.ScaleType, token: str):
+    project_info = ps.get_project_info(project_scenario_id, token)
+    based_scenario_id = ps.get_based_scenario_id(project_info, token)
 
-    # calculate chart data
-    names_funcs = {
-        'Среднее': np.mean,
-        'Медиана': np.median,
-        'Мин': np.min,
-        'Макс': np.max
+    names_keys = {
+        'Среднее': 'mean',
+        'Медиана': 'median',
+        'Мин': 'min',
+        'Макс': 'max'
     }
-
-    items = []
-    for name, func in names_funcs.items():
-        before = func(gdf_before['weighted_connectivity'])
-        after = func(gdf_after['weighted_connectivity'])
-        delta = after - before
-        items.append({
-            'name': name,
-            'before': round(before,1),
-            'after': round(after,1),
-            'delta': round(delta,1)
-        })
-    return items
+    return _get_chart_data(project_scenario_id, based_scenario_id, em.EffectType.TRANSPORT, scale_type, names_keys, 1)
 
 def get_connectivity_layer(project_scenario_id: int, scale_type: em.ScaleType, token: str):
     project_info = ps.get_project_info(project_scenario_id, token)
     based_scenario_id = ps.get_based_scenario_id(project_info, token)
-
-    # get both files
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.CONNECTIVITY, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.CONNECTIVITY, scale_type)
-
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
-
-    # calculate delta
-    gdf_delta = _sjoin_gdfs(gdf_before, gdf_after)
-    gdf_delta = gdf_delta.rename(columns={
-        'connectivity_before': 'before',
-        'connectivity_after': 'after'
-    })[['geometry', 'before', 'after']]
-    gdf_delta['delta'] = gdf_delta['after'] - gdf_delta['before']
-
-    # round digits
-    for column in ['before', 'after', 'delta']:
-        gdf_delta[column] = gdf_delta[column].apply(lambda v : round(v,1))
-
-    return gdf_delta
+    return _get_delta_layer(project_scenario_id, based_scenario_id, em.EffectType.CONNECTIVITY, scale_type, 'connectivity', 1)
 
 def get_connectivity_data(project_scenario_id: int, scale_type: em.ScaleType, token: str):
     project_info = ps.get_project_info(project_scenario_id, token)
     based_scenario_id = ps.get_based_scenario_id(project_info, token)
 
-    # get both files
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.CONNECTIVITY, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.CONNECTIVITY, scale_type)
-
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
-
-    # calculate chart data
-    names_funcs = {
-        'Среднее': np.mean,
-        'Мин': np.min,
-        'Макс': np.max
+    names_keys = {
+        'Среднее': 'mean',
+        'Мин': 'min',
+        'Макс': 'max'
     }
-
-    items = []
-    for name, func in names_funcs.items():
-        before = func(gdf_before['connectivity'])
-        after = func(gdf_after['connectivity'])
-        delta = after - before
-        items.append({
-            'name': name,
-            'before': round(before,1),
-            'after': round(after,1),
-            'delta': round(delta,1)
-        })
-    print(items)
-    return items
+    return _get_chart_data(project_scenario_id, based_scenario_id, em.EffectType.CONNECTIVITY, scale_type, names_keys, 1)
 
 def get_provision_layer(project_scenario_id: int, scale_type: em.ScaleType, service_type_id: int, token: str):
     project_info = ps.get_project_info(project_scenario_id, token)
     based_scenario_id = ps.get_based_scenario_id(project_info, token)
 
-    service_types = sts.get_bn_service_types(project_info['region_id'])
-    service_type = list(filter(lambda x: x.code == str(service_type_id), service_types))[0]
-
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.PROVISION, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.PROVISION, scale_type)
-
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
-
+    service_type = sts.get_bn_service_types_index(project_info['region_id'])[str(service_type_id)]
     provision_column = f'{service_type.name}_provision'
 
-    # calculate delta
-    gdf_delta = _sjoin_gdfs(gdf_before, gdf_after)
-    gdf_delta = gdf_delta.rename(columns={
-        f'{provision_column}_before': 'before',
-        f'{provision_column}_after': 'after'
-    })[['geometry', 'before', 'after']]
-    gdf_delta['delta'] = gdf_delta['after'] - gdf_delta['before']
-
-    for column in ['before', 'after', 'delta']:
-        gdf_delta[column] = gdf_delta[column].apply(lambda v : round(v,2))
-
-    return gdf_delta
+    return _get_delta_layer(project_scenario_id, based_scenario_id, em.EffectType.PROVISION, scale_type, provision_column, 2)
 
 
 def get_provision_data(project_scenario_id: int, scale_type: em.ScaleType, token: str) -> list[em.ChartData]:
     project_info = ps.get_project_info(project_scenario_id, token)
     based_scenario_id = ps.get_based_scenario_id(project_info, token)
 
-    before_file_path = _get_file_path(based_scenario_id, em.EffectType.PROVISION, scale_type)
-    after_file_path = _get_file_path(project_scenario_id, em.EffectType.PROVISION, scale_type)
-
-    gdf_before = gpd.read_parquet(before_file_path)
-    gdf_after = gpd.read_parquet(after_file_path)
-
     service_types = sts.get_bn_service_types(project_info['region_id'])
-    results = []
-    for st in service_types:
-        name = st.name
+    names_keys = {st.name: st.name for st in service_types}
+    return _get_chart_data(project_scenario_id, based_scenario_id, em.EffectType.PROVISION, scale_type, names_keys, 2)
 
-        before = _get_total_provision(gdf_before, name)
-        after = _get_total_provision(gdf_after, name)
-        delta = after - before
+LAYER_EFFECTS = {
+    em.LayerType.PROVISION: em.EffectType.PROVISION,
+    em.LayerType.TRANSPORT: em.EffectType.TRANSPORT,
+    em.LayerType.CONNECTIVITY: em.EffectType.CONNECTIVITY
+}
 
-        results.append({
-            'name': name,
-            'before': round(before,2),
-            'after': round(after,2),
-            'delta': round(delta,2)
-        })
-    return results
+def get_layer_tile(layer_type: em.LayerType, project_scenario_id: int, scale_type: em.ScaleType, z: int, x: int, y: int, token: str, service_type_id: int | None = None) -> bytes:
+    project_info = ps.get_project_info(project_scenario_id, token)
+    based_scenario_id = ps.get_based_scenario_id(project_info, token)
 
+    if layer_type == em.LayerType.PROVISION:
+        layer_name = f'{layer_type.value}_{service_type_id}'
+        get_layer = partial(get_provision_layer, project_scenario_id, scale_type, service_type_id, token)
+    elif layer_type == em.LayerType.TRANSPORT:
+        layer_name = layer_type.value
+        get_layer = partial(get_transport_layer, project_scenario_id, scale_type, token)
+    else:
+        layer_name = layer_type.value
+        get_layer = partial(get_connectivity_layer, project_scenario_id, scale_type, token)
+
+    # results are rewritten by evaluation processes, so the layer kept in memory is checked against them
+    effect_type = LAYER_EFFECTS[layer_type]
+    layer_version = tuple(os.path.getmtime(_get_file_path(scenario_id, effect_type, scale_type)) for scenario_id in [project_scenario_id, based_scenario_id])
+    tiles_key = f'{project_scenario_id}_{based_scenario_id}_{scale_type.name}_{layer_name}'
+    _touch_results(project_scenario_id, based_scenario_id)
+    return ts.get_tile(tiles_key, layer_name, z, x, y, get_layer, layer_version)
+
+@metrics.timed()
 def _evaluate_transport(project_scenario_id: int, city_model: City, scale: em.ScaleType):
     logger.info('Evaluating transport')
     conn = WeightedConnectivity(city_model=city_model, verbose=False)
     conn_gdf = conn.calculate()
-    file_path = _get_file_path(project_scenario_id, em.EffectType.TRANSPORT, scale)
-    conn_gdf.to_parquet(file_path)
+    _write_result(conn_gdf, project_scenario_id, em.EffectType.TRANSPORT, scale)
     logger.success('Transport successfully evaluated!')
 
+@metrics.timed()
 def _evaluate_connectivity(project_scenario_id: int, city_model: City, scale: em.ScaleType):
     logger.info('Evaluating connectivity')
     conn = Connectivity(city_model=city_model, verbose=False)
     conn_gdf = conn.calculate()
     conn_gdf['connectivity'] = conn_gdf['connectivity'].astype('float32')
     conn_gdf['connectivity'] = conn_gdf['connectivity'].apply(lambda v : np.nan if np.isinf(v) else v)
-    file_path = _get_file_path(project_scenario_id, em.EffectType.CONNECTIVITY, scale)
-    conn_gdf.to_parquet(file_path)
+    _write_result(conn_gdf, project_scenario_id, em.EffectType.CONNECTIVITY, scale)
     logger.success('Connectivity successfully evaluated!')
 
+class _SharedBlocksProvision(Provision):
+    """
+    Provision taking blocks population and capacities computed once for every service type,
+    instead of rebuilding the blocks layer from the city model per service type
+    """
+    blocks_gdf: InstanceOf[gpd.GeoDataFrame]
+
+    def _get_blocks_gdf(self, service_type: ServiceType, update_df: pd.DataFrame | None = None) -> gpd.GeoDataFrame:
+        if update_df is not None:
+            return super()._get_blocks_gdf(service_type, update_df)
+        capacity_column = f'capacity_{service_type.name}'
+        gdf = self.blocks_gdf[['geometry', 'population', capacity_column]].fillna(0)
+        gdf = gdf.rename(columns={'population': 'demand', capacity_column: 'capacity'})
+        # same as ServiceType.calculate_in_need for the whole column
+        gdf['demand'] = np.ceil(gdf['demand'] / 1000 * service_type.demand).astype('int64')
+        gdf['capacity_left'] = gdf['capacity']
+        gdf['demand_left'] = gdf['demand']
+        gdf['demand_within'] = 0
+        gdf['demand_without'] = 0
+        return gdf
+
+# provision input shared with forked workers
+_provision : _SharedBlocksProvision | None = None
+
+def _calculate_provision(service_type_name: str) -> pd.DataFrame:
+    prov_gdf = _provision.calculate(service_type_name)
+    return prov_gdf[PROVISION_COLUMNS].add_prefix(f'{service_type_name}_')
+
+def _get_provision_workers(service_types_count: int) -> int:
+    # workers of a provision stage are counted as stage workers of the evaluation, see _evaluate_scenario
+    return max(1, min(const.PROVISION_WORKERS, const.EVALUATION_STAGE_WORKERS, service_types_count))
+
+@metrics.timed()
 def _evaluate_provision(project_scenario_id: int, city_model: City, scale: em.ScaleType):
+    global _provision
     logger.info('Evaluating provision')
-    blocks_gdf = city_model.get_blocks_gdf()[['geometry']]
-
-    for st in city_model.service_types:
-        prov = Provision(city_model=city_model, verbose=False)
-        prov_gdf = prov.calculate(st)
-        for column in PROVISION_COLUMNS:
-            blocks_gdf[f'{st.name}_{column}'] = prov_gdf[column]
-
-    file_path = _get_file_path(project_scenario_id, em.EffectType.PROVISION, scale)
-    blocks_gdf.to_parquet(file_path)
+    blocks_gdf = city_model.get_blocks_gdf()
+    _provision = _SharedBlocksProvision(city_model=city_model, blocks_gdf=blocks_gdf, verbose=False)
+    service_type_names = [st.name for st in city_model.service_types]
+
+    # service types are independent, so they are spread across forked workers sharing the model and the matrix
+    max_workers = _get_provision_workers(len(service_type_names))
+    try:
+        if max_workers > 1:
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+                prov_dfs = list(executor.map(_calculate_provision, service_type_names))
+        else:
+            prov_dfs = [_calculate_provision(name) for name in service_type_names]
+    finally:
+        _provision = None
+    blocks_gdf = gpd.GeoDataFrame(pd.concat([blocks_gdf[['geometry']], *prov_dfs], axis=1), crs=blocks_gdf.crs)
+    _write_result(blocks_gdf, project_scenario_id, em.EffectType.PROVISION, scale)
     logger.success('Provision successfully evaluated!')
 
-def _evaluation_exists(project_scenario_id : int, token : str):
-    exists = True
-    for effect_type in list(em.EffectType):
-        for scale_type in list(em.ScaleType):
-            file_path = _get_file_path(project_scenario_id, effect_type, scale_type)
-            if not os.path.exists(file_path):
-                exists = False
-    return exists
+EFFECT_EVALUATORS = {
+    em.EffectType.TRANSPORT: _evaluate_transport,
+    em.EffectType.CONNECTIVITY: _evaluate_connectivity,
+    em.EffectType.PROVISION: _evaluate_provision
+}
+
+def _evaluate_effect(effect_type: em.EffectType, project_scenario_id: int, scale: em.ScaleType, blocks: tuple[gpd.GeoDataFrame, str], city_model: City):
+    # the matrix is mapped from the disk cache by every stage instead of being sent with the model
+    EFFECT_EVALUATORS[effect_type](project_scenario_id, bs.attach_acc_mx(city_model, blocks), scale)
+
+# rough peak memory of stages in accessibility matrix sizes, per worker for effects
+ACC_MX_MEMORY_FACTOR = 6 # float64 distances between blocks and the matrix itself
+MODEL_MEMORY_FACTOR = 1 # in-memory copy of the matrix made by City
+EFFECT_MEMORY_FACTORS = {
+    em.EffectType.TRANSPORT: 4,
+    em.EffectType.CONNECTIVITY: 2,
+    em.EffectType.PROVISION: 2
+}
+
+def _estimate_stage_memory(factor: int, blocks: tuple[gpd.GeoDataFrame, ...], *_) -> int:
+    return factor * bs.get_acc_mx_nbytes(blocks[0])
+
+# scenario parts effects depend on besides the blocks layer, see bs.get_scenario_fingerprints
+EFFECT_DEPENDENCIES = {
+    # weighted by blocks population and services count
+    em.EffectType.TRANSPORT: {'buildings', 'services'},
+    em.EffectType.CONNECTIVITY: set(),
+    em.EffectType.PROVISION: {'buildings', 'services'}
+}
+
+def _read_snapshot(project_scenario_id : int) -> dict | None:
+    snapshot_path = _get_snapshot_path(project_scenario_id)
+    if not os.path.exists(snapshot_path):
+        return None
+    with open(snapshot_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_snapshot(project_scenario_id : int, snapshot : dict) -> None:
+    def write(tmp_path : str):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+    rs.write_atomic(_get_snapshot_path(project_scenario_id), write)
+
+def _read_blocks(project_scenario_id : int, scale_type : em.ScaleType, acc_mx_key : str) -> tuple[gpd.GeoDataFrame, str]:
+    return gpd.read_parquet(_get_blocks_path(project_scenario_id, scale_type)), acc_mx_key
+
+def _get_changes(project_scenario_id : int, based_scenario_id : int, snapshot : dict | None, fingerprints : dict[str, str]) -> tuple[set[str], bool]:
+    """
+    Scenario parts changed since the last evaluation, and whether its blocks and accessibility matrices can be reused
+    """
+    if snapshot is None or not _evaluation_exists(project_scenario_id, based_scenario_id):
+        return set(fingerprints), False
+    changes = {part for part, fingerprint in fingerprints.items() if snapshot['fingerprints'].get(part) != fingerprint}
+    reuse_blocks = 'roads' not in changes and all(
+        os.path.exists(_get_blocks_path(project_scenario_id, scale_type)) and bs.is_acc_mx_cached(snapshot['acc_mx_keys'][scale_type.name])
+        for scale_type in list(em.ScaleType)
+    )
+    return changes, reuse_blocks
+
+def _evaluation_exists(project_scenario_id : int, based_scenario_id : int):
+    manifest = rs.read_manifest(project_scenario_id)
+    if manifest is not None:
+        return manifest['complete']
+    # results evaluated before manifests were kept
+    paths = [_get_file_path(project_scenario_id, et, st) for et in list(em.EffectType) for st in list(em.ScaleType)]
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    rs.write_manifest(project_scenario_id, based_scenario_id, _get_result_paths(project_scenario_id, based_scenario_id), complete=True)
+    return True
 
 def delete_evaluation(project_scenario_id : int):
+    # manifest goes first, so the scenario is no longer seen as evaluated while its files are removed
+    rs.delete_manifest(project_scenario_id)
+    _delete_blocks_mappings(project_scenario_id)
+    ts.delete_tiles(project_scenario_id)
+    file_paths = [_get_snapshot_path(project_scenario_id)]
+    file_paths.extend(_get_blocks_path(project_scenario_id, scale_type) for scale_type in list(em.ScaleType))
     for effect_type in list(em.EffectType):
         for scale_type in list(em.ScaleType):
-            file_path = _get_file_path(project_scenario_id, effect_type, scale_type)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-def evaluate_effects(project_scenario_id : int, token: str, reevaluate : bool = True):
-    logger.info(f'Fetching {project_scenario_id} project info')
-    
-    project_info = ps.get_project_info(project_scenario_id, token)
-    based_scenario_id = ps.get_based_scenario_id(project_info, token)
-    # if scenario isnt based, evaluate the based scenario
-    if project_scenario_id != based_scenario_id:
-        evaluate_effects(based_scenario_id, token, reevaluate=False)
-    
-    # if scenario exists and doesnt require reevaluation, we return
-    exists = _evaluation_exists(project_scenario_id, token)
-    if exists and not reevaluate:
-        logger.info(f'{project_scenario_id} evaluation already exists')
+            file_paths.extend([_get_file_path(project_scenario_id, effect_type, scale_type), _get_summary_path(project_scenario_id, effect_type, scale_type)])
+    for file_path in file_paths:
+        rs.remove(file_path)
+    # rewritten files are noticed by mtime, removed ones are released here
+    frame_cache.invalidate(lambda path: str(project_scenario_id) in os.path.basename(path).split('_')[:2])
+
+def _evaluate_scenario(project_scenario_id : int, based_scenario_id : int, project_info : dict, token : str, task_id : str | None):
+    logger.info('Fetching region service types, physical object types and scenario objects')
+    with task_store.stage(task_id, f'{project_scenario_id}_urban_api'):
+        service_types, physical_object_types, scenario_gdf = urban_api.gather(
+            lambda: sts.get_bn_service_types(project_info['region_id']),
+            ps.get_physical_object_types,
+            lambda: ps.get_scenario_objects(project_scenario_id, token)
+        )
+
+    # nested objects are flattened once for the diff and every blocks and model stage, then released before stages fork
+    with task_store.stage(task_id, f'{project_scenario_id}_normalize'):
+        scenario = bs.normalize_scenario(scenario_gdf, physical_object_types)
+    del scenario_gdf
+
+    # compare scenario objects with the last evaluation, so only affected effects are reevaluated
+    with task_store.stage(task_id, f'{project_scenario_id}_diff'):
+        fingerprints = bs.get_scenario_fingerprints(project_info, scenario, service_types)
+        snapshot = _read_snapshot(project_scenario_id)
+        changes, reuse_blocks = _get_changes(project_scenario_id, based_scenario_id, snapshot, fingerprints)
+    effect_types = [et for et in list(em.EffectType) if not reuse_blocks or len(changes & EFFECT_DEPENDENCIES[et]) > 0]
+    if len(effect_types) == 0:
+        logger.info(f'{project_scenario_id} objects are unchanged since the last evaluation')
+        rs.touch(project_scenario_id)
         return
-    
-    logger.info('Fetching region service types')
-    service_types = sts.get_bn_service_types(project_info['region_id'])
-    logger.info('Fetching physical object types')
-    physical_object_types = ps.get_physical_object_types()
-    logger.info('Fetching scenario objects')
-    scenario_gdf = ps.get_scenario_objects(project_scenario_id, token)
-
-    logger.info('Fetching project model')
-    project_model = bs.fetch_city_model(project_info=project_info,
-                                      service_types=service_types,
-                                      physical_object_types=physical_object_types,
-                                      scenario_gdf=scenario_gdf,
-                                      scale=em.ScaleType.PROJECT)
-
-    logger.info('Fetching context model')
-    context_model = bs.fetch_city_model(project_info=project_info,
-                                      service_types=service_types,
-                                      physical_object_types=physical_object_types,
-                                      scenario_gdf=scenario_gdf,
-                                      scale=em.ScaleType.CONTEXT)
-    
-    # project_model.to_pickle(f'{project_scenario_id}_project.pickle')
-    # context_model.to_pickle(f'{project_scenario_id}_context.pickle')
-
-    _evaluate_transport(project_scenario_id, project_model, em.ScaleType.PROJECT)
-    _evaluate_connectivity(project_scenario_id, project_model, em.ScaleType.PROJECT)
-    _evaluate_provision(project_scenario_id, project_model, em.ScaleType.PROJECT)
-
-    _evaluate_transport(project_scenario_id, context_model, em.ScaleType.CONTEXT)
-    _evaluate_connectivity(project_scenario_id, context_model, em.ScaleType.CONTEXT)
-    _evaluate_provision(project_scenario_id, context_model, em.ScaleType.CONTEXT)
+    logger.info(f'Changed {sorted(changes)}, evaluating {[et.name for et in effect_types]}' + (' on existing blocks' if reuse_blocks else ''))
+
+    # snapshot and complete manifest are written back only on success, so an interrupted evaluation is redone in full.
+    # Incomplete manifest keeps referring to the based scenario, so it isn't evicted meanwhile
+    result_paths = _get_result_paths(project_scenario_id, based_scenario_id)
+    rs.write_manifest(project_scenario_id, based_scenario_id, result_paths, complete=False)
+    rs.remove(_get_snapshot_path(project_scenario_id))
+    # blocks of the scenario are about to change
+    _delete_blocks_mappings(project_scenario_id)
+    ts.delete_tiles(project_scenario_id)
+
+    # blocks and models of both scales are built concurrently, then every effect of a scale runs as soon as its model is ready.
+    # Stages send back blocks, matrix keys and models without matrices, matrices are shared through the disk cache
+    stages = {}
+    for scale_type in list(em.ScaleType):
+        layout_stage = f'{scale_type.name}_layout'
+        blocks_stage = f'{scale_type.name}_blocks'
+        model_stage = f'{scale_type.name}_model'
+        if reuse_blocks:
+            stages[blocks_stage] = Stage(partial(_read_blocks, project_scenario_id, scale_type, snapshot['acc_mx_keys'][scale_type.name]))
+        else:
+            stages[layout_stage] = Stage(partial(bs.fetch_layout,
+                                                 project_info=project_info,
+                                                 scenario=scenario,
+                                                 scale=scale_type))
+            stages[blocks_stage] = Stage(bs.fetch_acc_mx,
+                                         deps=(layout_stage,),
+                                         memory=partial(_estimate_stage_memory, ACC_MX_MEMORY_FACTOR))
+        stages[model_stage] = Stage(partial(bs.fetch_city_model,
+                                            project_info=project_info,
+                                            service_types=service_types,
+                                            scenario=scenario,
+                                            scale=scale_type),
+                                    deps=(blocks_stage,),
+                                    memory=partial(_estimate_stage_memory, MODEL_MEMORY_FACTOR))
+        for effect_type in effect_types:
+            workers = _get_provision_workers(len(service_types)) if effect_type == em.EffectType.PROVISION else 1
+            stages[f'{scale_type.name}_{effect_type.name}'] = Stage(
+                partial(_evaluate_effect, effect_type, project_scenario_id, scale_type),
+                deps=(blocks_stage, model_stage),
+                memory=partial(_estimate_stage_memory, EFFECT_MEMORY_FACTORS[effect_type] * workers),
+                workers=workers
+            )
+
+    logger.info('Fetching models and evaluating effects')
+    on_start, on_finish = None, None
+    if task_id is not None:
+        on_start = lambda name: task_store.start_stage(task_id, f'{project_scenario_id}_{name}')
+        on_finish = lambda name, error: task_store.finish_stage(task_id, f'{project_scenario_id}_{name}', error)
+    results = run_stages(stages, const.EVALUATION_STAGE_WORKERS, const.EVALUATION_MEMORY_LIMIT_MB * 1024 * 1024, on_start, on_finish)
+
+    acc_mx_keys = {}
+    for scale_type in list(em.ScaleType):
+        blocks_gdf, acc_mx_keys[scale_type.name] = results[f'{scale_type.name}_blocks']
+        if not reuse_blocks:
+            with metrics.span('write_parquet'):
+                rs.write_atomic(_get_blocks_path(project_scenario_id, scale_type), blocks_gdf.to_parquet)
 
+    if project_scenario_id != based_scenario_id:
+        logger.info('Matching project blocks with based scenario blocks')
+        with task_store.stage(task_id, f'{project_scenario_id}_blocks_mapping'):
+            for scale_type in list(em.ScaleType):
+                _save_blocks_mapping(project_scenario_id, based_scenario_id, scale_type)
+
+    # tiles may have been cut from previous results while the evaluation was running
+    ts.delete_tiles(project_scenario_id)
+    _write_snapshot(project_scenario_id, {'fingerprints': fingerprints, 'acc_mx_keys': acc_mx_keys})
+    rs.write_manifest(project_scenario_id, based_scenario_id, result_paths, complete=True)
     logger.success(f'{project_scenario_id} evaluated successfully')
+    _evict_results(project_scenario_id, based_scenario_id)
+
+def _evict_results(project_scenario_id : int, based_scenario_id : int):
+    """
+    Delete least recently used results beyond RESULTS_QUOTA_MB, keeping the scenarios just evaluated
+    and the ones other processes are evaluating
+    """
+    if const.RESULTS_QUOTA_MB <= 0:
+        return
+    protected = {project_scenario_id, based_scenario_id} | task_store.get_locked_scenarios()
+    for scenario_id in rs.select_evictions(const.RESULTS_QUOTA_MB * 1024 * 1024, protected):
+        logger.info(f'Evicting {scenario_id} results')
+        delete_evaluation(scenario_id)
+
+def evaluate_effects(project_scenario_id : int, token: str, reevaluate : bool = True, task_id : str | None = None):
+    """
+    Evaluate effects of the scenario (and of its based scenario if missing).
+    Stages and spans are recorded to the task store if task_id is given
+    """
+    with metrics.task(task_id):
+        logger.info(f'Fetching {project_scenario_id} project info')
+
+        with task_store.stage(task_id, f'{project_scenario_id}_project_info'):
+            project_info = ps.get_project_info(project_scenario_id, token)
+            based_scenario_id = ps.get_based_scenario_id(project_info, token)
+        # if scenario isnt based, evaluate the based scenario
+        if project_scenario_id != based_scenario_id:
+            evaluate_effects(based_scenario_id, token, reevaluate=False, task_id=task_id)
+
+        # only one process evaluates the scenario at a time, others wait and then see its results
+        with task_store.scenario_lock(project_scenario_id, task_id):
+            # if scenario exists and doesnt require reevaluation, we return
+            exists = _evaluation_exists(project_scenario_id, based_scenario_id)
+            if exists and not reevaluate:
+                logger.info(f'{project_scenario_id} evaluation already exists')
+                return
+            _evaluate_scenario(project_scenario_id, based_scenario_id, project_info, token, task_id)
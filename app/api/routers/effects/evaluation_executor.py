@@ -0,0 +1,124 @@
+"""
+Runs effects evaluations in separate worker processes, so CPU-heavy BlocksNet work never blocks API workers.
+Running and waiting evaluations are counted in the task store, so the limits hold across every API worker
+"""
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from loguru import logger
+from ...utils import const, task_store
+from . import effects_service as es
+
+_context = multiprocessing.get_context(const.EVALUATION_START_METHOD)
+# tasks submitted to this API worker, bounded by the task store
+_queue : queue.Queue = queue.Queue()
+_processes : dict[str, multiprocessing.Process] = {}
+_lock = threading.Lock()
+_dispatcher : threading.Thread | None = None
+
+def _terminate(signum, frame):
+    raise SystemExit(1)
+
+def _evaluate(task_id : str, project_scenario_id : int, token : str):
+    # unwind on cancellation, so processes started by the evaluation are terminated too
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        es.evaluate_effects(project_scenario_id, token, task_id=task_id)
+    except Exception as e:
+        logger.error(e)
+        task_store.finish_task(task_id, 'error', error=f'{type(e).__name__}: {e}')
+        raise SystemExit(1)
+    task_store.finish_task(task_id, 'success')
+
+def _watch(task_id : str, process : multiprocessing.Process):
+    process.join()
+    with _lock:
+        del _processes[task_id]
+    # the evaluation process sets its own final status unless it was killed
+    task = task_store.get_task(task_id)
+    if task is not None and task['cancel_requested']:
+        task_store.finish_task(task_id, 'cancelled')
+    else:
+        task_store.finish_task(task_id, 'error', error=f'Evaluation process exited with code {process.exitcode}')
+
+def _start(task_id : str, args : tuple):
+    # wait for a slot free in every API worker, task stays waiting in the task store meanwhile
+    while (claimed := task_store.claim_task(task_id, const.EVALUATION_WORKERS)) is False:
+        time.sleep(const.EVALUATION_POLL_INTERVAL)
+    if claimed is None:
+        # cancelled while waiting
+        return
+    with _lock:
+        # not a daemon, since evaluation may start processes of its own
+        process = _context.Process(target=_evaluate, args=(task_id, *args), name=f'evaluation-{task_id}')
+        process.start()
+        _processes[task_id] = process
+    threading.Thread(target=_watch, args=(task_id, process), daemon=True).start()
+    if not task_store.start_task(task_id, process.pid):
+        task_store.request_cancel(task_id)
+        process.terminate()
+
+def _dispatch():
+    while True:
+        task_id, args = _queue.get()
+        # the dispatcher outlives failed starts, otherwise tasks queued later would wait forever
+        try:
+            _start(task_id, args)
+        except Exception as e:
+            logger.error(f'Failed to start {task_id}: {type(e).__name__}: {e}')
+            with _lock:
+                process = _processes.get(task_id)
+            if process is not None:
+                process.terminate()
+            try:
+                task_store.finish_task(task_id, 'error', error=f'Failed to start: {type(e).__name__}: {e}')
+            except Exception as e:
+                logger.error(e)
+
+def start():
+    global _dispatcher
+    task_store.fail_orphaned()
+    if _dispatcher is None:
+        _dispatcher = threading.Thread(target=_dispatch, name='evaluation-dispatcher', daemon=True)
+        _dispatcher.start()
+
+def stop():
+    with _lock:
+        for task_id, process in _processes.items():
+            task_store.request_cancel(task_id)
+            process.terminate()
+
+def _get_requester(token : str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def submit(task_id : str, project_scenario_id : int, token : str) -> str:
+    """
+    Queue scenario evaluation, or attach to the one of the scenario already waiting to start.
+    Returns id of the task evaluating the scenario. Raises queue.Full if EVALUATION_QUEUE_SIZE tasks are already waiting
+    """
+    waiting_task_id = task_store.create_task(task_id, project_scenario_id, const.EVALUATION_QUEUE_SIZE, _get_requester(token))
+    if waiting_task_id != task_id:
+        logger.info(f'{project_scenario_id} evaluation is already waiting as {waiting_task_id}')
+        return waiting_task_id
+    _queue.put((task_id, (project_scenario_id, token)))
+    return task_id
+
+def cancel(task_id : str, token : str) -> bool:
+    """
+    Drop the request of the token for waiting or running task of any API worker, cancelling the task
+    once no other request waits for it. Returns False if the task is unknown, finished or not requested with the token
+    """
+    task = task_store.request_cancel(task_id, _get_requester(token))
+    if task is None:
+        return False
+    if task['cancel_requested'] and task['pid'] is not None:
+        try:
+            os.kill(task['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    return True
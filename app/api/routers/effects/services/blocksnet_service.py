@@ -1,124 +1,251 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-import momepy
-import networkx as nx
+import shapely
 from loguru import logger
-from pyproj.crs import CRS
-from blocksnet import (AccessibilityProcessor, BlocksGenerator, City, ServiceType)
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import KDTree
+from blocksnet import (BlocksGenerator, City, ServiceType)
+from api.utils import const, disk_cache, metrics, result_store as rs
 from api.utils.const import DEFAULT_CRS
 from . import project_service as ps
 from .. import effects_models as em
 
 SPEED_M_MIN = 60 * 1000 / 60
+DIJKSTRA_CHUNK_SIZE = 256
+ACC_MX_DTYPE = np.float16
 GAP_TOLERANCE = 5
 
-def _get_geoms_by_function(function_name, physical_object_types, scenario_gdf):
-    valid_type_ids = {
-        d['physical_object_type_id']
-        for d in physical_object_types
-        if function_name in d['physical_object_function']['name']
-    }
-    return scenario_gdf[scenario_gdf['physical_objects'].apply(
-        lambda x: any(d.get('physical_object_type').get('id') in valid_type_ids for d in x))]
-
-def _get_water(scenario_gdf, physical_object_types):
-    water = _get_geoms_by_function('Водный объект', physical_object_types, scenario_gdf)
+LIVING_BUILDINGS_ID = 4
+NON_LIVING_BUILDINGS_ID = 5
+
+class ScenarioObjects(NamedTuple):
+    # scenario geometries without nested objects, indexed like the Urban API frame
+    gdf : gpd.GeoDataFrame
+    # physical_object_type_id and function of every physical object, indexed by its geometry
+    objects : pd.DataFrame
+    # service_id, service_type_id, name and capacity_real of every service, indexed by its geometry
+    services : pd.DataFrame
+
+@metrics.timed()
+def normalize_scenario(scenario_gdf : gpd.GeoDataFrame, physical_object_types : list[dict]) -> ScenarioObjects:
+    """
+    Flatten nested physical objects and services of the scenario once, so every layer of both scales
+    is selected from columnar tables by index
+    """
+    functions = {t['physical_object_type_id']: t['physical_object_function']['name'] for t in physical_object_types}
+
+    physical_objects = scenario_gdf['physical_objects'].explode().dropna()
+    objects = pd.DataFrame({
+        'physical_object_type_id': [d['physical_object_type']['id'] for d in physical_objects]
+    }, index=physical_objects.index)
+    objects['function'] = objects['physical_object_type_id'].map(functions)
+
+    services = scenario_gdf['services'].explode().dropna()
+    services = pd.DataFrame({
+        'service_id': [d['service_id'] for d in services],
+        'service_type_id': [d['service_type']['id'] for d in services],
+        'name': [d['name'] for d in services],
+        # raw values, missing capacities included
+        'capacity_real': pd.Series([d.get('capacity_real') for d in services], index=services.index, dtype=object)
+    }, index=services.index)
+
+    return ScenarioObjects(scenario_gdf[['geometry']], objects, services)
+
+def _select(scenario : ScenarioObjects, mask : pd.Series) -> gpd.GeoDataFrame:
+    return scenario.gdf[scenario.gdf.index.isin(scenario.objects.index[mask])]
+
+def _get_geoms_by_function(function_name : str, scenario : ScenarioObjects) -> gpd.GeoDataFrame:
+    return _select(scenario, scenario.objects['function'].str.contains(function_name, regex=False, na=False))
+
+def _get_geoms_by_object_type_id(scenario : ScenarioObjects, object_type_id : int) -> gpd.GeoDataFrame:
+    return _select(scenario, scenario.objects['physical_object_type_id'] == object_type_id)
+
+def _get_water(scenario : ScenarioObjects):
+    water = _get_geoms_by_function('Водный объект', scenario)
     water = water.explode(index_parts=True)
     water = water.reset_index()
     return water
 
 
-def _get_roads(scenario_gdf, physical_object_types):
-    roads = _get_geoms_by_function('Дорога', physical_object_types, scenario_gdf)
-    merged = roads.unary_union
-    if merged.geom_type == 'MultiLineString':
-        roads = gpd.GeoDataFrame(geometry=list(merged.geoms), crs=roads.crs)
-    else:
-        roads = gpd.GeoDataFrame(geometry=[merged], crs=roads.crs)
-    roads = roads.explode(index_parts=False).reset_index(drop=True)
-    roads.geometry = momepy.close_gaps(roads, GAP_TOLERANCE)
+def _node_tile(tree : shapely.STRtree, geometries : np.ndarray, tile : shapely.Polygon) -> np.ndarray:
+    candidates = geometries[tree.query(tile)]
+    # intersection keeps roads lying on the tile boundary, which clip_by_rect drops
+    return shapely.get_parts(shapely.union_all(shapely.intersection(candidates, tile)))
+
+def _node_roads(geometries : np.ndarray) -> np.ndarray:
+    """
+    Split roads at their intersections. Large networks are noded in ROADS_TILE_SIZE tiles in parallel,
+    which only adds nodes where roads cross tile edges.
+    Parts touching tile edges are noded again together, so roads along edges, which both tiles hold,
+    are split the same way as by a single union
+    """
+    if len(geometries) == 0:
+        return geometries
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geometries)
+    xs = np.arange(xmin, xmax, const.ROADS_TILE_SIZE)
+    ys = np.arange(ymin, ymax, const.ROADS_TILE_SIZE)
+    if len(xs) * len(ys) <= 1:
+        return shapely.get_parts(shapely.union_all(geometries))
+
+    tiles = shapely.box(*np.meshgrid(xs, ys), *np.meshgrid(xs + const.ROADS_TILE_SIZE, ys + const.ROADS_TILE_SIZE)).ravel()
+    tree = shapely.STRtree(geometries)
+    tiles = tiles[np.unique(tree.query(tiles)[0])]
+    # shapely releases the GIL, so threads are enough
+    with ThreadPoolExecutor(max_workers=const.ROADS_WORKERS) as executor:
+        parts = np.concatenate(list(executor.map(partial(_node_tile, tree, geometries), tiles)))
+    on_edges = np.zeros(len(parts), dtype=bool)
+    on_edges[shapely.STRtree(parts).query(shapely.boundary(tiles), predicate='intersects')[1]] = True
+    edge_parts = shapely.get_parts(shapely.union_all(parts[on_edges]))
+    return np.concatenate([parts[~on_edges], edge_parts])
+
+def _close_gaps(geometries : np.ndarray, tolerance : float) -> np.ndarray:
+    """
+    Snap roads to centroids of their endpoints lying within tolerance from each other, as momepy.close_gaps does,
+    querying spatial indexes instead of unioning buffers of every endpoint and snapping to every centroid
+    """
+    if len(geometries) == 0:
+        return geometries
+    endpoints = shapely.get_coordinates(np.concatenate([shapely.get_point(geometries, 0), shapely.get_point(geometries, -1)]))
+    points = np.unique(endpoints, axis=0)
+    pairs = shapely.STRtree(shapely.points(points)).query(shapely.points(points), predicate='dwithin', distance=tolerance)
+    adjacency = sparse.csr_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(len(points), len(points)))
+    _, labels = csgraph.connected_components(adjacency, directed=False)
+    counts = np.bincount(labels)
+    # endpoints closer than tolerance are merged into the centroid of their dissolved buffers,
+    # the others stay exactly in place, so coinciding geometries still coincide
+    centroids = shapely.points(points[np.unique(labels, return_index=True)[1]])
+    merged = np.flatnonzero(counts > 1)
+    if len(merged) > 0:
+        order = np.argsort(labels, kind='stable')
+        order = order[counts[labels[order]] > 1]
+        buffers = np.split(shapely.buffer(shapely.points(points[order]), tolerance / 2), np.cumsum(counts[merged])[:-1])
+        centroids[merged] = shapely.centroid(np.array([shapely.union_all(group) for group in buffers]))
+
+    # only centroids within tolerance can move a road
+    geometry_ids, centroid_ids = shapely.STRtree(centroids).query(geometries, predicate='dwithin', distance=tolerance)
+    snapped_ids, snap_points_ids = np.unique(geometry_ids, return_inverse=True)
+    snapped = geometries.copy()
+    snapped[snapped_ids] = shapely.snap(geometries[snapped_ids], shapely.multipoints(centroids[centroid_ids], indices=snap_points_ids), tolerance)
+    return snapped
+
+def _get_roads_key(roads_gdf : gpd.GeoDataFrame) -> str:
+    digest = hashlib.sha256()
+    digest.update(f'{roads_gdf.crs.to_wkt()}|{GAP_TOLERANCE}|{const.ROADS_TILE_SIZE}|{len(roads_gdf)}'.encode())
+    digest.update(b''.join(shapely.to_wkb(roads_gdf.geometry.values)))
+    return digest.hexdigest()
+
+def _get_roads_path(key : str) -> str:
+    return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, const.ROADS_FOLDER, f'{key}.parquet')
+
+@metrics.timed()
+def _get_roads(scenario : ScenarioObjects):
+    """
+    Noded road network with closed gaps, from the disk cache if the scale roads were prepared before
+    """
+    roads = _get_geoms_by_function('Дорога', scenario)
+    roads_path = _get_roads_path(_get_roads_key(roads))
+    if os.path.exists(roads_path):
+        disk_cache.touch(roads_path)
+        return gpd.read_parquet(roads_path)
+
+    geometries = _node_roads(roads.geometry.values)
+    geometries = geometries[shapely.get_type_id(geometries) == shapely.GeometryType.LINESTRING]
+    geometries = _close_gaps(geometries, GAP_TOLERANCE)
+    roads = gpd.GeoDataFrame(geometry=geometries, crs=roads.crs)
     roads = roads[roads.geom_type.isin(['LineString'])]
+
+    os.makedirs(os.path.dirname(roads_path), exist_ok=True)
+    rs.write_atomic(roads_path, roads.to_parquet)
+    disk_cache.evict()
     return roads
 
-def _get_geoms_by_object_type_id(scenario_gdf, object_type_id):
-    return scenario_gdf[scenario_gdf['physical_objects'].apply(lambda x: any(d.get('physical_object_type').get('id') == object_type_id for d in x))]
-
-def _get_buildings(scenario_gdf, physical_object_types):
-    LIVING_BUILDINGS_ID = 4
-    NON_LIVING_BUILDINGS_ID = 5
-    living_building = _get_geoms_by_object_type_id(scenario_gdf, LIVING_BUILDINGS_ID)
-    living_building['is_living'] = True
-    # print(living_building)
-    non_living_buildings = _get_geoms_by_object_type_id(scenario_gdf, NON_LIVING_BUILDINGS_ID)
-    non_living_buildings['is_living'] = False
-
-    buildings = gpd.GeoDataFrame( pd.concat( [living_building, non_living_buildings], ignore_index=True) )
-    # print(buildings)
-    # buildings = _get_geoms_by_function('Здание', physical_object_types, scenario_gdf)
+def _get_buildings(scenario : ScenarioObjects):
+    living_buildings = _get_geoms_by_object_type_id(scenario, LIVING_BUILDINGS_ID).assign(is_living=True)
+    non_living_buildings = _get_geoms_by_object_type_id(scenario, NON_LIVING_BUILDINGS_ID).assign(is_living=False)
+
+    buildings = gpd.GeoDataFrame(pd.concat([living_buildings, non_living_buildings], ignore_index=True), crs=scenario.gdf.crs)
     buildings['number_of_floors'] = 1
-    # buildings['is_living'] = True
     buildings['footprint_area'] = buildings.geometry.area
     buildings['build_floor_area'] = buildings['footprint_area'] * buildings['number_of_floors']
     buildings['living_area'] = buildings.geometry.area
-    buildings['population'] = 0
-    buildings['population'][buildings['is_living']] = 100
-    buildings = buildings.reset_index()
+    buildings['population'] = np.where(buildings['is_living'], 100, 0)
     buildings = buildings[buildings.geometry.type != 'Point']
     return buildings[['geometry', 'number_of_floors', 'footprint_area', 'build_floor_area', 'living_area', 'population']]
 
 
-def _get_services(scenario_gdf) -> gpd.GeoDataFrame | None:
-
-    def extract_services(row):
-        if isinstance(row['services'], list) and len(row['services']) > 0:
-            return [
-                {
-                    'service_id': service['service_id'],
-                    'service_type_id': service['service_type']['id'],
-                    'name': service['name'],
-                    'capacity_real': service['capacity_real'],
-                    'geometry': row['geometry']  # Сохраняем геометрию
-                }
-                for service in row['services']
-                if service.get('capacity_real') is not None and service['capacity_real'] > 0
-            ]
-        return []
-
-    extracted_data = []
-    for _, row in scenario_gdf.iterrows():
-        extracted_data.extend(extract_services(row))
-
-    if len(extracted_data) == 0:
-        return None
+def _get_services(scenario : ScenarioObjects) -> gpd.GeoDataFrame | None:
+    services = scenario.services[scenario.services.index.isin(scenario.gdf.index)]
+    services = services[pd.to_numeric(services['capacity_real'], errors='coerce') > 0]
+    # in order of the (clipped) geometries
+    services = services.iloc[np.argsort(scenario.gdf.index.get_indexer(services.index), kind='stable')]
 
-    services_gdf = gpd.GeoDataFrame(extracted_data, crs=scenario_gdf.crs)
+    if len(services) == 0:
+        return None
 
-    services_gdf['capacity'] = services_gdf['capacity_real']
+    services_gdf = gpd.GeoDataFrame(
+        services[['service_id', 'service_type_id', 'name']].assign(capacity=pd.to_numeric(services['capacity_real'])),
+        geometry=scenario.gdf.geometry.loc[services.index].values,
+        crs=scenario.gdf.crs
+    ).reset_index(drop=True)
     services_gdf = services_gdf[['geometry', 'service_id', 'service_type_id', 'name', 'capacity']]
 
-    services_gdf['area'] = services_gdf.geometry.area
-    services_gdf['area'] = services_gdf['area'].apply(lambda a : a if a > 1 else 1)
-    # services_gdf.loc[services_gdf.area == 0, 'area'] = 100
-    # services_gdf['area'] = services_gdf
+    services_gdf['area'] = services_gdf.geometry.area.clip(lower=1)
 
     return services_gdf
 
 
-def _roads_to_graph(roads):
-    roads.to_parquet(f'roads_{len(roads)}.parquet')
-    graph = momepy.gdf_to_nx(roads)
-    graph.graph['crs'] = CRS.to_epsg(roads.crs)
-    graph = nx.DiGraph(graph)
-    for _, _, data in graph.edges(data=True):
-        geometry = data['geometry']
-        data['time_min'] = geometry.length / SPEED_M_MIN
-        # data['weight'] = data['mm_len'] / 1000 / 1000
-        # data['length_meter'] = data['mm_len'] / 1000
-    for n, data in graph.nodes(data=True):
-        graph.nodes[n]['x'] = n[0]  # Assign X coordinate to node
-        graph.nodes[n]['y'] = n[1]
-
-    return graph
+def _get_graph_key(roads_gdf : gpd.GeoDataFrame) -> str:
+    digest = hashlib.sha256()
+    digest.update(f'{roads_gdf.crs.to_wkt()}|{SPEED_M_MIN}|{len(roads_gdf)}'.encode())
+    digest.update(b''.join(shapely.to_wkb(roads_gdf.geometry.values)))
+    return digest.hexdigest()
+
+def _get_graph_path(key : str) -> str:
+    return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, const.GRAPHS_FOLDER, f'{key}.npz')
+
+def _roads_to_graph(roads_gdf : gpd.GeoDataFrame) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    Undirected road graph as a CSR matrix of travel minutes with coordinates of its nodes.
+    Nodes are road endpoints with equal coordinates, like in a momepy primal graph
+    """
+    geometries = roads_gdf.geometry.values
+    endpoints = shapely.get_coordinates(np.concatenate([shapely.get_point(geometries, 0), shapely.get_point(geometries, -1)]))
+    nodes, node_ids = np.unique(endpoints, axis=0, return_inverse=True)
+    node_ids = node_ids.reshape(-1)
+    u, v = np.minimum(node_ids[:len(geometries)], node_ids[len(geometries):]), np.maximum(node_ids[:len(geometries)], node_ids[len(geometries):])
+    time_min = shapely.length(geometries) / SPEED_M_MIN
+    # the shortest of parallel roads, loops never shorten a path
+    edges = pd.DataFrame({'u': u, 'v': v, 'time_min': time_min})
+    edges = edges[edges['u'] != edges['v']].groupby(['u', 'v'], as_index=False)['time_min'].min()
+    graph = sparse.csr_matrix((edges['time_min'].to_numpy(), (edges['u'].to_numpy(), edges['v'].to_numpy())), shape=(len(nodes), len(nodes)))
+    return graph, nodes
+
+def _get_graph(roads_gdf : gpd.GeoDataFrame) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    Road graph from the disk cache, shared by every scenario and scale with the same roads
+    """
+    graph_path = _get_graph_path(_get_graph_key(roads_gdf))
+    if os.path.exists(graph_path):
+        disk_cache.touch(graph_path)
+        with np.load(graph_path) as data:
+            graph = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return graph, data['nodes']
+    graph, nodes = _roads_to_graph(roads_gdf)
+    os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+    def write(tmp_path : str):
+        # a file object, so numpy doesn't append .npz to the temporary path
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, data=graph.data, indices=graph.indices, indptr=graph.indptr, shape=graph.shape, nodes=nodes)
+    rs.write_atomic(graph_path, write)
+    disk_cache.evict()
+    return graph, nodes
 
 def _get_boundaries(project_info : dict, scale : em.ScaleType) -> gpd.GeoDataFrame:
     if scale == em.ScaleType.PROJECT:
@@ -129,8 +256,9 @@ def _get_boundaries(project_info : dict, scale : em.ScaleType) -> gpd.GeoDataFra
     local_crs = boundaries.estimate_utm_crs()
     return boundaries.to_crs(local_crs)
 
-def _generate_blocks(boundaries_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataFrame, scenario_gdf : gpd.GeoDataFrame, physical_object_types : dict) -> gpd.GeoDataFrame:
-    water_gdf = _get_water(scenario_gdf, physical_object_types).to_crs(boundaries_gdf.crs)
+@metrics.timed()
+def _generate_blocks(boundaries_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataFrame, scenario : ScenarioObjects) -> gpd.GeoDataFrame:
+    water_gdf = _get_water(scenario).to_crs(boundaries_gdf.crs)
 
     blocks_generator = BlocksGenerator(
         boundaries=boundaries_gdf,
@@ -141,24 +269,92 @@ def _generate_blocks(boundaries_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataF
     blocks['land_use'] = None  # TODO ЗАмнить на норм land_use?? >> здесь должен быть этап определения лендюза по тому что есть в бд
     return blocks
 
+@metrics.timed()
 def _calculate_acc_mx(blocks_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataFrame) -> pd.DataFrame:
-    accessibility_processor = AccessibilityProcessor(blocks=blocks_gdf)
-    graph = _roads_to_graph(roads_gdf)
-    accessibility_matrix = accessibility_processor.get_accessibility_matrix(graph=graph)
-    return accessibility_matrix
+    """
+    Travel minutes between blocks along the roads, from the graph nodes closest to blocks representative points,
+    as AccessibilityProcessor.get_accessibility_matrix does
+    """
+    graph, nodes = _get_graph(roads_gdf)
+    points = shapely.get_coordinates(blocks_gdf.representative_point().values)
+    _, closest_nodes = KDTree(nodes).query(points)
+    sources, source_ids = np.unique(closest_nodes, return_inverse=True)
+    # distances to every node are only kept for a chunk of sources at a time
+    distances = np.empty((len(sources), len(sources)))
+    for start in range(0, len(sources), DIJKSTRA_CHUNK_SIZE):
+        chunk = sources[start:start + DIJKSTRA_CHUNK_SIZE]
+        distances[start:start + len(chunk)] = csgraph.dijkstra(graph, directed=False, indices=chunk)[:, sources]
+    acc_mx = distances.astype(ACC_MX_DTYPE)[np.ix_(source_ids, source_ids)]
+    return pd.DataFrame(acc_mx, index=blocks_gdf.index, columns=blocks_gdf.index)
+
+def _get_acc_mx_key(blocks_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataFrame) -> str:
+    """
+    Hash of everything the matrix depends on: blocks (with their index), road network and speed
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{blocks_gdf.crs.to_wkt()}|{SPEED_M_MIN}|{len(blocks_gdf)}|{len(roads_gdf)}'.encode())
+    digest.update(pd.util.hash_array(np.asarray(blocks_gdf.index)).tobytes())
+    for geometries in [blocks_gdf.geometry.values, roads_gdf.geometry.values]:
+        digest.update(b''.join(shapely.to_wkb(geometries)))
+    return digest.hexdigest()
+
+def _get_acc_mx_path(key : str) -> str:
+    return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, const.ACC_MX_FOLDER, f'{key}.npy')
+
+def _cache_acc_mx(blocks_gdf : gpd.GeoDataFrame, roads_gdf : gpd.GeoDataFrame) -> str:
+    """
+    Key of the blocks accessibility matrix in the disk cache, calculating and caching it on a miss
+    """
+    acc_mx_key = _get_acc_mx_key(blocks_gdf, roads_gdf)
+    acc_mx_path = _get_acc_mx_path(acc_mx_key)
+    if os.path.exists(acc_mx_path):
+        logger.info('Accessibility matrix found in cache')
+        disk_cache.touch(acc_mx_path)
+        return acc_mx_key
+    acc_mx = _calculate_acc_mx(blocks_gdf, roads_gdf)
+    os.makedirs(os.path.dirname(acc_mx_path), exist_ok=True)
+    def write(tmp_path : str):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, acc_mx.to_numpy())
+    rs.write_atomic(acc_mx_path, write)
+    disk_cache.evict()
+    return acc_mx_key
+
+def _load_acc_mx(acc_mx_key : str, blocks_gdf : gpd.GeoDataFrame) -> pd.DataFrame:
+    # blocks index is part of the key, so labels are restored from the blocks
+    acc_mx_path = _get_acc_mx_path(acc_mx_key)
+    disk_cache.touch(acc_mx_path)
+    values = np.load(acc_mx_path, mmap_mode='r')
+    return pd.DataFrame(values, index=blocks_gdf.index, columns=blocks_gdf.index, copy=False)
+
+def is_acc_mx_cached(acc_mx_key : str) -> bool:
+    return os.path.exists(_get_acc_mx_path(acc_mx_key))
+
+def get_acc_mx_nbytes(blocks_gdf : gpd.GeoDataFrame) -> int:
+    return len(blocks_gdf) ** 2 * np.dtype(ACC_MX_DTYPE).itemsize
+
+def attach_acc_mx(city : City, blocks : tuple[gpd.GeoDataFrame, str]) -> City:
+    """
+    Map the cached accessibility matrix of blocks returned by fetch_blocks into the model returned by fetch_city_model
+    """
+    blocks_gdf, acc_mx_key = blocks
+    city.accessibility_matrix = _load_acc_mx(acc_mx_key, blocks_gdf)
+    return city
 
-def _update_buildings(city : City, scenario_gdf : gpd.GeoDataFrame, physical_object_types : dict) -> None:
-    buildings_gdf = _get_buildings(scenario_gdf, physical_object_types).copy().to_crs(city.crs)
+@metrics.timed()
+def _update_buildings(city : City, scenario : ScenarioObjects) -> None:
+    buildings_gdf = _get_buildings(scenario).to_crs(city.crs)
     buildings_gdf = buildings_gdf[buildings_gdf.geom_type.isin(['Polygon', 'MultiPolygon'])]
     city.update_buildings(buildings_gdf)
 
-def _update_services(city : City, service_types : list[ServiceType], scenario_gdf : gpd.GeoDataFrame) -> None:
+@metrics.timed()
+def _update_services(city : City, service_types : list[ServiceType], scenario : ScenarioObjects) -> None:
     # reset service types
     city._service_types = {}
     for st in service_types:
         city.add_service_type(st)
     # filter services and add to the model if exist
-    services_gdf = _get_services(scenario_gdf)
+    services_gdf = _get_services(scenario)
     if services_gdf is None:
         return
     services_gdf = services_gdf.to_crs(city.crs).copy()
@@ -170,38 +366,113 @@ def _update_services(city : City, service_types : list[ServiceType], scenario_gd
         if service_type is not None:
             city.update_services(service_type, gdf)
 
-def fetch_city_model(project_info: dict,
-                      scenario_gdf: gpd.GeoDataFrame,
-                      physical_object_types: dict,
-                      service_types: list,
-                      scale: em.ScaleType):
-    
+def _clip_scenario(scenario : ScenarioObjects, boundaries_gdf : gpd.GeoDataFrame) -> ScenarioObjects:
+    # clipping keeps the index, so the objects and services tables still apply
+    scenario_gdf = scenario.gdf.to_crs(boundaries_gdf.crs)
+    return scenario._replace(gdf=scenario_gdf.clip(boundaries_gdf))
+
+def fetch_layout(project_info: dict,
+                 scenario: ScenarioObjects,
+                 scale: em.ScaleType) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """
+    Blocks layer of the scale with the roads it is generated from
+    """
     # getting boundaries for our model
     boundaries_gdf = _get_boundaries(project_info, scale)
-    local_crs = boundaries_gdf.crs
 
     # clipping scenario objects
-    scenario_gdf = scenario_gdf.to_crs(local_crs)
-    scenario_gdf = scenario_gdf.clip(boundaries_gdf)
+    scenario = _clip_scenario(scenario, boundaries_gdf)
 
-    roads_gdf = _get_roads(scenario_gdf, physical_object_types)
+    roads_gdf = _get_roads(scenario)
 
     # generating blocks layer
-    blocks_gdf = _generate_blocks(boundaries_gdf, roads_gdf, scenario_gdf, physical_object_types)
+    blocks_gdf = _generate_blocks(boundaries_gdf, roads_gdf, scenario)
+
+    return blocks_gdf, roads_gdf
+
+def fetch_acc_mx(layout: tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]) -> tuple[gpd.GeoDataFrame, str]:
+    """
+    Blocks layer returned by fetch_layout with the key of its cached accessibility matrix
+    """
+    blocks_gdf, roads_gdf = layout
+    return blocks_gdf, _cache_acc_mx(blocks_gdf, roads_gdf)
+
+def fetch_blocks(project_info: dict,
+                 scenario: ScenarioObjects,
+                 scale: em.ScaleType) -> tuple[gpd.GeoDataFrame, str]:
+    """
+    Blocks layer of the scale with the key of its cached accessibility matrix
+    """
+    return fetch_acc_mx(fetch_layout(project_info, scenario, scale))
+
+def fetch_city_model(blocks: tuple[gpd.GeoDataFrame, str],
+                      project_info: dict,
+                      scenario: ScenarioObjects,
+                      service_types: list,
+                      scale: em.ScaleType):
+    """
+    City model of the scale built on blocks returned by fetch_blocks.
+    The model is returned without its accessibility matrix, so it is cheap to send between processes, see attach_acc_mx
+    """
+    blocks_gdf, acc_mx_key = blocks
 
-    # calculating accessibility matrix
-    acc_mx = _calculate_acc_mx(blocks_gdf, roads_gdf)
+    # clipping scenario objects
+    scenario = _clip_scenario(scenario, _get_boundaries(project_info, scale))
 
     # initializing city model
     city = City(
         blocks=blocks_gdf,
-        acc_mx=acc_mx,
+        acc_mx=_load_acc_mx(acc_mx_key, blocks_gdf),
     )
+    # the model keeps an in-memory copy of the mapped matrix, which updates don't need
+    city.accessibility_matrix = None
 
     # updating buildings layer
-    _update_buildings(city, scenario_gdf, physical_object_types)
+    _update_buildings(city, scenario)
 
     # updating service types
-    _update_services(city, service_types, scenario_gdf)
+    _update_services(city, service_types, scenario)
 
     return city
+
+def _hash_items(items) -> str:
+    # order independent, since the Urban API doesn't guarantee objects order
+    digest = hashlib.sha256()
+    for item_digest in sorted(hashlib.sha256(item).digest() for item in items):
+        digest.update(item_digest)
+    return digest.hexdigest()
+
+def get_scenario_fingerprints(project_info : dict,
+                              scenario : ScenarioObjects,
+                              service_types : list[ServiceType]) -> dict[str, str]:
+    """
+    Hashes of the scenario parts effects depend on:
+    roads (boundaries, roads and water that blocks are generated from), buildings and services
+    """
+    layout_gdf = pd.concat([
+        _get_geoms_by_function('Дорога', scenario),
+        _get_geoms_by_function('Водный объект', scenario)
+    ])
+    boundaries = [shapely.to_wkb(project_info[key]) for key in ['geometry', 'context']]
+
+    buildings_items = []
+    for prefix, object_type_id in [(b'living', LIVING_BUILDINGS_ID), (b'non_living', NON_LIVING_BUILDINGS_ID)]:
+        gdf = _get_geoms_by_object_type_id(scenario, object_type_id)
+        buildings_items.extend(prefix + wkb for wkb in shapely.to_wkb(gdf.geometry.values))
+
+    # raw services, since _get_services measures areas that don't matter here
+    services = scenario.services
+    services_items = [st.model_dump_json().encode() for st in service_types]
+    services_items.extend(
+        f'{service_id}|{service_type_id}|{capacity}|'.encode() + wkb
+        for service_id, service_type_id, capacity, wkb in zip(
+            services['service_id'], services['service_type_id'], services['capacity_real'],
+            shapely.to_wkb(scenario.gdf.geometry.loc[services.index].values)
+        )
+    )
+
+    return {
+        'roads': _hash_items([*boundaries, *shapely.to_wkb(layout_gdf.geometry.values)]),
+        'buildings': _hash_items(buildings_items),
+        'services': _hash_items(services_items)
+    }
@@ -1,22 +1,35 @@
+import hashlib
 import json
+import os
+import time
+from typing import Callable
 
-import requests
 import shapely
 import geopandas as gpd
-from api.utils import const
+from api.utils import const, result_store as rs, urban_api
+from api.utils.cache import TTLCache
 from loguru import logger
 from .. import effects_models as em 
 
+# keyed by (token, id) so cached metadata is only served back to the same user
+_project_info_cache = TTLCache(const.PROJECT_INFO_CACHE_TTL)
+_based_scenario_cache = TTLCache(const.PROJECT_INFO_CACHE_TTL)
+# territories are public, so their geometries are shared by every user
+_territory_cache = TTLCache(const.TERRITORIES_CACHE_TTL)
+_context_cache = TTLCache(const.TERRITORIES_CACHE_TTL)
+
 def get_scenarios_by_project_id(project_id : int, token : str) -> dict:
-  res = requests.get(const.URBAN_API + f'/api/v1/projects/{project_id}/scenarios', headers={'Authorization': f'Bearer {token}'})
-  res.raise_for_status()
-  return res.json()
+  return urban_api.get(f'/api/v1/projects/{project_id}/scenarios', token)
 
-def get_based_scenario_id(project_info, token):
-    scenarios = get_scenarios_by_project_id(project_info['project_id'], token)
+def _fetch_based_scenario_id(project_id : int, token : str) -> int:
+    scenarios = get_scenarios_by_project_id(project_id, token)
     based_scenario_id = list(filter(lambda x: x['is_based'], scenarios))[0]['scenario_id']
     return based_scenario_id
 
+def get_based_scenario_id(project_info, token):
+    project_id = project_info['project_id']
+    return _based_scenario_cache.get_or_set((token, project_id), lambda: _fetch_based_scenario_id(project_id, token))
+
 def _get_scenario_objects(
         scenario_id : int,
         token : str,
@@ -26,67 +39,97 @@ def _get_scenario_objects(
         physical_object_function_id : int | None = None, 
         urban_function_id : int | None = None
     ):
-  headers = {'Authorization': f'Bearer {token}'}
-  url = const.URBAN_API + f'/api/v1/scenarios/{scenario_id}/{"context/" if scale_type == em.ScaleType.CONTEXT else ""}geometries_with_all_objects'
-  res = requests.get(url, params={
+  path = f'/api/v1/scenarios/{scenario_id}/{"context/" if scale_type == em.ScaleType.CONTEXT else ""}geometries_with_all_objects'
+  return urban_api.get(path, token, params={
       'physical_object_type_id': physical_object_type_id,
       'service_type_id': service_type_id,
       'physical_object_function_id' : physical_object_function_id,
       'urban_function_id' : urban_function_id
-  }, headers=headers)
-  return res.json()
+  })
 
 def get_scenario_objects(scenario_id : int, token : str, *args, **kwargs) -> gpd.GeoDataFrame:
-  collections = [_get_scenario_objects(scenario_id, token, scale_type, *args, **kwargs) for scale_type in list(em.ScaleType)]
+  collections = urban_api.gather(*[
+    lambda scale_type=scale_type: _get_scenario_objects(scenario_id, token, scale_type, *args, **kwargs)
+    for scale_type in list(em.ScaleType)
+  ])
   features = [feature for collection in collections for feature in collection['features']]
   gdf = gpd.GeoDataFrame.from_features(features).set_crs(const.DEFAULT_CRS)
   return gdf.drop_duplicates(subset=['object_geometry_id'])
     
 def get_physical_object_types():
-    res = requests.get(const.URBAN_API + f'/api/v1/physical_object_types', verify=False)
-    return res.json()
+    return urban_api.get('/api/v1/physical_object_types', verify=False)
 
 def _get_scenario_by_id(scenario_id : int, token : str) -> dict:
-  res = requests.get(const.URBAN_API + f'/api/v1/scenarios/{scenario_id}', headers={'Authorization': f'Bearer {token}'})
-  res.raise_for_status()
-  return res.json()
+  return urban_api.get(f'/api/v1/scenarios/{scenario_id}', token)
 
 def _get_project_territory_by_id(project_id : int, token : str) -> dict:
-  res = requests.get(const.URBAN_API + f'/api/v1/projects/{project_id}/territory', headers={'Authorization': f'Bearer {token}'})
-  res.raise_for_status()
-  return res.json()
+  return urban_api.get(f'/api/v1/projects/{project_id}/territory', token)
 
 def _get_project_by_id(project_id : int, token : str) -> dict:
-  res = requests.get(const.URBAN_API + f'/api/v1/projects/{project_id}', headers={'Authorization': f'Bearer {token}'})
-  res.raise_for_status()
-  return res.json()
+  return urban_api.get(f'/api/v1/projects/{project_id}', token)
 
 def _get_territory_by_id(territory_id : int) -> dict:
-  res = requests.get(const.URBAN_API + f'/api/v1/territory/{territory_id}')
-  res.raise_for_status()
-  return res.json()
-
-def _get_context_geometry(territories_ids : list[int]):
-  geometries = []
-  for territory_id in territories_ids:
-    territory = _get_territory_by_id(territory_id)
-    geom_json = json.dumps(territory['geometry']) 
-    geometry = shapely.from_geojson(geom_json)
-    geometries.append(geometry)
+  return urban_api.get(f'/api/v1/territory/{territory_id}')
+
+def _get_geometry_path(name : str) -> str:
+  return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, const.TERRITORIES_FOLDER, f'{name}.wkb')
+
+def _read_geometry(name : str) -> shapely.Geometry | None:
+  geometry_path = _get_geometry_path(name)
+  try:
+    if time.time() - os.path.getmtime(geometry_path) > const.TERRITORIES_CACHE_TTL:
+      return None
+    with open(geometry_path, 'rb') as f:
+      return shapely.from_wkb(f.read())
+  except FileNotFoundError:
+    return None
+
+def _write_geometry(name : str, geometry : shapely.Geometry) -> None:
+  geometry_path = _get_geometry_path(name)
+  os.makedirs(os.path.dirname(geometry_path), exist_ok=True)
+  def write(tmp_path : str):
+    with open(tmp_path, 'wb') as f:
+      f.write(shapely.to_wkb(geometry))
+  rs.write_atomic(geometry_path, write)
+
+def _get_cached_geometry(name : str, fetch : Callable[[], shapely.Geometry]) -> shapely.Geometry:
+  geometry = _read_geometry(name)
+  if geometry is None:
+    geometry = fetch()
+    _write_geometry(name, geometry)
+  return geometry
+
+def _get_territory_geometry(territory_id : int) -> shapely.Geometry:
+  fetch = lambda: shapely.from_geojson(json.dumps(_get_territory_by_id(territory_id)['geometry']))
+  return _territory_cache.get_or_set(territory_id, lambda: _get_cached_geometry(f'territory_{territory_id}', fetch))
+
+def _union_territories(territories_ids : tuple[int, ...]) -> shapely.Geometry:
+  geometries = urban_api.gather(*[
+    lambda territory_id=territory_id: _get_territory_geometry(territory_id)
+    for territory_id in territories_ids
+  ])
   return shapely.unary_union(geometries)
 
-def get_project_info(project_scenario_id : int, token : str) -> dict:
+def _get_context_geometry(territories_ids : list[int]) -> shapely.Geometry:
   """
-  Fetch project data
+  Union of the territories, cached in memory and on disk by the territories set, which projects of a region often share.
+  Territories geometries are cached too, so other sets with them don't fetch them again
   """
+  key = tuple(sorted(set(territories_ids)))
+  name = 'context_' + hashlib.sha256(','.join(map(str, key)).encode()).hexdigest()
+  return _context_cache.get_or_set(key, lambda: _get_cached_geometry(name, lambda: _union_territories(key)))
+
+def _fetch_project_info(project_scenario_id : int, token : str) -> dict:
   scenario_info = _get_scenario_by_id(project_scenario_id, token)
   is_based = scenario_info['is_based'] # является ли сценарий базовым для проекта
   project_id = scenario_info['project']['project_id']
 
-  project_info = _get_project_by_id(project_id, token)
+  project_info, project_territory = urban_api.gather(
+    lambda: _get_project_by_id(project_id, token),
+    lambda: _get_project_territory_by_id(project_id, token)
+  )
   context_ids = project_info['properties']['context']
 
-  project_territory = _get_project_territory_by_id(project_id, token)
   region_id = project_territory['project']['region']['id']
   project_geometry = json.dumps(project_territory['geometry'])
 
@@ -96,4 +139,28 @@ def get_project_info(project_scenario_id : int, token : str) -> dict:
     'is_based': is_based,
     'geometry': shapely.from_geojson(project_geometry),
     'context': _get_context_geometry(context_ids)
-  }
\ No newline at end of file
+  }
+
+def get_project_info(project_scenario_id : int, token : str) -> dict:
+  """
+  Fetch project data, cached per token for PROJECT_INFO_CACHE_TTL seconds
+  """
+  return _project_info_cache.get_or_set((token, project_scenario_id), lambda: _fetch_project_info(project_scenario_id, token))
+
+def invalidate_project_info(project_scenario_id : int | None = None) -> None:
+  """
+  Drop cached project data of the scenario (for every token), or the whole cache with territories geometries
+  kept in memory if no scenario is given
+  """
+  if project_scenario_id is None:
+    _project_info_cache.invalidate()
+    _based_scenario_cache.invalidate()
+    _territory_cache.invalidate()
+    _context_cache.invalidate()
+    return
+  project_ids = set()
+  for key, project_info in _project_info_cache.items():
+    if key[1] == project_scenario_id:
+      project_ids.add(project_info['project_id'])
+  _project_info_cache.invalidate(lambda key: key[1] == project_scenario_id)
+  _based_scenario_cache.invalidate(lambda key: key[1] in project_ids)
@@ -1,43 +1,135 @@
+import json
+import os
+import threading
+import time
 
 import pandas as pd
-import requests
-from api.utils import const
+from api.utils import const, result_store as rs, urban_api
 from blocksnet.models import ServiceType
+from loguru import logger
+
+# (region_id, normatives_year) -> (cache file mtime, service types, service types by code)
+_cache : dict[tuple[int, int], tuple[float, list[ServiceType], dict[str, ServiceType]]] = {}
+_refreshing : set[tuple[int, int]] = set()
+_lock = threading.Lock()
 
 def _get_service_types(region_id : int) -> pd.DataFrame:
-  res = requests.get(const.URBAN_API + f'/api/v1/territory/{region_id}/service_types')
-  res.raise_for_status()
-  df = pd.DataFrame(res.json())
+  df = pd.DataFrame(urban_api.get(f'/api/v1/territory/{region_id}/service_types'))
   return df.set_index('service_type_id')
 
 def _get_normatives(region_id : int) -> pd.DataFrame:
-  res = requests.get(const.URBAN_API + f'/api/v1/territory/{region_id}/normatives', params={'year': const.NORMATIVES_YEAR})
-  res.raise_for_status()
-  df = pd.DataFrame(res.json())
+  df = pd.DataFrame(urban_api.get(f'/api/v1/territory/{region_id}/normatives', params={'year': const.NORMATIVES_YEAR}))
   df['service_type_id'] = df['service_type'].apply(lambda st : st['id'])
   return df.set_index('service_type_id')
 
-def get_bn_service_types(region_id : int) -> list[ServiceType]:
+def _fetch_bn_service_types(region_id : int) -> list[ServiceType]:
   """
   Befriend normatives and service types into BlocksNet format
   """
-  db_service_types_df = _get_service_types(region_id)
-  db_normatives_df = _get_normatives(region_id)
+  db_service_types_df, db_normatives_df = urban_api.gather(
+    lambda: _get_service_types(region_id),
+    lambda: _get_normatives(region_id)
+  )
   service_types_df = db_service_types_df.merge(db_normatives_df, left_index=True, right_index=True)
   # filter by minutes not null
   service_types_df = service_types_df[~service_types_df['time_availability_minutes'].isna()]
   # filter by capacity not null
   service_types_df = service_types_df[~service_types_df['services_capacity_per_1000_normative'].isna()]
-  
+
   service_types = []
-  for _, row in service_types_df.iterrows():
+  for row in service_types_df.to_dict('records'):
     service_type = ServiceType(
-      code=row['code'], 
-      name=row['name'], 
+      code=row['code'],
+      name=row['name'],
       accessibility=row['time_availability_minutes'],
       demand=row['services_capacity_per_1000_normative'],
       land_use = [], #TODO
       bricks = [] #TODO
     )
     service_types.append(service_type)
-  return service_types
\ No newline at end of file
+  return service_types
+
+def _get_cache_path(region_id : int) -> str:
+  return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, f'service_types_{region_id}_{const.NORMATIVES_YEAR}.json')
+
+def _write_cache(region_id : int, service_types : list[ServiceType]) -> None:
+  cache_path = _get_cache_path(region_id)
+  os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+  def write(tmp_path : str):
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump([st.model_dump(mode='json') for st in service_types], f, ensure_ascii=False)
+  rs.write_atomic(cache_path, write)
+
+def _read_cache(region_id : int) -> list[ServiceType]:
+  with open(_get_cache_path(region_id), encoding='utf-8') as f:
+    return [ServiceType.model_validate(st) for st in json.load(f)]
+
+def _refresh(region_id : int) -> None:
+  key = (region_id, const.NORMATIVES_YEAR)
+  try:
+    _write_cache(region_id, _fetch_bn_service_types(region_id))
+    logger.info(f'Service types of region {region_id} refreshed')
+  except Exception as e:
+    logger.error(f'Failed to refresh service types of region {region_id}: {e}')
+  finally:
+    with _lock:
+      _refreshing.discard(key)
+
+def _refresh_in_background(region_id : int) -> None:
+  key = (region_id, const.NORMATIVES_YEAR)
+  with _lock:
+    if key in _refreshing:
+      return
+    _refreshing.add(key)
+  threading.Thread(target=_refresh, args=(region_id,), daemon=True).start()
+
+def _get_cached(region_id : int) -> tuple[list[ServiceType], dict[str, ServiceType]]:
+  key = (region_id, const.NORMATIVES_YEAR)
+  cache_path = _get_cache_path(region_id)
+  if not os.path.exists(cache_path):
+    _write_cache(region_id, _fetch_bn_service_types(region_id))
+  mtime = os.path.getmtime(cache_path)
+  if time.time() - mtime > const.SERVICE_TYPES_CACHE_TTL:
+    # serve the stale list while a fresh one is fetched
+    _refresh_in_background(region_id)
+  with _lock:
+    cached = _cache.get(key)
+  # reload when another worker has rewritten the file
+  if cached is None or cached[0] != mtime:
+    service_types = _read_cache(region_id)
+    cached = (mtime, service_types, {st.code: st for st in service_types})
+    with _lock:
+      _cache[key] = cached
+  return cached[1], cached[2]
+
+def get_bn_service_types(region_id : int) -> list[ServiceType]:
+  """
+  Region service types in BlocksNet format, cached on disk per normatives year
+  """
+  service_types, _ = _get_cached(region_id)
+  return service_types
+
+def get_bn_service_types_index(region_id : int) -> dict[str, ServiceType]:
+  """
+  Region service types by code
+  """
+  _, service_types_index = _get_cached(region_id)
+  return service_types_index
+
+def invalidate_bn_service_types(region_id : int | None = None) -> None:
+  """
+  Drop cached service types of the region, or of every region if no region is given
+  """
+  cache_folder = os.path.join(const.DATA_PATH, const.CACHE_FOLDER)
+  with _lock:
+    for key in [key for key in _cache if region_id is None or key[0] == region_id]:
+      del _cache[key]
+  if region_id is not None:
+    cache_paths = [_get_cache_path(region_id)]
+  elif os.path.exists(cache_folder):
+    cache_paths = [os.path.join(cache_folder, f) for f in os.listdir(cache_folder) if f.startswith('service_types_')]
+  else:
+    cache_paths = []
+  for cache_path in cache_paths:
+    if os.path.exists(cache_path):
+      os.remove(cache_path)
@@ -0,0 +1,149 @@
+"""
+Mapbox Vector Tiles of effect layers, generated lazily and cached on disk by layer version.
+Tiles count against CACHE_QUOTA_MB, and empty ones are never written
+"""
+import hashlib
+import math
+import os
+import shutil
+import time
+from typing import Callable, Hashable
+
+import geopandas as gpd
+import mapbox_vector_tile
+import shapely
+from api.utils import const, disk_cache, result_store as rs
+from api.utils.cache import TTLCache
+
+WEB_MERCATOR_CRS = 3857
+WEB_MERCATOR_BOUND = 20037508.342789244
+TILE_EXTENT = 4096
+TILE_BUFFER = 64 # in tile extent units, so polygons edges don't show on tiles borders
+
+# layers projected to web mercator, shared by every tile of a viewport
+_layers = TTLCache(const.PROJECT_INFO_CACHE_TTL, max_size=const.TILE_LAYERS_CACHE_SIZE)
+# time of the last disk quota check of this process
+_evicted_at = 0.0
+
+def is_valid_tile(z : int, x : int, y : int) -> bool:
+  return z >= 0 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def get_tile_bounds(z : int, x : int, y : int) -> tuple[float, float, float, float]:
+  """
+  Web mercator bounds of the XYZ tile
+  """
+  size = 2 * WEB_MERCATOR_BOUND / 2 ** z
+  min_x = -WEB_MERCATOR_BOUND + x * size
+  max_y = WEB_MERCATOR_BOUND - y * size
+  return min_x, max_y - size, min_x + size, max_y
+
+def get_tile_features(gdf : gpd.GeoDataFrame, z : int, x : int, y : int) -> list[dict]:
+  """
+  Features of the web mercator layer clipped to the buffered tile, with every non-geometry column as a property
+  """
+  bounds = get_tile_bounds(z, x, y)
+  buffer = (bounds[2] - bounds[0]) * TILE_BUFFER / TILE_EXTENT
+  buffered_bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+  gdf = gdf.iloc[gdf.sindex.query(shapely.box(*buffered_bounds), predicate='intersects')]
+  geometries = shapely.clip_by_rect(gdf.geometry.values.to_numpy(), *buffered_bounds)
+  columns = [column for column in gdf.columns if column != gdf.geometry.name]
+  values = [gdf[column].tolist() for column in columns]
+  ids = gdf.index.tolist()
+
+  features = []
+  for i, geometry in enumerate(geometries):
+    if geometry.is_empty:
+      continue
+    # missing values are left out, since vector tiles have no null
+    properties = {
+      column : column_values[i] for column, column_values in zip(columns, values)
+      if column_values[i] is not None and not (isinstance(column_values[i], float) and math.isnan(column_values[i]))
+    }
+    feature = {'geometry': geometry, 'properties': properties}
+    if isinstance(ids[i], int):
+      feature['id'] = ids[i]
+    features.append(feature)
+  return features
+
+def _encode(features : list[dict], z : int, x : int, y : int, layer_name : str) -> bytes:
+  return mapbox_vector_tile.encode(
+    [{'name': layer_name, 'features': features}],
+    default_options={'quantize_bounds': get_tile_bounds(z, x, y), 'extents': TILE_EXTENT}
+  )
+
+def encode_tile(gdf : gpd.GeoDataFrame, z : int, x : int, y : int, layer_name : str) -> bytes:
+  """
+  Encode features of the web mercator layer within the tile, with every non-geometry column as a property
+  """
+  return _encode(get_tile_features(gdf, z, x, y), z, x, y, layer_name)
+
+def _get_tiles_folder() -> str:
+  return os.path.join(const.DATA_PATH, const.TILES_FOLDER)
+
+def _get_version_folder(tiles_key : str, layer_version : Hashable) -> str:
+  version = hashlib.sha256(repr(layer_version).encode()).hexdigest()[:16]
+  return os.path.join(_get_tiles_folder(), tiles_key, version)
+
+def _delete_old_versions(version_folder : str) -> None:
+  layer_folder, version = os.path.split(version_folder)
+  for folder in os.listdir(layer_folder):
+    if folder != version:
+      shutil.rmtree(os.path.join(layer_folder, folder), ignore_errors=True)
+
+def _evict() -> None:
+  global _evicted_at
+  # scanning every tile on every write would cost more than the write
+  if time.time() - _evicted_at < const.TILES_EVICTION_INTERVAL:
+    return
+  _evicted_at = time.time()
+  disk_cache.evict()
+
+def get_tile(tiles_key : str, layer_name : str, z : int, x : int, y : int,
+             get_layer : Callable[[], gpd.GeoDataFrame], layer_version : Hashable) -> bytes:
+  """
+  Tile of the layer cached on disk under tiles_key and layer_version, which has to change whenever the layer does.
+  The layer is built with get_layer on a miss and kept in memory by layer_version.
+  Tiles of other versions are deleted once the first tile of a new version is written
+  """
+  version_folder = _get_version_folder(tiles_key, layer_version)
+  tile_path = os.path.join(version_folder, str(z), str(x), f'{y}.mvt')
+  try:
+    with open(tile_path, 'rb') as f:
+      tile = f.read()
+    disk_cache.touch(tile_path)
+    return tile
+  except FileNotFoundError:
+    pass
+  gdf = _layers.get_or_set((tiles_key, layer_version), lambda: get_layer().to_crs(WEB_MERCATOR_CRS))
+  features = get_tile_features(gdf, z, x, y)
+  tile = _encode(features, z, x, y, layer_name)
+  # empty tiles are cheap to encode again, and any tile of the world may be requested
+  if len(features) == 0:
+    return tile
+  if not os.path.isdir(version_folder):
+    os.makedirs(version_folder, exist_ok=True)
+    _delete_old_versions(version_folder)
+  def write(tmp_path : str):
+    with open(tmp_path, 'wb') as f:
+      f.write(tile)
+  try:
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    rs.write_atomic(tile_path, write)
+  except FileNotFoundError:
+    # a newer version of the layer deleted this one meanwhile
+    return tile
+  _evict()
+  return tile
+
+def delete_tiles(scenario_id : int) -> None:
+  """
+  Drop cached tiles of layers the scenario takes part in, either as project or as based scenario
+  """
+  _layers.invalidate(lambda key : str(scenario_id) in key[0].split('_')[:2])
+  tiles_folder = _get_tiles_folder()
+  if not os.path.exists(tiles_folder):
+    return
+  for tiles_key in os.listdir(tiles_folder):
+    if str(scenario_id) in tiles_key.split('_')[:2]:
+      shutil.rmtree(os.path.join(tiles_folder, tiles_key), ignore_errors=True)
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with per-entry time to live and LRU size limit.
+
+    Concurrent misses on the same key are coalesced, so the factory passed to
+    `get_or_set` is called only once while other callers wait for its result.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: dict[Hashable, threading.Lock] = {}
+
+    def _get(self, key: Hashable) -> tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            found, value = self._get(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                return value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another caller may have filled the entry while we were waiting
+            with self._lock:
+                found, value = self._get(key)
+            if not found:
+                value = factory()
+                self.set(key, value)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+    def items(self) -> list[tuple[Hashable, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expires_at, value) in self._entries.items() if expires_at >= now]
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] | None = None) -> None:
+        """
+        Drop entries whose key matches the predicate, or every entry if no predicate is given
+        """
+        with self._lock:
+            if predicate is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
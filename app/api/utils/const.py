@@ -5,6 +5,50 @@ API_DESCRIPTION = 'API for assessing territory transformation effects'
 EVALUATION_RESPONSE_MESSAGE = 'Evaluation started'
 DEFAULT_CRS = 4326
 NORMATIVES_YEAR = 2024
+PROJECT_INFO_CACHE_TTL = int(os.environ.get('PROJECT_INFO_CACHE_TTL', 300)) # seconds
+CACHE_FOLDER = 'cache' # inside DATA_PATH
+ACC_MX_FOLDER = 'acc_mx' # accessibility matrices inside CACHE_FOLDER, keyed by blocks and roads hash
+GRAPHS_FOLDER = 'graphs' # road graphs inside CACHE_FOLDER, keyed by roads hash
+ROADS_FOLDER = 'roads' # noded roads inside CACHE_FOLDER, keyed by scale roads hash
+ROADS_TILE_SIZE = int(os.environ.get('ROADS_TILE_SIZE', 2000)) # meters, roads are noded tile by tile
+ROADS_WORKERS = int(os.environ.get('ROADS_WORKERS', 4)) # threads noding road tiles
+CACHE_QUOTA_MB = int(os.environ.get('CACHE_QUOTA_MB', 10 * 1024)) # disk budget of roads, graphs, accessibility matrices and tiles, 0 keeps everything
+CACHE_EVICTION_GRACE = int(os.environ.get('CACHE_EVICTION_GRACE', 60 * 60)) # seconds entries are kept for since their last use
+TILES_FOLDER = 'tiles' # vector tiles inside DATA_PATH
+MAX_TILE_ZOOM = int(os.environ.get('MAX_TILE_ZOOM', 18)) # tiles above it are not served
+TILES_EVICTION_INTERVAL = int(os.environ.get('TILES_EVICTION_INTERVAL', 60)) # seconds between disk quota checks after tile writes of each process
+RESULTS_MANIFESTS_FOLDER = 'manifests' # manifests of evaluated scenarios inside DATA_PATH
+RESULTS_QUOTA_MB = int(os.environ.get('RESULTS_QUOTA_MB', 20 * 1024)) # disk budget of evaluation results, least recently used scenarios are evicted beyond it, 0 keeps everything
+RESULTS_ACCESS_RESOLUTION = int(os.environ.get('RESULTS_ACCESS_RESOLUTION', 60)) # seconds between recorded reads of the same scenario results
+TERRITORIES_FOLDER = 'territories' # territories and context geometries inside CACHE_FOLDER
+TERRITORIES_CACHE_TTL = int(os.environ.get('TERRITORIES_CACHE_TTL', 24 * 60 * 60)) # seconds
+TILE_LAYERS_CACHE_SIZE = int(os.environ.get('TILE_LAYERS_CACHE_SIZE', 16)) # projected layers kept in memory for tiles
+SERVICE_TYPES_CACHE_TTL = int(os.environ.get('SERVICE_TYPES_CACHE_TTL', 24 * 60 * 60)) # seconds
+TASKS_DB_FILE = 'tasks.db' # inside DATA_PATH
+TASKS_TTL = int(os.environ.get('TASKS_TTL', 7 * 24 * 60 * 60)) # seconds to keep finished tasks
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10)) # seconds between writes of API worker metrics to the task store
+SCENARIO_LOCK_POLL_INTERVAL = float(os.environ.get('SCENARIO_LOCK_POLL_INTERVAL', 1)) # seconds
+EVALUATION_WORKERS = int(os.environ.get('EVALUATION_WORKERS', 2)) # concurrent evaluation processes of all API workers
+EVALUATION_QUEUE_SIZE = int(os.environ.get('EVALUATION_QUEUE_SIZE', 16)) # waiting evaluations of all API workers before 429
+EVALUATION_POLL_INTERVAL = float(os.environ.get('EVALUATION_POLL_INTERVAL', 1)) # seconds between checks for a free evaluation slot
+EVALUATION_START_METHOD = os.environ.get('EVALUATION_START_METHOD', 'spawn')
+EVALUATION_STAGE_WORKERS = int(os.environ.get('EVALUATION_STAGE_WORKERS', 4)) # parallel stages of one evaluation
+EVALUATION_MEMORY_LIMIT_MB = int(os.environ.get('EVALUATION_MEMORY_LIMIT_MB', 8 * 1024)) # for parallel stages of one evaluation
+PROVISION_WORKERS = int(os.environ.get('PROVISION_WORKERS', 4)) # processes sharing service types of one provision stage, at most EVALUATION_STAGE_WORKERS
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 16 * 1024)) # rows of effect results row groups
+PARQUET_SPATIAL_SORT = os.environ.get('PARQUET_SPATIAL_SORT', '1') == '1' # store effect results in hilbert curve order
+FRAME_CACHE_SIZE_MB = int(os.environ.get('FRAME_CACHE_SIZE_MB', 512)) # memory budget of result frames kept by each API worker
+GEOJSON_PRECISION = int(os.environ.get('GEOJSON_PRECISION', 6)) # decimal digits of layers coordinates, negative keeps full precision
+URBAN_API_CACHE = os.environ.get('URBAN_API_CACHE', 'record') # off, record (conditional requests, responses stored) or replay (stored responses only)
+URBAN_API_CACHE_FOLDER = 'urban_api' # recorded responses inside CACHE_FOLDER
+URBAN_API_CACHE_TTL = int(os.environ.get('URBAN_API_CACHE_TTL', 30 * 24 * 60 * 60)) # seconds recorded responses are kept since their last use
+URBAN_API_CACHE_SIZE_MB = int(os.environ.get('URBAN_API_CACHE_SIZE_MB', 1024)) # budget of recorded bodies, 0 leaves only the TTL
+URBAN_API_CACHE_EVICTION_INTERVAL = int(os.environ.get('URBAN_API_CACHE_EVICTION_INTERVAL', 60 * 60)) # seconds between eviction passes
+URBAN_API_MAX_WORKERS = int(os.environ.get('URBAN_API_MAX_WORKERS', 8))
+URBAN_API_RETRIES = int(os.environ.get('URBAN_API_RETRIES', 3))
+URBAN_API_BACKOFF_FACTOR = float(os.environ.get('URBAN_API_BACKOFF_FACTOR', 0.5))
+URBAN_API_CONNECT_TIMEOUT = float(os.environ.get('URBAN_API_CONNECT_TIMEOUT', 10)) # seconds
+URBAN_API_READ_TIMEOUT = float(os.environ.get('URBAN_API_READ_TIMEOUT', 300)) # seconds
 
 if 'DATA_PATH' in os.environ:
   DATA_PATH = os.path.abspath('data')
@@ -1,40 +1,76 @@
-import json
 from functools import wraps
+from typing import Iterator
 
 import geopandas as gpd
+import numpy as np
+import orjson
+import shapely
+from fastapi.responses import StreamingResponse
 
-# from shapely import set_precision
+from . import const, metrics
 
-PRECISION_GRID_SIZE = 0.0001
+FEATURES_CHUNK_SIZE = 1000
+
+def _set_precision(geometries : np.ndarray, digits : int) -> np.ndarray:
+    # snapping keeps geometries valid, rounding keeps snapped coordinates short once printed
+    snapped = shapely.set_precision(geometries, grid_size=10 ** -digits)
+    # sliver blocks thinner than the grid are only rounded, so they don't vanish from the layer
+    collapsed = shapely.is_empty(snapped) & ~shapely.is_empty(geometries)
+    snapped[collapsed] = geometries[collapsed]
+    return shapely.transform(snapped, lambda coords : np.round(coords, digits))
+
+def _iter_geojson(gdf : gpd.GeoDataFrame, digits : int | None) -> Iterator[bytes]:
+    geometries = gdf.geometry.values.to_numpy()
+    if digits is not None:
+        geometries = _set_precision(geometries, digits)
+    geometries = shapely.to_geojson(geometries)
+    ids = gdf.index.astype(str).tolist()
+    columns = [column for column in gdf.columns if column != gdf.geometry.name]
+    # plain python values, NaN is written as null like gdf.to_json does
+    values = [gdf[column].tolist() for column in columns]
+
+    yield b'{"type":"FeatureCollection","features":['
+    for start in range(0, len(gdf), FEATURES_CHUNK_SIZE):
+        features = []
+        for i in range(start, min(start + FEATURES_CHUNK_SIZE, len(gdf))):
+            geometry = geometries[i]
+            properties = orjson.dumps({column: column_values[i] for column, column_values in zip(columns, values)}, option=orjson.OPT_SERIALIZE_NUMPY)
+            features.append(
+                b'{"id":' + orjson.dumps(ids[i]) +
+                b',"type":"Feature","properties":' + properties +
+                b',"geometry":' + (b'null' if geometry is None else geometry.encode()) + b'}'
+            )
+        yield (b',' if start > 0 else b'') + b','.join(features)
+    yield b']}'
 
 def gdf_to_geojson(func):
     """
-    A decorator that processes a GeoDataFrame returned by an asynchronous function and converts it to GeoJSON format with specified CRS and geometry precision.
+    A decorator that processes a GeoDataFrame returned by a function and streams it as GeoJSON with specified CRS and geometry precision.
 
-    This decorator takes an asynchronous function that returns a GeoDataFrame, transforms its coordinate system to EPSG:4326, 
-    and optionally adjusts the geometry precision based on a defined grid size. The final result is a GeoJSON-compatible dictionary.
+    This decorator takes a function that returns a GeoDataFrame, transforms its coordinate system to EPSG:4326,
+    optionally reduces the geometry precision and encodes features in chunks straight from geometry and column arrays,
+    so the payload is never held as a whole string or as Python dicts.
 
     Parameters
     ----------
     func : Callable
-        An asynchronous function that returns a GeoDataFrame.
+        A function that returns a GeoDataFrame.
 
     Returns
     -------
     Callable
-        A wrapped asynchronous function that returns the GeoDataFrame as a GeoJSON-compatible dictionary.
+        A wrapped function that returns a streaming GeoJSON response.
 
     Notes
     -----
     - The decorator converts the GeoDataFrame to EPSG:4326 (WGS 84).
-    - Geometry precision is adjusted using the `set_precision` function and a grid size defined by `PRECISION_GRID_SIZE`.
-    - Commented-out code allows optional rounding for columns containing 'provision' in their name, if enabled.
-    
+    - Coordinates are snapped with `set_precision` and rounded to `GEOJSON_PRECISION` decimal digits, unless it is negative.
+
     Examples
     --------
     ```
     @gdf_to_geojson
-    async def get_geodata():
+    def get_geodata():
         # returns a GeoDataFrame
         return gdf
     ```
@@ -42,6 +78,6 @@ def gdf_to_geojson(func):
     @wraps(func)
     def process(*args, **kwargs):
         gdf = func(*args, **kwargs).to_crs(4326)
-        # gdf.geometry = set_precision(gdf.geometry, grid_size=PRECISION_GRID_SIZE)
-        return json.loads(gdf.to_json())
-    return process
\ No newline at end of file
+        digits = const.GEOJSON_PRECISION if const.GEOJSON_PRECISION >= 0 else None
+        return StreamingResponse(metrics.iter_span('geojson_encoding', _iter_geojson(gdf, digits)), media_type='application/geo+json')
+    return process
@@ -0,0 +1,59 @@
+"""
+Size cap of caches under DATA_PATH: noded roads, road graphs, accessibility matrices and vector tiles.
+
+Entries are files whose modification time is their last use. Beyond CACHE_QUOTA_MB least recently used
+entries are deleted, and a deleted entry is recomputed on its next miss. Entries used within
+CACHE_EVICTION_GRACE seconds are kept, so running evaluations don't lose the ones they rely on.
+"""
+import os
+import time
+
+from . import const
+
+def _get_folders() -> list[str]:
+    folders = [os.path.join(const.DATA_PATH, const.CACHE_FOLDER, folder) for folder in [const.ROADS_FOLDER, const.GRAPHS_FOLDER, const.ACC_MX_FOLDER]]
+    return folders + [os.path.join(const.DATA_PATH, const.TILES_FOLDER)]
+
+def touch(path : str) -> None:
+    """
+    Record use of the cache entry
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def evict() -> int:
+    """
+    Delete least recently used entries beyond CACHE_QUOTA_MB. Returns the number of deleted entries
+    """
+    if const.CACHE_QUOTA_MB <= 0:
+        return 0
+    entries = []
+    for folder in _get_folders():
+        # tiles are nested by layer, version and zoom, other caches are flat
+        for root, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                # files being written by other processes
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+    usage = sum(size for _, size, _ in entries)
+    quota = const.CACHE_QUOTA_MB * 1024 * 1024
+    used_since = time.time() - const.CACHE_EVICTION_GRACE
+    deleted = 0
+    for mtime, size, path in sorted(entries):
+        if usage <= quota or mtime >= used_since:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        usage -= size
+        deleted += 1
+    return deleted
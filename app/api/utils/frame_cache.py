@@ -0,0 +1,78 @@
+"""
+In-process LRU cache of frames read from parquet, bounded by memory and validated by file modification time.
+Cached frames are shared between requests and must not be modified in place.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from . import const, metrics
+
+# (path, mtime, size, columns, geometry) -> (frame, estimated bytes)
+_entries : OrderedDict[tuple, tuple[pd.DataFrame, int]] = OrderedDict()
+_size = 0
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_lock = threading.Lock()
+
+def _estimate_size(frame : pd.DataFrame) -> int:
+    size = int(frame.memory_usage(index=True, deep=True).sum())
+    if isinstance(frame, gpd.GeoDataFrame):
+        # geometries live outside the array, roughly 16 bytes per coordinate and a header per geometry
+        geometries = frame.geometry.values.to_numpy()
+        size += int(shapely.get_num_coordinates(geometries).sum()) * 16 + len(geometries) * 64
+    return size
+
+def _drop(key : tuple) -> None:
+    global _size
+    _, size = _entries.pop(key)
+    _size -= size
+
+def read_parquet(path : str, columns : list[str] | None = None, geometry : bool = True) -> pd.DataFrame:
+    """
+    Read parquet as GeoDataFrame (or as DataFrame if geometry is False), reusing the frame read before
+    while the file is unchanged
+    """
+    global _size
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size, None if columns is None else tuple(columns), geometry)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            _stats['hits'] += 1
+            return entry[0]
+        _stats['misses'] += 1
+
+    with metrics.span('read_parquet'):
+        frame = gpd.read_parquet(path, columns=columns) if geometry else pd.read_parquet(path, columns=columns)
+    size = _estimate_size(frame)
+    budget = const.FRAME_CACHE_SIZE_MB * 1024 * 1024
+    with _lock:
+        # frames of the previous file version are never read again
+        for stale_key in [k for k in _entries if k[0] == path and k[1:3] != key[1:3]]:
+            _drop(stale_key)
+        if size > budget or key in _entries:
+            return frame
+        _entries[key] = (frame, size)
+        _size += size
+        while _size > budget:
+            _drop(next(iter(_entries)))
+            _stats['evictions'] += 1
+    return frame
+
+def invalidate(predicate : Callable[[str], bool] | None = None) -> None:
+    """
+    Drop frames whose file path matches the predicate, or every frame if no predicate is given
+    """
+    with _lock:
+        for key in [key for key in _entries if predicate is None or predicate(key[0])]:
+            _drop(key)
+
+def get_stats() -> dict[str, int]:
+    with _lock:
+        return {**_stats, 'entries': len(_entries), 'size_bytes': _size}
@@ -0,0 +1,273 @@
+"""
+Timing and memory spans, request latency histograms and their Prometheus text exposition.
+
+A scrape reaches any of the API workers, so every worker adds what it recorded to totals in the task store,
+at most every METRICS_FLUSH_INTERVAL seconds and on every scrape, and metrics are rendered from those totals.
+Spans of evaluations run in other processes, so inside a task they are written to the task store at once,
+both per task and as running totals.
+"""
+import bisect
+import os
+import resource
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterable, Iterator
+from urllib.parse import parse_qs
+
+from loguru import logger
+from . import const, task_store
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FRAME_CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+# recorded since the last flush to the task store
+# span name -> [count, wall seconds, cpu seconds, process peak rss bytes]
+_spans : dict[str, list[float]] = {}
+# (route, scale, status) -> [bucket counts..., sum, count]
+_latencies : dict[tuple[str, str, int], list[float]] = {}
+# frame cache counters as of the last flush
+_frame_cache_flushed = dict.fromkeys(FRAME_CACHE_COUNTERS, 0)
+_flushed_at = time.monotonic()
+_lock = threading.Lock()
+_task_id : str | None = None
+
+def _clear():
+    # forked processes don't own metrics their parent recorded
+    _spans.clear()
+    _latencies.clear()
+
+os.register_at_fork(after_in_child=_clear)
+
+@contextmanager
+def task(task_id : str | None):
+    """
+    Attribute spans of the wrapped block, including processes forked inside it, to the task
+    """
+    global _task_id
+    previous_task_id = _task_id
+    _task_id = task_id
+    try:
+        yield
+    finally:
+        _task_id = previous_task_id
+
+def _get_cpu_time() -> float:
+    if _task_id is None:
+        # children of API workers are evaluation processes, which are not part of their spans
+        return time.thread_time()
+    # children are counted once waited for, e.g. forked provision workers
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+def _get_peak_rss() -> int:
+    # peak of the whole process lifetime, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _record_span(name : str, started_at : float, wall : float, cpu : float, peak_rss : int) -> None:
+    if _task_id is not None:
+        task_store.record_span(_task_id, name, started_at, wall, cpu, peak_rss)
+        return
+    with _lock:
+        span = _spans.setdefault(name, [0, 0.0, 0.0, 0])
+        span[0] += 1
+        span[1] += wall
+        span[2] += cpu
+        span[3] = max(span[3], peak_rss)
+    flush()
+
+@contextmanager
+def span(name : str):
+    """
+    Record wall time and CPU time of the wrapped block, with the process lifetime peak RSS at its end
+    """
+    started_at = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = _get_cpu_time()
+    try:
+        yield
+    finally:
+        _record_span(name, started_at, time.perf_counter() - start_wall, _get_cpu_time() - start_cpu, _get_peak_rss())
+
+def timed(name : str | None = None):
+    """
+    Decorator recording every call of the function as a span, named after the function by default
+    """
+    def decorator(func : Callable):
+        span_name = name or func.__name__.lstrip('_')
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def iter_span(name : str, iterable : Iterable) -> Iterator:
+    """
+    Record producing the items of a lazily consumed iterable as one span.
+    Only the time spent inside the iterable counts, since items may be pulled from different threads
+    """
+    started_at = time.time()
+    wall = cpu = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start_wall = time.perf_counter()
+            start_cpu = _get_cpu_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                wall += time.perf_counter() - start_wall
+                cpu += _get_cpu_time() - start_cpu
+            yield item
+    finally:
+        _record_span(name, started_at, wall, cpu, _get_peak_rss())
+
+def observe_latency(route : str, scale : str, status : int, duration : float) -> None:
+    key = (route, scale, status)
+    with _lock:
+        latency = _latencies.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        if bucket < len(LATENCY_BUCKETS):
+            latency[bucket] += 1
+        latency[-2] += duration
+        latency[-1] += 1
+    flush()
+
+def flush(force : bool = False) -> None:
+    """
+    Add metrics recorded by this process to the totals of every API worker in the task store,
+    unless the last flush was less than METRICS_FLUSH_INTERVAL seconds ago
+    """
+    global _flushed_at
+    # imported here, since frame cache reads are instrumented with spans
+    from . import frame_cache
+    with _lock:
+        if not force and time.monotonic() - _flushed_at < const.METRICS_FLUSH_INTERVAL:
+            return
+        _flushed_at = time.monotonic()
+        spans = dict(_spans)
+        latencies = dict(_latencies)
+        _spans.clear()
+        _latencies.clear()
+        stats = frame_cache.get_stats()
+        counters = {f'frame_cache_{name}': stats[name] - _frame_cache_flushed[name] for name in FRAME_CACHE_COUNTERS}
+        _frame_cache_flushed.update({name: stats[name] for name in FRAME_CACHE_COUNTERS})
+    try:
+        task_store.add_worker_metrics(spans, latencies, counters, {'frame_cache_bytes': stats['size_bytes']})
+    except sqlite3.Error as e:
+        logger.error(f'Failed to flush metrics: {e}')
+        # kept for the next flush
+        with _lock:
+            for name, span in spans.items():
+                total = _spans.setdefault(name, [0, 0.0, 0.0, 0])
+                _spans[name] = [*(a + b for a, b in zip(total[:3], span[:3])), max(total[3], span[3])]
+            for key, latency in latencies.items():
+                total = _latencies.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+                _latencies[key] = [a + b for a, b in zip(total, latency)]
+            for name in FRAME_CACHE_COUNTERS:
+                _frame_cache_flushed[name] -= counters[f'frame_cache_{name}']
+
+class LatencyMiddleware:
+    """
+    ASGI middleware observing request latency until the last body chunk is sent, so streamed layers are fully counted.
+    scale_type query values are labelled by scales (value -> label), unknown ones as "other"
+    """
+
+    def __init__(self, app, scales : dict[str, str] | None = None):
+        self.app = app
+        self.scales = scales or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_observed(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                route = scope.get('route')
+                # unmatched paths and unknown scales are left out of labels, so random requests can't blow them up
+                if route is not None:
+                    query = parse_qs(scope.get('query_string', b'').decode())
+                    scale = query.get('scale_type', [''])[0]
+                    scale = self.scales.get(scale, 'other') if scale != '' else ''
+                    observe_latency(route.path, scale, status, time.perf_counter() - start)
+
+        await self.app(scope, receive, send_observed)
+
+def _format_labels(**labels) -> str:
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+def render() -> str:
+    """
+    Metrics of every API worker and evaluation in Prometheus text format
+    """
+    flush(force=True)
+    totals = task_store.get_worker_metrics()
+    spans = {('api', total['name']): total for total in totals['spans']}
+    for total in task_store.get_span_totals():
+        spans[('evaluation', total['name'])] = total
+    counters = {total['name']: total['value'] for total in totals['counters']}
+
+    lines = [
+        '# HELP effects_span_seconds Wall time of instrumented spans',
+        '# TYPE effects_span_seconds summary'
+    ]
+    for (process, name), total in sorted(spans.items()):
+        labels = _format_labels(process=process, span=name)
+        lines.append(f'effects_span_seconds_sum{labels} {total["wall"]}')
+        lines.append(f'effects_span_seconds_count{labels} {int(total["count"])}')
+    lines += [
+        '# HELP effects_span_cpu_seconds_total CPU time of instrumented spans',
+        '# TYPE effects_span_cpu_seconds_total counter'
+    ]
+    for (process, name), total in sorted(spans.items()):
+        lines.append(f'effects_span_cpu_seconds_total{_format_labels(process=process, span=name)} {total["cpu"]}')
+    lines += [
+        '# HELP effects_span_process_peak_rss_bytes Highest lifetime peak RSS of a process at the end of the span, not the peak during the span',
+        '# TYPE effects_span_process_peak_rss_bytes gauge'
+    ]
+    for (process, name), total in sorted(spans.items()):
+        lines.append(f'effects_span_process_peak_rss_bytes{_format_labels(process=process, span=name)} {int(total["peak_rss"])}')
+
+    lines += [
+        '# HELP effects_request_duration_seconds Request latency by route and scale',
+        '# TYPE effects_request_duration_seconds histogram'
+    ]
+    for latency in totals['latencies']:
+        route, scale, status = latency['route'], latency['scale'], latency['status']
+        cumulative = 0
+        for le, count in zip(LATENCY_BUCKETS, latency['buckets']):
+            cumulative += count
+            lines.append(f'effects_request_duration_seconds_bucket{_format_labels(route=route, scale=scale, status=status, le=le)} {cumulative}')
+        labels = _format_labels(route=route, scale=scale, status=status)
+        lines.append(f'effects_request_duration_seconds_bucket{_format_labels(route=route, scale=scale, status=status, le="+Inf")} {int(latency["count"])}')
+        lines.append(f'effects_request_duration_seconds_sum{labels} {latency["sum"]}')
+        lines.append(f'effects_request_duration_seconds_count{labels} {int(latency["count"])}')
+
+    lines += [
+        '# HELP effects_frame_cache_requests_total Result frame reads by cache outcome',
+        '# TYPE effects_frame_cache_requests_total counter',
+        f'effects_frame_cache_requests_total{_format_labels(result="hit")} {int(counters.get("frame_cache_hits", 0))}',
+        f'effects_frame_cache_requests_total{_format_labels(result="miss")} {int(counters.get("frame_cache_misses", 0))}',
+        '# HELP effects_frame_cache_evictions_total Result frames evicted from the cache',
+        '# TYPE effects_frame_cache_evictions_total counter',
+        f'effects_frame_cache_evictions_total {int(counters.get("frame_cache_evictions", 0))}',
+        '# HELP effects_frame_cache_bytes Estimated size of result frames cached by each API worker',
+        '# TYPE effects_frame_cache_bytes gauge'
+    ]
+    for gauge in totals['gauges']:
+        if gauge['name'] == 'frame_cache_bytes':
+            lines.append(f'effects_frame_cache_bytes{_format_labels(pid=gauge["pid"])} {int(gauge["value"])}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,217 @@
+"""
+Persistent store of Urban API responses under DATA_PATH, shared by every process.
+
+Request entries keep the validators (ETag, Last-Modified) of the last response and the hash of its body.
+Bodies are stored once per content hash, so the same payload seen by several users or scenarios is kept once,
+and every entry referring to a body leaves a marker next to it, so unreferenced bodies are found without a scan.
+Entry modification time is its last use: entries unused for URBAN_API_CACHE_TTL seconds, and least recently used
+ones beyond URBAN_API_CACHE_SIZE_MB, are evicted while recording.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from . import const, result_store
+
+def _get_folder(*parts : str) -> str:
+    return os.path.join(const.DATA_PATH, const.CACHE_FOLDER, const.URBAN_API_CACHE_FOLDER, *parts)
+
+def _write_atomic(path : str, content : bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    def write(tmp_path : str):
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+    result_store.write_atomic(path, write)
+
+def get_key(url : str, token : str | None, params : dict | None) -> str:
+    """
+    Key of the request. Token is a part of it, so responses are only served back to the same user
+    """
+    params = {name: value for name, value in (params or {}).items() if value is not None}
+    token_hash = None if token is None else hashlib.sha256(token.encode()).hexdigest()
+    request = json.dumps([url, sorted(params.items()), token_hash], default=str)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+def _get_entry_path(key : str) -> str:
+    return _get_folder('requests', f'{key}.json')
+
+def _get_body_path(body_hash : str) -> str:
+    return _get_folder('bodies', body_hash[:2], f'{body_hash}.json')
+
+def _get_refs_folder(body_hash : str) -> str:
+    return _get_folder('refs', body_hash)
+
+def _add_ref(body_hash : str, key : str) -> None:
+    refs_folder = _get_refs_folder(body_hash)
+    os.makedirs(refs_folder, exist_ok=True)
+    open(os.path.join(refs_folder, key), 'wb').close()
+
+def _release(body_hash : str, key : str) -> None:
+    """
+    Drop reference of the entry to the body, deleting the body once nothing refers to it
+    """
+    refs_folder = _get_refs_folder(body_hash)
+    try:
+        os.remove(os.path.join(refs_folder, key))
+    except FileNotFoundError:
+        # bodies recorded before markers were kept are left to prune
+        return
+    try:
+        os.rmdir(refs_folder)
+    except OSError:
+        # other entries still refer to the body
+        return
+    try:
+        os.remove(_get_body_path(body_hash))
+    except FileNotFoundError:
+        pass
+
+def get_entry(key : str) -> dict | None:
+    """
+    Stored entry of the request with its validators, or None if it was never recorded
+    """
+    try:
+        with open(_get_entry_path(key), 'rb') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def touch(key : str) -> None:
+    """
+    Record use of the stored entry, e.g. when its body was revalidated
+    """
+    try:
+        os.utime(_get_entry_path(key))
+    except FileNotFoundError:
+        pass
+
+def has_body(entry : dict) -> bool:
+    return os.path.exists(_get_body_path(entry['body_hash']))
+
+def read_body(entry : dict) -> bytes | None:
+    """
+    Body of the stored entry, or None if it is gone
+    """
+    try:
+        with open(_get_body_path(entry['body_hash']), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def store(key : str, url : str, params : dict | None, body : bytes, etag : str | None, last_modified : str | None) -> dict:
+    """
+    Record the response of the request. Returns the new entry
+    """
+    previous_entry = get_entry(key)
+    body_hash = hashlib.sha256(body).hexdigest()
+    # referenced before written, so a concurrent release of the same body can't delete it afterwards
+    _add_ref(body_hash, key)
+    body_path = _get_body_path(body_hash)
+    if not os.path.exists(body_path):
+        _write_atomic(body_path, body)
+    entry = {
+        'url': url,
+        'params': {name: value for name, value in (params or {}).items() if value is not None},
+        'etag': etag,
+        'last_modified': last_modified,
+        'body_hash': body_hash,
+        'size': len(body)
+    }
+    _write_atomic(_get_entry_path(key), json.dumps(entry, default=str).encode())
+    if previous_entry is not None and previous_entry['body_hash'] != body_hash:
+        _release(previous_entry['body_hash'], key)
+    evict()
+    return entry
+
+def _delete_entry(key : str, entry : dict) -> None:
+    try:
+        os.remove(_get_entry_path(key))
+    except FileNotFoundError:
+        return
+    _release(entry['body_hash'], key)
+
+def evict(force : bool = False) -> int:
+    """
+    Delete entries unused for URBAN_API_CACHE_TTL seconds and least recently used ones beyond URBAN_API_CACHE_SIZE_MB,
+    at most once per URBAN_API_CACHE_EVICTION_INTERVAL seconds unless forced. Returns the number of deleted entries
+    """
+    marker_path = _get_folder('evicted_at')
+    now = time.time()
+    try:
+        if not force and now - os.path.getmtime(marker_path) < const.URBAN_API_CACHE_EVICTION_INTERVAL:
+            return 0
+    except FileNotFoundError:
+        pass
+    _write_atomic(marker_path, b'')
+
+    entries = []
+    requests_folder = _get_folder('requests')
+    if os.path.isdir(requests_folder):
+        for file_name in os.listdir(requests_folder):
+            key = file_name.removesuffix('.json')
+            entry_path = _get_entry_path(key)
+            entry = get_entry(key)
+            try:
+                entries.append((os.path.getmtime(entry_path), key, entry))
+            except FileNotFoundError:
+                continue
+    entries.sort(key=lambda item: item[0])
+    # every body counts once, however many entries refer to it
+    sizes = {entry['body_hash']: entry.get('size', 0) for _, _, entry in entries if entry is not None}
+    refs = {}
+    for _, _, entry in entries:
+        if entry is not None:
+            refs[entry['body_hash']] = refs.get(entry['body_hash'], 0) + 1
+    usage = sum(sizes.values())
+    quota = const.URBAN_API_CACHE_SIZE_MB * 1024 * 1024
+    deleted = 0
+    for used_at, key, entry in entries:
+        if entry is None:
+            continue
+        if used_at >= now - const.URBAN_API_CACHE_TTL and (quota <= 0 or usage <= quota):
+            break
+        _delete_entry(key, entry)
+        refs[entry['body_hash']] -= 1
+        if refs[entry['body_hash']] == 0:
+            usage -= sizes[entry['body_hash']]
+        deleted += 1
+    prune()
+    return deleted
+
+def prune() -> int:
+    """
+    Delete bodies and markers no entry refers to anymore, e.g. left by interrupted writes,
+    and mark references of entries recorded before markers were kept. Returns the number of deleted bodies
+    """
+    referenced = {}
+    requests_folder = _get_folder('requests')
+    if os.path.isdir(requests_folder):
+        for file_name in os.listdir(requests_folder):
+            key = file_name.removesuffix('.json')
+            entry = get_entry(key)
+            if entry is not None:
+                referenced.setdefault(entry['body_hash'], set()).add(key)
+    refs_root = _get_folder('refs')
+    if os.path.isdir(refs_root):
+        for body_hash in os.listdir(refs_root):
+            keys = referenced.get(body_hash, set())
+            refs_folder = os.path.join(refs_root, body_hash)
+            for key in os.listdir(refs_folder):
+                if key not in keys:
+                    os.remove(os.path.join(refs_folder, key))
+            if body_hash not in referenced:
+                shutil.rmtree(refs_folder, ignore_errors=True)
+    for body_hash, keys in referenced.items():
+        for key in keys:
+            if not os.path.exists(os.path.join(_get_refs_folder(body_hash), key)):
+                _add_ref(body_hash, key)
+    deleted = 0
+    bodies_folder = _get_folder('bodies')
+    for root, _, file_names in os.walk(bodies_folder):
+        for file_name in file_names:
+            if file_name.endswith('.json') and file_name.removesuffix('.json') not in referenced:
+                os.remove(os.path.join(root, file_name))
+                deleted += 1
+    return deleted
@@ -0,0 +1,139 @@
+"""
+Store of evaluation results under DATA_PATH, shared by every API worker and evaluation process.
+
+Files are written to a temporary path and renamed, so readers see either the previous or the new version.
+Every evaluated scenario has a manifest listing its files with their sizes and its based scenario,
+and the manifest modification time is the last access of the scenario. Beyond RESULTS_QUOTA_MB
+least recently used scenarios are evicted, except based scenarios other manifests still refer to.
+"""
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+from . import const
+
+# scenario id -> time of the last access recorded by this process
+_touched : dict[int, float] = {}
+
+def write_atomic(path : str, write : Callable[[str], None]) -> None:
+    """
+    Write the file with write(tmp_path) next to the target and rename it over the target
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove(tmp_path)
+        raise
+
+def remove(path : str) -> None:
+    """
+    Remove the file if it exists, another process may be removing it too
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _get_manifests_folder() -> str:
+    return os.path.join(const.DATA_PATH, const.RESULTS_MANIFESTS_FOLDER)
+
+def _get_manifest_path(scenario_id : int) -> str:
+    return os.path.join(_get_manifests_folder(), f'{scenario_id}.json')
+
+def read_manifest(scenario_id : int) -> dict | None:
+    """
+    Manifest of the scenario with its last access time, or None if the scenario has no results
+    """
+    manifest_path = _get_manifest_path(scenario_id)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['accessed_at'] = os.path.getmtime(manifest_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return manifest
+
+def write_manifest(scenario_id : int, based_scenario_id : int | None, paths : list[str], complete : bool) -> dict:
+    """
+    Record existing files of the paths as results of the scenario.
+    Incomplete manifests mark evaluations in progress, which still refer to their based scenario
+    """
+    files = {}
+    for path in paths:
+        try:
+            files[os.path.basename(path)] = os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    manifest = {
+        'scenario_id': scenario_id,
+        'based_scenario_id': based_scenario_id,
+        'complete': complete,
+        'files': files,
+        'updated_at': time.time()
+    }
+    os.makedirs(_get_manifests_folder(), exist_ok=True)
+    def write(tmp_path : str):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    write_atomic(_get_manifest_path(scenario_id), write)
+    _touched[scenario_id] = time.time()
+    return manifest
+
+def delete_manifest(scenario_id : int) -> None:
+    remove(_get_manifest_path(scenario_id))
+    _touched.pop(scenario_id, None)
+
+def touch(scenario_id : int) -> None:
+    """
+    Record access to results of the scenario, at most once per RESULTS_ACCESS_RESOLUTION seconds per process
+    """
+    now = time.time()
+    if now - _touched.get(scenario_id, 0) < const.RESULTS_ACCESS_RESOLUTION:
+        return
+    _touched[scenario_id] = now
+    try:
+        os.utime(_get_manifest_path(scenario_id))
+    except FileNotFoundError:
+        pass
+
+def get_manifests() -> dict[int, dict]:
+    manifests = {}
+    manifests_folder = _get_manifests_folder()
+    if not os.path.isdir(manifests_folder):
+        return manifests
+    for file_name in os.listdir(manifests_folder):
+        scenario_id = file_name.removesuffix('.json')
+        if not file_name.endswith('.json') or not scenario_id.isdigit():
+            continue
+        manifest = read_manifest(int(scenario_id))
+        if manifest is not None:
+            manifests[int(scenario_id)] = manifest
+    return manifests
+
+def get_size(manifest : dict) -> int:
+    return sum(manifest['files'].values())
+
+def select_evictions(quota : int, protected : set[int]) -> list[int]:
+    """
+    Least recently used scenarios to evict, so results fit into quota bytes.
+    Protected scenarios and based scenarios of the remaining ones are kept
+    """
+    manifests = get_manifests()
+    usage = sum(get_size(manifest) for manifest in manifests.values())
+    order = sorted(manifests, key=lambda scenario_id: manifests[scenario_id]['accessed_at'])
+    evictions = []
+    while usage > quota:
+        # evicting a project scenario may release its based scenario, so references are gathered every round
+        referenced = {manifest['based_scenario_id'] for scenario_id, manifest in manifests.items()
+                      if scenario_id not in evictions and manifest['based_scenario_id'] != scenario_id}
+        scenario_id = next((scenario_id for scenario_id in order
+                            if scenario_id not in evictions and scenario_id not in protected and scenario_id not in referenced), None)
+        if scenario_id is None:
+            break
+        evictions.append(scenario_id)
+        usage -= get_size(manifests[scenario_id])
+    return evictions
@@ -0,0 +1,127 @@
+"""
+Runs a DAG of independent stages in parallel forked processes.
+
+Each stage is forked once all its dependencies are done, so it inherits their results
+without pickling them, and only its own result is sent back to the parent process.
+"""
+import multiprocessing
+import multiprocessing.connection
+from typing import Any, Callable, NamedTuple
+
+from loguru import logger
+
+class Stage(NamedTuple):
+    func : Callable[..., Any]
+    # names of stages whose results are passed to func as positional arguments
+    deps : tuple[str, ...] = ()
+    # estimated peak memory in bytes, or a function of dependencies results returning it
+    memory : int | Callable[..., int] = 0
+    # processes the stage runs at once, including its own, counted against max_workers
+    workers : int = 1
+
+_stages : dict[str, Stage] = {}
+_results : dict[str, Any] = {}
+
+def _run_stage(name : str, conn : multiprocessing.connection.Connection):
+    stage = _stages[name]
+    try:
+        result = stage.func(*[_results[dep] for dep in stage.deps])
+        conn.send((True, result))
+    except Exception as e:
+        conn.send((False, f'{type(e).__name__}: {e}'))
+    finally:
+        conn.close()
+
+def _estimate_memory(stage : Stage) -> int:
+    if callable(stage.memory):
+        return stage.memory(*[_results[dep] for dep in stage.deps])
+    return stage.memory
+
+def _run_sequentially(stages : dict[str, Stage], on_start : Callable[[str], None], on_finish : Callable[[str, str | None], None]) -> dict[str, Any]:
+    results = {}
+    while len(results) < len(stages):
+        ready = [name for name, stage in stages.items() if name not in results and all(dep in results for dep in stage.deps)]
+        if len(ready) == 0:
+            raise RuntimeError('Stages dependencies contain a cycle')
+        for name in ready:
+            stage = stages[name]
+            on_start(name)
+            try:
+                results[name] = stage.func(*[results[dep] for dep in stage.deps])
+            except Exception as e:
+                on_finish(name, f'{type(e).__name__}: {e}')
+                raise
+            on_finish(name, None)
+    return results
+
+def _ignore(*args):
+    pass
+
+def run_stages(stages : dict[str, Stage], max_workers : int, memory_limit : int,
+               on_start : Callable[[str], None] | None = None, on_finish : Callable[[str, str | None], None] | None = None) -> dict[str, Any]:
+    """
+    Run stages as soon as their dependencies are done, keeping the sum of running stages workers within max_workers
+    and the sum of their memory estimates within memory_limit bytes.
+    A stage is always started when nothing else is running, even if it exceeds the limits.
+    on_start(name) and on_finish(name, error) are called in the calling process around every stage.
+    Returns results by stage name.
+    """
+    on_start = on_start or _ignore
+    on_finish = on_finish or _ignore
+    for name, stage in stages.items():
+        unknown = set(stage.deps) - set(stages)
+        if unknown:
+            raise ValueError(f'Stage {name} depends on unknown stages {unknown}')
+    if max_workers <= 1:
+        return _run_sequentially(stages, on_start, on_finish)
+
+    _stages.clear()
+    _stages.update(stages)
+    _results.clear()
+    context = multiprocessing.get_context('fork')
+    running : dict[multiprocessing.connection.Connection, tuple[str, multiprocessing.Process, int]] = {}
+    try:
+        while len(_results) < len(stages):
+            used_memory = sum(memory for _, _, memory in running.values())
+            running_names = {name for name, _, _ in running.values()}
+            used_workers = sum(stages[name].workers for name in running_names)
+            for name, stage in stages.items():
+                if name in _results or name in running_names or not all(dep in _results for dep in stage.deps):
+                    continue
+                if len(running) > 0 and used_workers + stage.workers > max_workers:
+                    continue
+                memory = _estimate_memory(stage)
+                if len(running) > 0 and used_memory + memory > memory_limit:
+                    continue
+                parent_conn, child_conn = context.Pipe(duplex=False)
+                process = context.Process(target=_run_stage, args=(name, child_conn), name=f'stage-{name}')
+                on_start(name)
+                process.start()
+                child_conn.close()
+                running[parent_conn] = (name, process, memory)
+                running_names.add(name)
+                used_workers += stage.workers
+                used_memory += memory
+            if len(running) == 0:
+                raise RuntimeError('Stages dependencies contain a cycle')
+            for conn in multiprocessing.connection.wait(list(running)):
+                name, process, _ = running.pop(conn)
+                try:
+                    ok, result = conn.recv()
+                except EOFError:
+                    ok, result = False, f'process exited with code {process.exitcode}'
+                conn.close()
+                process.join()
+                on_finish(name, None if ok else result)
+                if not ok:
+                    raise RuntimeError(f'Stage {name} failed: {result}')
+                logger.info(f'Stage {name} done')
+                _results[name] = result
+        return dict(_results)
+    finally:
+        for conn, (name, process, _) in running.items():
+            process.terminate()
+            process.join()
+            conn.close()
+        _stages.clear()
+        _results.clear()
@@ -0,0 +1,487 @@
+"""
+Durable task registry and metric totals in SQLite under DATA_PATH, shared by every API worker and evaluation process
+"""
+import json
+import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from . import const
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    scenario_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    owner_pid INTEGER NOT NULL,
+    owner_start TEXT,
+    pid INTEGER,
+    pid_start TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at);
+CREATE INDEX IF NOT EXISTS tasks_scenario_id ON tasks (scenario_id, status);
+CREATE TABLE IF NOT EXISTS task_requesters (
+    task_id TEXT NOT NULL,
+    requester TEXT NOT NULL,
+    PRIMARY KEY (task_id, requester)
+);
+CREATE TABLE IF NOT EXISTS scenario_locks (
+    scenario_id INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    pid_start TEXT,
+    task_id TEXT,
+    acquired_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_stages (
+    task_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    duration REAL,
+    error TEXT,
+    PRIMARY KEY (task_id, stage)
+);
+CREATE TABLE IF NOT EXISTS task_spans (
+    task_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    peak_rss INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_spans_task_id ON task_spans (task_id);
+CREATE TABLE IF NOT EXISTS span_totals (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    peak_rss INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS api_span_totals (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    peak_rss INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS request_latencies (
+    route TEXT NOT NULL,
+    scale TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    buckets TEXT NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (route, scale, status)
+);
+CREATE TABLE IF NOT EXISTS metric_counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS worker_gauges (
+    pid INTEGER NOT NULL,
+    pid_start TEXT,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (pid, name)
+);
+'''
+
+# columns added after the first release, so databases created before get them too
+_MIGRATIONS = {
+    'tasks': {'owner_start': 'TEXT', 'pid_start': 'TEXT'},
+    'scenario_locks': {'pid_start': 'TEXT'}
+}
+
+FINISHED_STATUSES = ('success', 'error', 'cancelled')
+
+# (pid, database path) the schema was ensured for
+_initialized : tuple[int, str] | None = None
+
+def _get_db_path() -> str:
+    return os.path.join(const.DATA_PATH, const.TASKS_DB_FILE)
+
+def _migrate(conn : sqlite3.Connection) -> None:
+    for table, columns in _MIGRATIONS.items():
+        existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        for column, column_type in columns.items():
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+@contextmanager
+def _connect():
+    global _initialized
+    db_path = _get_db_path()
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        if _initialized != (os.getpid(), db_path):
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            _migrate(conn)
+            _initialized = (os.getpid(), db_path)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _add_requester(conn : sqlite3.Connection, task_id : str, requester : str | None) -> None:
+    if requester is not None:
+        conn.execute('INSERT OR IGNORE INTO task_requesters (task_id, requester) VALUES (?, ?)', (task_id, requester))
+
+def create_task(task_id : str, scenario_id : int, max_waiting : int | None = None, requester : str | None = None) -> str:
+    """
+    Create pending task for the scenario, unless one is already waiting to start.
+    A task that has already started may have loaded the scenario before its last changes,
+    so one follow-up task is queued behind it. Returns id of the task that evaluates the scenario,
+    which records requester among the ones waiting for it.
+    Raises queue.Full if max_waiting tasks of every API worker are already waiting to start
+    """
+    purge()
+    with _connect() as conn:
+        # lock the database, so concurrent workers can't both miss the waiting task
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute(
+            "SELECT * FROM tasks WHERE scenario_id = ? AND status = 'pending' AND cancel_requested = 0 ORDER BY created_at",
+            (scenario_id,)
+        ).fetchall()
+        for row in rows:
+            # tasks of dead processes would otherwise take every later request of the scenario
+            if not _is_task_alive(row):
+                _fail_interrupted(conn, row['task_id'])
+            elif row['started_at'] is None:
+                _add_requester(conn, row['task_id'], requester)
+                return row['task_id']
+        if max_waiting is not None:
+            rows = conn.execute(
+                "SELECT owner_pid, owner_start FROM tasks WHERE status = 'pending' AND started_at IS NULL AND cancel_requested = 0"
+            ).fetchall()
+            # tasks queued by dead API workers will never start
+            if sum(_is_alive(row['owner_pid'], row['owner_start']) for row in rows) >= max_waiting:
+                raise queue.Full
+        conn.execute(
+            'INSERT INTO tasks (task_id, scenario_id, status, owner_pid, owner_start, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (task_id, scenario_id, 'pending', os.getpid(), _get_start(os.getpid()), time.time())
+        )
+        _add_requester(conn, task_id, requester)
+        return task_id
+
+def delete_task(task_id : str) -> None:
+    with _connect() as conn:
+        conn.execute('DELETE FROM task_stages WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM task_spans WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM task_requesters WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+def claim_task(task_id : str, max_running : int) -> bool | None:
+    """
+    Mark pending task as started if fewer than max_running tasks of every API worker are running.
+    Returns False if there is no free slot yet, None if the task is no longer pending
+    """
+    with _connect() as conn:
+        # lock the database, so concurrent workers can't take the same slot
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT 1 FROM tasks WHERE task_id = ? AND status = 'pending' AND cancel_requested = 0", (task_id,)).fetchone()
+        if row is None:
+            return None
+        rows = conn.execute("SELECT * FROM tasks WHERE status = 'pending' AND started_at IS NOT NULL").fetchall()
+        # tasks of dead processes don't hold slots, they are failed by fail_orphaned
+        running = sum(_is_task_alive(row) for row in rows)
+        if running >= max_running:
+            return False
+        conn.execute('UPDATE tasks SET started_at = ? WHERE task_id = ?', (time.time(), task_id))
+        return True
+
+def start_task(task_id : str, pid : int) -> bool:
+    """
+    Record the process running the claimed task. Returns False if the task is no longer pending
+    """
+    with _connect() as conn:
+        cursor = conn.execute(
+            "UPDATE tasks SET pid = ?, pid_start = ? WHERE task_id = ? AND status = 'pending' AND cancel_requested = 0",
+            (pid, _get_start(pid), task_id)
+        )
+        return cursor.rowcount > 0
+
+def finish_task(task_id : str, status : str, error : str | None = None) -> None:
+    """
+    Set final status of the task, unless it is already finished
+    """
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE tasks SET status = ?, error = ?, finished_at = ? WHERE task_id = ? AND status = 'pending'",
+            (status, error, time.time(), task_id)
+        )
+
+def request_cancel(task_id : str, requester : str | None = None) -> dict | None:
+    """
+    Flag pending task for cancellation, cancelling it at once if it has not started yet.
+    With requester, only its request is dropped, and the task is cancelled once nobody else waits for it.
+    Returns the task after the change, or None if it is unknown, finished or not requested by requester
+    """
+    with _connect() as conn:
+        # lock the database, so a request attached meanwhile isn't cancelled with the task
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT * FROM tasks WHERE task_id = ? AND status = 'pending'", (task_id,)).fetchone()
+        if row is None:
+            return None
+        task = dict(row)
+        if requester is not None:
+            cursor = conn.execute('DELETE FROM task_requesters WHERE task_id = ? AND requester = ?', (task_id, requester))
+            if cursor.rowcount == 0:
+                return None
+            if conn.execute('SELECT 1 FROM task_requesters WHERE task_id = ?', (task_id,)).fetchone() is not None:
+                return task
+        task['cancel_requested'] = 1
+        if task['started_at'] is None:
+            task['status'] = 'cancelled'
+            conn.execute(
+                "UPDATE tasks SET status = 'cancelled', cancel_requested = 1, finished_at = ? WHERE task_id = ?",
+                (time.time(), task_id)
+            )
+        else:
+            conn.execute('UPDATE tasks SET cancel_requested = 1 WHERE task_id = ?', (task_id,))
+        return task
+
+def _get_boot_id() -> str:
+    try:
+        with open('/proc/sys/kernel/random/boot_id', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+_boot_id = _get_boot_id()
+
+def _get_start(pid : int) -> str | None:
+    """
+    Boot id and start time of the process, which tell it from a later process reusing its pid,
+    since DATA_PATH outlives restarts. None if the process is gone, empty where /proc is not available
+    """
+    if not os.path.isdir('/proc/self'):
+        return ''
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8') as f:
+            stat = f.read()
+    except FileNotFoundError:
+        return None
+    # command name in parentheses may contain spaces, start time is the 22nd field
+    return f"{_boot_id}:{stat.rsplit(')', 1)[1].split()[19]}"
+
+def _is_alive(pid : int, start : str | None) -> bool:
+    # rows recorded without start time predate the restart that upgraded the store
+    if start is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return start == '' or _get_start(pid) == start
+
+def _is_task_alive(row : sqlite3.Row) -> bool:
+    # owner only watches the task once it has started its evaluation process
+    if row['pid'] is not None:
+        return _is_alive(row['pid'], row['pid_start'])
+    return _is_alive(row['owner_pid'], row['owner_start'])
+
+def _fail_interrupted(conn : sqlite3.Connection, task_id : str) -> None:
+    conn.execute(
+        "UPDATE tasks SET status = 'error', error = ?, finished_at = ? WHERE task_id = ?",
+        ('Task was interrupted', time.time(), task_id)
+    )
+
+def fail_orphaned() -> None:
+    """
+    Fail pending tasks whose API worker or evaluation process is gone, e.g. after a restart
+    """
+    with _connect() as conn:
+        rows = conn.execute("SELECT * FROM tasks WHERE status = 'pending'").fetchall()
+        for row in rows:
+            if not _is_task_alive(row):
+                _fail_interrupted(conn, row['task_id'])
+
+def _try_lock_scenario(scenario_id : int, task_id : str | None) -> bool:
+    with _connect() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT pid, pid_start FROM scenario_locks WHERE scenario_id = ?', (scenario_id,)).fetchone()
+        # lock of a dead process is taken over
+        if row is not None and row['pid'] != os.getpid() and _is_alive(row['pid'], row['pid_start']):
+            return False
+        conn.execute(
+            'INSERT OR REPLACE INTO scenario_locks (scenario_id, pid, pid_start, task_id, acquired_at) VALUES (?, ?, ?, ?, ?)',
+            (scenario_id, os.getpid(), _get_start(os.getpid()), task_id, time.time())
+        )
+        return True
+
+@contextmanager
+def scenario_lock(scenario_id : int, task_id : str | None = None):
+    """
+    Hold scenario lock shared by every process, waiting while another process evaluates the scenario
+    """
+    while not _try_lock_scenario(scenario_id, task_id):
+        time.sleep(const.SCENARIO_LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        with _connect() as conn:
+            conn.execute('DELETE FROM scenario_locks WHERE scenario_id = ? AND pid = ?', (scenario_id, os.getpid()))
+
+def get_locked_scenarios() -> set[int]:
+    """
+    Scenarios locked by live processes
+    """
+    with _connect() as conn:
+        rows = conn.execute('SELECT scenario_id, pid, pid_start FROM scenario_locks').fetchall()
+    return {row['scenario_id'] for row in rows if _is_alive(row['pid'], row['pid_start'])}
+
+def start_stage(task_id : str, stage : str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO task_stages (task_id, stage, status, started_at) VALUES (?, ?, 'pending', ?)",
+            (task_id, stage, time.time())
+        )
+
+def finish_stage(task_id : str, stage : str, error : str | None = None) -> None:
+    finished_at = time.time()
+    with _connect() as conn:
+        conn.execute(
+            'UPDATE task_stages SET status = ?, finished_at = ?, duration = ? - started_at, error = ? WHERE task_id = ? AND stage = ?',
+            ('error' if error is not None else 'success', finished_at, finished_at, error, task_id, stage)
+        )
+
+@contextmanager
+def stage(task_id : str | None, name : str):
+    """
+    Record the wrapped block as a stage of the task. Does nothing if task_id is None
+    """
+    if task_id is None:
+        yield
+        return
+    start_stage(task_id, name)
+    try:
+        yield
+    except BaseException as e:
+        finish_stage(task_id, name, error=f'{type(e).__name__}: {e}')
+        raise
+    finish_stage(task_id, name)
+
+def _add_span_total(conn : sqlite3.Connection, table : str, name : str, count : int, wall : float, cpu : float, peak_rss : int) -> None:
+    conn.execute(
+        f'''INSERT INTO {table} (name, count, wall, cpu, peak_rss) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET count = count + excluded.count, wall = wall + excluded.wall, cpu = cpu + excluded.cpu,
+        peak_rss = MAX(peak_rss, excluded.peak_rss)''',
+        (name, count, wall, cpu, peak_rss)
+    )
+
+def record_span(task_id : str, name : str, started_at : float, wall : float, cpu : float, peak_rss : int) -> None:
+    """
+    Add span of the task and count it in the span totals, which outlive purged tasks
+    """
+    with _connect() as conn:
+        conn.execute(
+            'INSERT INTO task_spans (task_id, name, started_at, wall, cpu, peak_rss) VALUES (?, ?, ?, ?, ?, ?)',
+            (task_id, name, started_at, wall, cpu, peak_rss)
+        )
+        _add_span_total(conn, 'span_totals', name, 1, wall, cpu, peak_rss)
+
+def get_span_totals() -> list[dict]:
+    with _connect() as conn:
+        rows = conn.execute('SELECT * FROM span_totals ORDER BY name').fetchall()
+    return [dict(row) for row in rows]
+
+def add_worker_metrics(spans : dict[str, list[float]], latencies : dict[tuple[str, str, int], list[float]],
+                       counters : dict[str, float], gauges : dict[str, float]) -> None:
+    """
+    Add metrics an API worker recorded since its last call to the totals of every API worker:
+    spans (name -> [count, wall, cpu, peak_rss]), latencies ((route, scale, status) -> [bucket counts..., sum, count])
+    and counters (name -> increment). Gauges (name -> value) are kept per worker
+    """
+    with _connect() as conn:
+        # lock the database, so concurrent workers don't lose each other's latency buckets
+        conn.execute('BEGIN IMMEDIATE')
+        for name, (count, wall, cpu, peak_rss) in spans.items():
+            _add_span_total(conn, 'api_span_totals', name, count, wall, cpu, peak_rss)
+        for (route, scale, status), latency in latencies.items():
+            row = conn.execute(
+                'SELECT buckets, sum, count FROM request_latencies WHERE route = ? AND scale = ? AND status = ?',
+                (route, scale, status)
+            ).fetchone()
+            buckets = latency[:-2]
+            if row is not None:
+                buckets = [count + total for count, total in zip(buckets, json.loads(row['buckets']))]
+            conn.execute(
+                'INSERT OR REPLACE INTO request_latencies (route, scale, status, buckets, sum, count) VALUES (?, ?, ?, ?, ?, ?)',
+                (route, scale, status, json.dumps(buckets), latency[-2] + (row['sum'] if row else 0), latency[-1] + (row['count'] if row else 0))
+            )
+        for name, value in counters.items():
+            conn.execute(
+                'INSERT INTO metric_counters (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                (name, value)
+            )
+        for name, value in gauges.items():
+            conn.execute(
+                'INSERT OR REPLACE INTO worker_gauges (pid, pid_start, name, value) VALUES (?, ?, ?, ?)',
+                (os.getpid(), _get_start(os.getpid()), name, value)
+            )
+
+def get_worker_metrics() -> dict[str, list[dict]]:
+    """
+    Totals of every API worker, with gauges of the live ones
+    """
+    with _connect() as conn:
+        spans = conn.execute('SELECT * FROM api_span_totals ORDER BY name').fetchall()
+        latencies = conn.execute('SELECT * FROM request_latencies ORDER BY route, scale, status').fetchall()
+        counters = conn.execute('SELECT * FROM metric_counters ORDER BY name').fetchall()
+        gauges = conn.execute('SELECT * FROM worker_gauges ORDER BY name, pid').fetchall()
+        dead = {(row['pid'], row['pid_start']) for row in gauges if not _is_alive(row['pid'], row['pid_start'])}
+        for pid, pid_start in dead:
+            conn.execute('DELETE FROM worker_gauges WHERE pid = ? AND pid_start IS ?', (pid, pid_start))
+    return {
+        'spans': [dict(row) for row in spans],
+        'latencies': [{**dict(row), 'buckets': json.loads(row['buckets'])} for row in latencies],
+        'counters': [dict(row) for row in counters],
+        'gauges': [dict(row) for row in gauges if (row['pid'], row['pid_start']) not in dead]
+    }
+
+def get_task(task_id : str) -> dict | None:
+    """
+    Task with its stages and spans ordered by start time
+    """
+    with _connect() as conn:
+        row = conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        stages = conn.execute('SELECT * FROM task_stages WHERE task_id = ? ORDER BY started_at', (task_id,)).fetchall()
+        spans = conn.execute('SELECT * FROM task_spans WHERE task_id = ? ORDER BY started_at', (task_id,)).fetchall()
+    task = dict(row)
+    task['stages'] = [{key: stage[key] for key in stage.keys() if key != 'task_id'} for stage in stages]
+    task['spans'] = [{key: span[key] for key in span.keys() if key != 'task_id'} for span in spans]
+    return task
+
+def get_tasks(offset : int = 0, limit : int = 100) -> list[dict]:
+    """
+    Tasks page, newest first
+    """
+    with _connect() as conn:
+        rows = conn.execute('SELECT * FROM tasks ORDER BY created_at DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+    return [dict(row) for row in rows]
+
+def purge(ttl : float | None = None) -> None:
+    """
+    Delete tasks finished more than ttl seconds ago (TASKS_TTL by default)
+    """
+    expired_at = time.time() - (const.TASKS_TTL if ttl is None else ttl)
+    expired = f'SELECT task_id FROM tasks WHERE status IN {FINISHED_STATUSES} AND finished_at < ?'
+    with _connect() as conn:
+        conn.execute(f'DELETE FROM task_stages WHERE task_id IN ({expired})', (expired_at,))
+        conn.execute(f'DELETE FROM task_spans WHERE task_id IN ({expired})', (expired_at,))
+        conn.execute(f'DELETE FROM task_requesters WHERE task_id IN ({expired})', (expired_at,))
+        conn.execute(f'DELETE FROM tasks WHERE task_id IN ({expired})', (expired_at,))
@@ -0,0 +1,122 @@
+"""
+Shared Urban API client with pooled connections, retries and concurrent fan-out
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import const, metrics, response_cache
+
+_WORKER_PREFIX = 'urban-api'
+
+# session and pool are created lazily per process, since neither survives a fork
+_pid : int | None = None
+_session : requests.Session | None = None
+_executor : ThreadPoolExecutor | None = None
+_lock = threading.Lock()
+
+def _create_session() -> requests.Session:
+    retry = Retry(
+        total=const.URBAN_API_RETRIES,
+        backoff_factor=const.URBAN_API_BACKOFF_FACTOR,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=['GET'],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=const.URBAN_API_MAX_WORKERS,
+        pool_maxsize=const.URBAN_API_MAX_WORKERS * 2,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _init() -> None:
+    global _pid, _session, _executor
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid != os.getpid():
+            _session = _create_session()
+            _executor = ThreadPoolExecutor(max_workers=const.URBAN_API_MAX_WORKERS, thread_name_prefix=_WORKER_PREFIX)
+            _pid = os.getpid()
+
+def get_session() -> requests.Session:
+    _init()
+    return _session
+
+def _request(url : str, token : str | None, params : dict | None, verify : bool, headers : dict[str, str]) -> requests.Response:
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+    return get_session().get(
+        url,
+        params=params,
+        headers=headers,
+        verify=verify,
+        timeout=(const.URBAN_API_CONNECT_TIMEOUT, const.URBAN_API_READ_TIMEOUT)
+    )
+
+def _get_response(path : str, token : str | None, params : dict | None, verify : bool) -> bytes:
+    url = const.URBAN_API + path
+    if const.URBAN_API_CACHE == 'off':
+        res = _request(url, token, params, verify, {})
+        res.raise_for_status()
+        return res.content
+
+    key = response_cache.get_key(url, token, params)
+    entry = response_cache.get_entry(key)
+    if const.URBAN_API_CACHE == 'replay':
+        body = None if entry is None else response_cache.read_body(entry)
+        if body is None:
+            raise RuntimeError(f'No recorded Urban API response for {path}')
+        return body
+
+    # bodies may be large, so the stored one is only read once the server answers it is unchanged
+    headers = {}
+    if entry is not None and response_cache.has_body(entry):
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+    res = _request(url, token, params, verify, headers)
+    if res.status_code == 304:
+        body = None if entry is None else response_cache.read_body(entry)
+        if body is not None:
+            response_cache.touch(key)
+            return body
+        # body was evicted since the request was sent
+        res = _request(url, token, params, verify, {})
+    res.raise_for_status()
+    response_cache.store(key, url, params, res.content, res.headers.get('ETag'), res.headers.get('Last-Modified'))
+    return res.content
+
+def get(path : str, token : str | None = None, params : dict | None = None, verify : bool = True) -> Any:
+    """
+    GET Urban API json by relative path, raising on unsuccessful status.
+    Depending on URBAN_API_CACHE, responses are revalidated against the recorded ones or replayed without requests
+    """
+    with metrics.span('urban_api'):
+        return orjson.loads(_get_response(path, token, params, verify))
+
+def gather(*calls : Callable[[], Any]) -> list[Any]:
+    """
+    Run independent calls concurrently on the shared bounded pool and return their results in order.
+    Fan-outs nested inside a pooled call get their own short-lived pool, so they never wait on busy shared workers.
+    """
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    if threading.current_thread().name.startswith(_WORKER_PREFIX):
+        max_workers = min(len(calls), const.URBAN_API_MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{_WORKER_PREFIX}-nested') as executor:
+            futures = [executor.submit(call) for call in calls]
+            return [future.result() for future in futures]
+    _init()
+    futures = [_executor.submit(call) for call in calls]
+    return [future.result() for future in futures]
@@ -1,11 +1,12 @@
 from contextlib import asynccontextmanager
 
-from api.routers.effects import effects_controller
+from api.routers.effects import effects_controller, effects_models as em
+from api.utils import metrics, task_store
 from api.utils.const import API_DESCRIPTION, API_TITLE
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 
 controllers = [effects_controller]
 
@@ -14,7 +15,8 @@ async def on_startup():
         c.on_startup()
 
 async def on_shutdown():
-    ...
+    for c in controllers:
+        c.on_shutdown()
 
 @asynccontextmanager
 async def lifespan(router : FastAPI):
@@ -37,18 +39,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.add_middleware(GZipMiddleware, minimum_size=100)
+app.add_middleware(metrics.LatencyMiddleware, scales={scale.value: scale.name for scale in em.ScaleType})
 
 @app.get("/", include_in_schema=False)
 async def read_root():
     return RedirectResponse('/docs')
 
+def _get_task(task_id : str) -> dict:
+    task = task_store.get_task(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail='Task not found')
+    return task
+
 @app.get('/tasks', tags=['Tasks'])
-def get_tasks() -> dict[str,str]:
-    return effects_controller.tasks
+def get_tasks(page : int = Query(1, ge=1), page_size : int = Query(100, ge=1, le=1000)) -> dict[str,str]:
+    tasks = task_store.get_tasks(offset=(page - 1) * page_size, limit=page_size)
+    return {task['task_id']: task['status'] for task in tasks}
 
 @app.get('/task_status', tags=['Tasks'])
 def get_task_status(task_id : str) -> str:
-    return effects_controller.tasks[task_id]
+    return _get_task(task_id)['status']
+
+@app.get('/task_info', tags=['Tasks'])
+def get_task_info(task_id : str) -> dict:
+    return _get_task(task_id)
+
+@app.get('/metrics', include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
 
 for controller in controllers:
     app.include_router(controller.router)
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+Times scenario fetching, city model stages, effects evaluation and read endpoints on synthetic cities
+of several sizes, served by a local Urban API stand-in. Results are written as JSON, so runs can be compared.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run --sizes S M --output bench.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import wraps
+from uuid import uuid4
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, 'app'))
+# the app refuses to start without these, real values are set per city below
+os.environ.setdefault('DATA_PATH', 'data')
+os.environ.setdefault('URBAN_API', 'http://127.0.0.1')
+
+from . import synthetic, urban_api_stub
+
+TOKEN = 'benchmark'
+# bs functions timed inside fetch_blocks and fetch_city_model
+CITY_MODEL_STAGES = ['_get_boundaries', '_clip_scenario', '_get_roads', '_generate_blocks', '_calculate_acc_mx',
+                     '_cache_acc_mx', '_load_acc_mx', '_update_buildings', '_update_services']
+
+def _timed(func, timings : dict[str, float]):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[func.__name__] = timings.get(func.__name__, 0) + time.perf_counter() - start
+    return wrapper
+
+def _measure(func, repeat : int) -> dict[str, float]:
+    durations = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {'cold': durations[0], 'warm_median': statistics.median(durations[1:]) if repeat > 0 else None}
+
+def _reset_caches(data_path : str):
+    from api.utils import const, frame_cache
+    from api.routers.effects.services import project_service as ps, service_type_service as sts
+    const.DATA_PATH = data_path
+    os.makedirs(data_path, exist_ok=True)
+    ps.invalidate_project_info()
+    sts.invalidate_bn_service_types()
+    frame_cache.invalidate()
+
+def _bench_city_model(project_info : dict) -> dict:
+    from api.routers.effects import effects_models as em
+    from api.routers.effects.services import blocksnet_service as bs, project_service as ps, service_type_service as sts
+    from api.utils import urban_api
+
+    start = time.perf_counter()
+    service_types, physical_object_types, scenario_gdf = urban_api.gather(
+        lambda: sts.get_bn_service_types(project_info['region_id']),
+        ps.get_physical_object_types,
+        lambda: ps.get_scenario_objects(urban_api_stub.PROJECT_SCENARIO_ID, TOKEN)
+    )
+    result = {'urban_api': time.perf_counter() - start, 'scenario_objects': len(scenario_gdf), 'scales': {}}
+    start = time.perf_counter()
+    scenario = bs.normalize_scenario(scenario_gdf, physical_object_types)
+    result['normalize'] = time.perf_counter() - start
+
+    originals = {name: getattr(bs, name) for name in CITY_MODEL_STAGES}
+    try:
+        for scale_type in list(em.ScaleType):
+            timings = {}
+            for name, func in originals.items():
+                setattr(bs, name, _timed(func, timings))
+            start = time.perf_counter()
+            blocks = bs.fetch_blocks(project_info, scenario, scale_type)
+            city = bs.fetch_city_model(blocks, project_info, scenario, service_types, scale_type)
+            result['scales'][scale_type.name] = {
+                'total': time.perf_counter() - start,
+                'blocks': len(blocks[0]),
+                'stages': timings
+            }
+            del city
+    finally:
+        for name, func in originals.items():
+            setattr(bs, name, func)
+    return result
+
+def _bench_evaluation() -> dict:
+    from api.routers.effects import effects_service as es
+    from api.utils import task_store
+
+    result = {}
+    for name in ['cold', 'unchanged']:
+        task_id = task_store.create_task(str(uuid4()), urban_api_stub.PROJECT_SCENARIO_ID)
+        start = time.perf_counter()
+        es.evaluate_effects(urban_api_stub.PROJECT_SCENARIO_ID, TOKEN, task_id=task_id)
+        total = time.perf_counter() - start
+        task_store.finish_task(task_id, 'success')
+        stages = {stage['stage']: stage['duration'] for stage in task_store.get_task(task_id)['stages']}
+        result[name] = {'total': total, 'stages': stages}
+    return result
+
+def _get_tile(lon : float, lat : float, z : int) -> tuple[int, int]:
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+def _bench_reads(repeat : int) -> dict:
+    from api.routers.effects import effects_models as em, effects_service as es
+    from api.routers.effects.services import tile_service as ts
+    from api.utils import decorators
+
+    scenario_id = urban_api_stub.PROJECT_SCENARIO_ID
+    # tile over the first grid cells
+    z = 14
+    tile_x, tile_y = _get_tile(synthetic.ORIGIN[0] + synthetic.CELL_SIZE, synthetic.ORIGIN[1] + synthetic.CELL_SIZE, z)
+
+    def encode(get_layer):
+        return lambda: b''.join(decorators._iter_geojson(get_layer().to_crs(4326), 6))
+
+    result = {}
+    for scale_type in list(em.ScaleType):
+        reads = {
+            'transport_layer': encode(lambda: es.get_transport_layer(scenario_id, scale_type, TOKEN)),
+            'transport_data': lambda: es.get_transport_data(scenario_id, scale_type, TOKEN),
+            'connectivity_layer': encode(lambda: es.get_connectivity_layer(scenario_id, scale_type, TOKEN)),
+            'connectivity_data': lambda: es.get_connectivity_data(scenario_id, scale_type, TOKEN),
+            'provision_layer': encode(lambda: es.get_provision_layer(scenario_id, scale_type, 1, TOKEN)),
+            'provision_data': lambda: es.get_provision_data(scenario_id, scale_type, TOKEN),
+            'provision_tile': lambda: es.get_layer_tile(em.LayerType.PROVISION, scenario_id, scale_type, z, tile_x, tile_y, TOKEN, 1),
+        }
+        result[scale_type.name] = {name: _measure(read, repeat) for name, read in reads.items()}
+        # tiles are cached on disk, so the cold read is the only one generating the tile
+        ts.delete_tiles(scenario_id)
+    return result
+
+def _get_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_PATH, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_size(size : str, service_types_count : int, repeat : int, seed : int) -> dict:
+    from api.routers.effects.services import project_service as ps
+    from api.utils import const
+
+    cells = synthetic.SIZES[size]
+    base_city = synthetic.make_city(cells, service_types_count, seed)
+    project_city = synthetic.make_city(cells, service_types_count, seed, extra_buildings=cells)
+    server, url = urban_api_stub.serve(base_city, project_city, service_types_count)
+    const.URBAN_API = url
+    data_path = tempfile.mkdtemp(prefix=f'effects-benchmark-{size}-')
+    try:
+        result = {'cells': cells, 'service_types': service_types_count}
+        # separate data folders, so the evaluation doesn't reuse matrices cached by the city model run
+        _reset_caches(os.path.join(data_path, 'city_model'))
+        project_info = ps.get_project_info(urban_api_stub.PROJECT_SCENARIO_ID, TOKEN)
+        result['city_model'] = _bench_city_model(project_info)
+        _reset_caches(os.path.join(data_path, 'evaluation'))
+        result['evaluate_effects'] = _bench_evaluation()
+        result['reads'] = _bench_reads(repeat)
+        return result
+    finally:
+        server.shutdown()
+        shutil.rmtree(data_path, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=list(synthetic.SIZES), default=['S', 'M'])
+    parser.add_argument('--service-types', type=int, default=10, help='service types of the region')
+    parser.add_argument('--repeat', type=int, default=5, help='warm reads per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file, printed to stdout if omitted')
+    args = parser.parse_args()
+
+    from loguru import logger
+    # imported first, since BlocksNet dependencies reconfigure logging on import
+    from api.routers.effects import effects_service
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    report = {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'commit': _get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'sizes': {}
+    }
+    for size in args.sizes:
+        print(f'Benchmarking {size}', file=sys.stderr)
+        report['sizes'][size] = run_size(size, args.service_types, args.repeat, args.seed)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+if __name__ == '__main__':
+    main()
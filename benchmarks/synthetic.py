@@ -0,0 +1,107 @@
+"""
+Synthetic cities in the Urban API GeoJSON format: a road grid with water, buildings and services in every cell
+"""
+import json
+import random
+
+import shapely
+
+ROAD_TYPE_ID = 1
+WATER_TYPE_ID = 2
+LIVING_BUILDING_TYPE_ID = 4
+NON_LIVING_BUILDING_TYPE_ID = 5
+
+PHYSICAL_OBJECT_TYPES = [
+    {'physical_object_type_id': ROAD_TYPE_ID, 'physical_object_function': {'name': 'Дорога'}},
+    {'physical_object_type_id': WATER_TYPE_ID, 'physical_object_function': {'name': 'Водный объект'}},
+    {'physical_object_type_id': LIVING_BUILDING_TYPE_ID, 'physical_object_function': {'name': 'Здание'}},
+    {'physical_object_type_id': NON_LIVING_BUILDING_TYPE_ID, 'physical_object_function': {'name': 'Здание'}},
+]
+
+# grid cells per side
+SIZES = {
+    'S': 6,
+    'M': 12,
+    'L': 24,
+    'XL': 48
+}
+
+ORIGIN = (30.0, 59.0)
+CELL_SIZE = 0.0045 # degrees, about 250 x 500 m at this latitude
+BUILDINGS_PER_CELL = 3
+SERVICE_PROBABILITY = 0.3
+LIVING_PROBABILITY = 0.7
+
+class _Collection:
+
+    def __init__(self):
+        self.features = []
+
+    def add(self, geometry : shapely.Geometry, type_id : int, services : list[dict] | None = None) -> int:
+        object_geometry_id = len(self.features) + 1
+        self.features.append({
+            'type': 'Feature',
+            'geometry': json.loads(shapely.to_geojson(geometry)),
+            'properties': {
+                'object_geometry_id': object_geometry_id,
+                'physical_objects': [{'physical_object_type': {'id': type_id}}],
+                'services': services or []
+            }
+        })
+        return object_geometry_id
+
+def get_service_types(service_types_count : int) -> tuple[list[dict], list[dict]]:
+    """
+    Region service types and normatives as returned by the Urban API
+    """
+    service_types = [{'service_type_id': i, 'code': str(i), 'name': f'service_type_{i}'} for i in range(1, service_types_count + 1)]
+    normatives = [
+        {'service_type': {'id': i}, 'time_availability_minutes': 5 * (1 + i % 6), 'services_capacity_per_1000_normative': 10 + 10 * (i % 5)}
+        for i in range(1, service_types_count + 1)
+    ]
+    return service_types, normatives
+
+def make_city(cells : int, service_types_count : int = 10, seed : int = 0, extra_buildings : int = 0) -> dict:
+    """
+    Scenario objects of a cells x cells grid city, with extra_buildings added at random cells.
+    Returns the objects collection with project and context territories geometries
+    """
+    rng = random.Random(seed)
+    collection = _Collection()
+    x0, y0 = ORIGIN
+    size = cells * CELL_SIZE
+
+    for i in range(cells + 1):
+        collection.add(shapely.LineString([(x0 + i * CELL_SIZE, y0 - CELL_SIZE), (x0 + i * CELL_SIZE, y0 + size + CELL_SIZE)]), ROAD_TYPE_ID)
+        collection.add(shapely.LineString([(x0 - CELL_SIZE, y0 + i * CELL_SIZE), (x0 + size + CELL_SIZE, y0 + i * CELL_SIZE)]), ROAD_TYPE_ID)
+
+    # a lake in every tenth cell
+    for i in range(0, cells * cells, 10):
+        cx, cy = x0 + (i % cells) * CELL_SIZE, y0 + (i // cells) * CELL_SIZE
+        collection.add(shapely.box(cx + 0.2 * CELL_SIZE, cy + 0.1 * CELL_SIZE, cx + 0.6 * CELL_SIZE, cy + 0.4 * CELL_SIZE), WATER_TYPE_ID)
+
+    def add_building(bx : float, by : float, width : float):
+        services = []
+        if rng.random() < SERVICE_PROBABILITY:
+            services = [{
+                'service_id': len(collection.features) + 1,
+                'service_type': {'id': rng.randint(1, service_types_count)},
+                'name': 'service',
+                'capacity_real': rng.randint(50, 500)
+            }]
+        type_id = LIVING_BUILDING_TYPE_ID if rng.random() < LIVING_PROBABILITY else NON_LIVING_BUILDING_TYPE_ID
+        collection.add(shapely.box(bx, by, bx + width, by + width), type_id, services)
+
+    for i in range(cells):
+        for j in range(cells):
+            for k in range(BUILDINGS_PER_CELL):
+                add_building(x0 + (i + 0.1 + k * 0.3) * CELL_SIZE, y0 + (j + 0.6) * CELL_SIZE, 0.2 * CELL_SIZE)
+    for _ in range(extra_buildings):
+        i, j = rng.randrange(cells), rng.randrange(cells)
+        add_building(x0 + (i + 0.45) * CELL_SIZE, y0 + (j + 0.45) * CELL_SIZE, 0.1 * CELL_SIZE)
+
+    return {
+        'objects': {'type': 'FeatureCollection', 'features': collection.features},
+        'project_geometry': shapely.box(x0 + CELL_SIZE, y0 + CELL_SIZE, x0 + size - CELL_SIZE, y0 + size - CELL_SIZE),
+        'context_geometry': shapely.box(x0, y0, x0 + size, y0 + size)
+    }
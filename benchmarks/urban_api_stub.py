@@ -0,0 +1,86 @@
+"""
+Local stand-in for the Urban API endpoints used by project_service and service_type_service
+"""
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import shapely
+
+from .synthetic import PHYSICAL_OBJECT_TYPES, get_service_types
+
+REGION_ID = 1
+CONTEXT_TERRITORY_ID = 2
+PROJECT_ID = 1
+BASED_SCENARIO_ID = 1
+PROJECT_SCENARIO_ID = 2
+
+def _get_routes(base_city : dict, project_city : dict, service_types_count : int) -> list[tuple[re.Pattern, object]]:
+    service_types, normatives = get_service_types(service_types_count)
+    scenarios_objects = {BASED_SCENARIO_ID: base_city['objects'], PROJECT_SCENARIO_ID: project_city['objects']}
+    routes = {
+        r'/api/v1/scenarios/(\d+)(/context)?/geometries_with_all_objects': lambda scenario_id, _: scenarios_objects[int(scenario_id)],
+        r'/api/v1/scenarios/(\d+)': lambda scenario_id: {
+            'is_based': int(scenario_id) == BASED_SCENARIO_ID,
+            'project': {'project_id': PROJECT_ID}
+        },
+        rf'/api/v1/projects/{PROJECT_ID}/scenarios': lambda: [
+            {'scenario_id': BASED_SCENARIO_ID, 'is_based': True},
+            {'scenario_id': PROJECT_SCENARIO_ID, 'is_based': False}
+        ],
+        rf'/api/v1/projects/{PROJECT_ID}/territory': lambda: {
+            'project': {'region': {'id': REGION_ID}},
+            'geometry': json.loads(shapely.to_geojson(project_city['project_geometry']))
+        },
+        rf'/api/v1/projects/{PROJECT_ID}': lambda: {'properties': {'context': [CONTEXT_TERRITORY_ID]}},
+        rf'/api/v1/territory/{REGION_ID}/service_types': lambda: service_types,
+        rf'/api/v1/territory/{REGION_ID}/normatives': lambda: normatives,
+        r'/api/v1/territory/(\d+)': lambda _: {'geometry': json.loads(shapely.to_geojson(project_city['context_geometry']))},
+        r'/api/v1/physical_object_types': lambda: PHYSICAL_OBJECT_TYPES,
+    }
+    return [(re.compile(f'{pattern}$'), handler) for pattern, handler in routes.items()]
+
+def serve(base_city : dict, project_city : dict, service_types_count : int, port : int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Serve based and project scenarios of the synthetic city in a background thread.
+    Returns the server and its base url to use as URBAN_API
+    """
+    routes = _get_routes(base_city, project_city, service_types_count)
+    # responses are the same for every request, so they are encoded once
+    encoded = {}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            for pattern, handler in routes:
+                match = pattern.match(path)
+                if match is None:
+                    continue
+                if path not in encoded:
+                    body = json.dumps(handler(*match.groups())).encode()
+                    encoded[path] = body, f'"{hashlib.sha256(body).hexdigest()}"'
+                body, etag = encoded[path]
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(404)
+            self.end_headers()
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
@@ -0,0 +1,9 @@
+import os
+import sys
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, 'app'))
+sys.path.insert(0, REPOSITORY_PATH)
+# the app refuses to start without these, tests point DATA_PATH to temporary folders
+os.environ.setdefault('DATA_PATH', 'data')
+os.environ.setdefault('URBAN_API', 'http://127.0.0.1')
@@ -0,0 +1,76 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from api.routers.effects.effects_service import _match_blocks
+
+CRS = 32636
+
+def _sjoin_gdfs(gdf_before : gpd.GeoDataFrame, gdf_after : gpd.GeoDataFrame):
+    # row-wise matching the vectorized one replaced
+    gdf_before = gdf_before.to_crs(gdf_after.crs)
+    gdf_before['i'] = gdf_before.index
+    gdf_after['i'] = gdf_after.index
+    gdf_sjoin = gdf_after.sjoin(gdf_before, how='left', predicate='intersects', lsuffix='after', rsuffix='before')
+    gdf_sjoin = gdf_sjoin[~gdf_sjoin['i_before'].isna()]
+    gdf_sjoin = gdf_sjoin[~gdf_sjoin['i_after'].isna()]
+    gdf_sjoin['area'] = gdf_sjoin.apply(lambda s : gdf_before.loc[s['i_before'], 'geometry'].intersection(gdf_after.loc[s['i_after'], 'geometry']).area, axis=1)
+    gdf_sjoin = gdf_sjoin.sort_values(by='area')
+    return gdf_sjoin.drop_duplicates(subset=['i_after'], keep='last')
+
+def _make_grid(size : int, cell : float, offset : tuple[float, float] = (0, 0), jitter : float = 0, seed : int = 0, start : int = 0) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    geometries = []
+    for row in range(size):
+        for column in range(size):
+            dx, dy = rng.uniform(-jitter, jitter, 2) if jitter > 0 else (0, 0)
+            x = offset[0] + column * cell + dx
+            y = offset[1] + row * cell + dy
+            geometries.append(shapely.box(x, y, x + cell, y + cell))
+    index = range(start, start + len(geometries))
+    return gpd.GeoDataFrame(geometry=geometries, index=index, crs=CRS)
+
+@pytest.mark.parametrize('size', [4, 10])
+def test_matches_row_wise_sjoin(size):
+    gdf_before = _make_grid(size, 100, jitter=20, seed=1)
+    gdf_after = _make_grid(size, 100, offset=(7, 13), jitter=20, seed=2, start=1000)
+    expected = _sjoin_gdfs(gdf_before.copy(), gdf_after.copy())
+
+    mapping = _match_blocks(gdf_before, gdf_after)
+
+    assert mapping['after'].tolist() == expected['i_after'].astype(int).tolist()
+    assert mapping['before'].tolist() == expected['i_before'].astype(int).tolist()
+
+@pytest.mark.parametrize('offset', [(50, 0), (0, 50), (50, 50)])
+def test_equal_overlaps_go_to_first_before_block(offset):
+    gdf_before = _make_grid(10, 100)
+    # every after block overlaps two or four before blocks by the same area
+    gdf_after = _make_grid(10, 100, offset=offset, start=100)
+
+    mapping = _match_blocks(gdf_before, gdf_after)
+
+    for after, before in zip(mapping['after'], mapping['before']):
+        after_geometry = gdf_after.geometry[after]
+        areas = gdf_before.geometry.intersection(after_geometry).area
+        largest = areas[areas == areas.max()]
+        assert before == largest.index[0]
+    # equal overlaps keep after blocks order
+    areas = shapely.area(shapely.intersection(gdf_after.geometry[mapping['after']].values, gdf_before.geometry[mapping['before']].values))
+    assert np.all(np.diff(areas) >= 0)
+    for area in np.unique(areas):
+        assert np.all(np.diff(mapping['after'][areas == area].values) > 0)
+
+def test_tie_breaking_ignores_row_order():
+    gdf_before = _make_grid(10, 100)
+    gdf_after = _make_grid(10, 100, offset=(50, 50), start=100)
+
+    mapping = _match_blocks(gdf_before, gdf_after)
+    # the spatial index of a reversed layer returns candidates in another order
+    reversed_mapping = _match_blocks(gdf_before.iloc[::-1], gdf_after)
+
+    first_before = {after: before for after, before in zip(mapping['after'], mapping['before'])}
+    last_before = {after: before for after, before in zip(reversed_mapping['after'], reversed_mapping['before'])}
+    assert set(first_before) == set(last_before)
+    # the first before block by position is the last one by label once reversed
+    assert all(last_before[after] >= first_before[after] for after in first_before)
@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from api.utils import const, task_store
+from api.routers.effects import evaluation_executor as ee
+
+class _Process:
+    """
+    Stand-in for the evaluation process, running until the test ends
+    """
+    exitcode = 0
+
+    def __init__(self, target, args, name):
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+
+    def start(self):
+        pass
+
+    def join(self):
+        self._stopped.wait()
+
+    def terminate(self):
+        self._stopped.set()
+
+class _Context:
+    Process = _Process
+
+@pytest.fixture(autouse=True)
+def data_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(const, 'EVALUATION_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(ee, '_context', _Context())
+    monkeypatch.setattr(ee, '_queue', ee.queue.Queue())
+    monkeypatch.setattr(ee, '_processes', {})
+
+def _wait(condition, timeout : float = 5) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_dispatcher_survives_failed_start(monkeypatch):
+    claim_task = task_store.claim_task
+    def failing_claim_task(task_id, max_running):
+        if task_id == 'failing':
+            raise sqlite3.OperationalError('database is locked')
+        return claim_task(task_id, max_running)
+    monkeypatch.setattr(task_store, 'claim_task', failing_claim_task)
+
+    threading.Thread(target=ee._dispatch, daemon=True).start()
+    ee.submit('failing', 1, 'token')
+    ee.submit('next', 2, 'token')
+
+    assert _wait(lambda: task_store.get_task('next')['pid'] is not None)
+    failed = task_store.get_task('failing')
+    assert failed['status'] == 'error'
+    assert 'OperationalError' in failed['error']
+    for process in list(ee._processes.values()):
+        process.terminate()
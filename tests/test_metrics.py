@@ -0,0 +1,38 @@
+import pytest
+
+from api.utils import const, metrics, task_store
+
+@pytest.fixture(autouse=True)
+def data_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(const, 'METRICS_FLUSH_INTERVAL', 3600)
+    monkeypatch.setattr(metrics, '_spans', {})
+    monkeypatch.setattr(metrics, '_latencies', {})
+
+def _get_value(text : str, line_start : str) -> float:
+    return next(float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(line_start))
+
+def test_render_adds_up_every_worker():
+    metrics.observe_latency('/effects/provision_layer', 'CITY', 200, 0.2)
+    with metrics.span('encode'):
+        pass
+    # another API worker, which flushed its own metrics
+    other_latency = [0] * (len(metrics.LATENCY_BUCKETS) + 2)
+    other_latency[0], other_latency[-2], other_latency[-1] = 1, 0.001, 1
+    task_store.add_worker_metrics({'encode': [2, 1.0, 0.5, 1024]}, {('/effects/provision_layer', 'CITY', 200): other_latency},
+                                  {'frame_cache_hits': 3}, {})
+
+    text = metrics.render()
+    labels = metrics._format_labels(route='/effects/provision_layer', scale='CITY', status=200)
+    assert _get_value(text, f'effects_request_duration_seconds_count{labels}') == 2
+    assert _get_value(text, f'effects_request_duration_seconds_sum{labels}') == pytest.approx(0.201)
+    assert _get_value(text, 'effects_request_duration_seconds_bucket{route="/effects/provision_layer",scale="CITY",status="200",le="0.005"}') == 1
+    assert _get_value(text, 'effects_span_seconds_count{process="api",span="encode"}') == 3
+    assert _get_value(text, 'effects_frame_cache_requests_total{result="hit"}') >= 3
+
+def test_render_does_not_count_twice():
+    metrics.observe_latency('/effects/transport_layer', '', 200, 0.2)
+    metrics.render()
+    text = metrics.render()
+    labels = metrics._format_labels(route='/effects/transport_layer', scale='', status=200)
+    assert _get_value(text, f'effects_request_duration_seconds_count{labels}') == 1
@@ -0,0 +1,51 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+from api.utils import const
+from api.routers.effects.services import blocksnet_service as bs
+
+CRS = 32636
+SIZE = 5000
+STEP = 500
+
+def _make_roads() -> np.ndarray:
+    # axis-aligned grid, so roads run along the outer and inner tile edges
+    lines = [shapely.LineString([(x, 0), (x, SIZE)]) for x in range(0, SIZE + 1, STEP)]
+    lines += [shapely.LineString([(0, y), (SIZE, y)]) for y in range(0, SIZE + 1, STEP)]
+    # roads crossing tile edges at an angle, ending on an edge, and bending along one
+    lines += [
+        shapely.LineString([(0, 0), (SIZE, SIZE)]),
+        shapely.LineString([(250, 4250), (2000, 3250)]),
+        shapely.LineString([(1750, 1250), (2000, 1250), (2000, 1750), (2250, 1750)])
+    ]
+    return np.array(lines)
+
+def _get_travel_times(parts : np.ndarray, points : np.ndarray) -> np.ndarray:
+    graph, nodes = bs._roads_to_graph(gpd.GeoDataFrame(geometry=parts, crs=CRS))
+    # crossings of roads cut at tile edges are computed again, so they may move by a rounding error
+    distances, indices = cKDTree(nodes).query(points)
+    assert distances.max() < 1e-6
+    return csgraph.dijkstra(graph, directed=False, indices=indices)[:, indices]
+
+@pytest.mark.parametrize('tile_size', [2000, 1000, 1250])
+def test_tiled_noding_matches_union(monkeypatch, tile_size):
+    monkeypatch.setattr(const, 'ROADS_TILE_SIZE', tile_size)
+    roads = _make_roads()
+
+    tiled = bs._node_roads(roads)
+    untiled = shapely.get_parts(shapely.union_all(roads))
+
+    tiled = tiled[shapely.get_type_id(tiled) == shapely.GeometryType.LINESTRING]
+    assert shapely.length(tiled).sum() == pytest.approx(shapely.length(untiled).sum())
+    # parts never overlap, so no road is held twice
+    assert shapely.length(shapely.union_all(tiled)) == pytest.approx(shapely.length(tiled).sum())
+    # every crossing of the untiled network is a node, and travel times between them are the same
+    points = np.unique(shapely.get_coordinates(np.concatenate([shapely.get_point(untiled, 0), shapely.get_point(untiled, -1)])), axis=0)
+    tiled_times = _get_travel_times(tiled, points)
+    untiled_times = _get_travel_times(untiled, points)
+    assert np.all(np.isfinite(tiled_times))
+    np.testing.assert_allclose(tiled_times, untiled_times)
@@ -0,0 +1,75 @@
+import os
+import time
+
+import pytest
+
+from api.utils import const, task_store
+
+SCENARIO_ID = 42
+
+@pytest.fixture(autouse=True)
+def data_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(const, 'SCENARIO_LOCK_POLL_INTERVAL', 0.01)
+
+def _add_stale_task(task_id : str, started : bool = False):
+    # recorded before a restart by a process whose pid this process reuses now
+    with task_store._connect() as conn:
+        conn.execute(
+            'INSERT INTO tasks (task_id, scenario_id, status, owner_pid, owner_start, pid, pid_start, created_at, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (task_id, SCENARIO_ID, 'pending', os.getpid(), 'before-restart', os.getpid() if started else None,
+             'before-restart' if started else None, time.time(), time.time() if started else None)
+        )
+
+def test_reused_pid_is_not_alive():
+    assert task_store._is_alive(os.getpid(), task_store._get_start(os.getpid()))
+    assert not task_store._is_alive(os.getpid(), 'before-restart')
+    assert not task_store._is_alive(os.getpid(), None)
+
+def test_fail_orphaned_fails_tasks_of_reused_pids():
+    _add_stale_task('stale')
+    _add_stale_task('stale_started', started=True)
+    task_store.fail_orphaned()
+    assert task_store.get_task('stale')['status'] == 'error'
+    assert task_store.get_task('stale_started')['status'] == 'error'
+
+def test_stale_tasks_hold_no_slots():
+    _add_stale_task('stale_started', started=True)
+    task_store.create_task('fresh', SCENARIO_ID + 1)
+    assert task_store.claim_task('fresh', 1) is True
+
+def test_scenario_lock_of_reused_pid_is_taken_over():
+    with task_store._connect() as conn:
+        conn.execute(
+            'INSERT INTO scenario_locks (scenario_id, pid, pid_start, acquired_at) VALUES (?, ?, ?, ?)',
+            (SCENARIO_ID, 1, 'before-restart', time.time())
+        )
+    assert SCENARIO_ID not in task_store.get_locked_scenarios()
+    with task_store.scenario_lock(SCENARIO_ID):
+        assert SCENARIO_ID in task_store.get_locked_scenarios()
+
+def test_requests_attach_to_waiting_task():
+    assert task_store.create_task('first', SCENARIO_ID) == 'first'
+    assert task_store.create_task('second', SCENARIO_ID) == 'first'
+
+def test_requests_do_not_attach_to_stale_task():
+    _add_stale_task('stale')
+    assert task_store.create_task('fresh', SCENARIO_ID) == 'fresh'
+    assert task_store.get_task('stale')['status'] == 'error'
+
+def test_started_task_gets_one_follow_up():
+    task_store.create_task('running', SCENARIO_ID)
+    assert task_store.claim_task('running', 1) is True
+    assert task_store.start_task('running', os.getpid())
+    assert task_store.create_task('follow_up', SCENARIO_ID) == 'follow_up'
+    assert task_store.create_task('another', SCENARIO_ID) == 'follow_up'
+    assert task_store.get_task('running')['status'] == 'pending'
+
+def test_cancel_drops_only_the_request_of_the_requester():
+    task_store.create_task('shared', SCENARIO_ID, requester='a')
+    task_store.create_task('other', SCENARIO_ID, requester='b')
+    assert task_store.request_cancel('shared', 'c') is None
+    assert not task_store.request_cancel('shared', 'a')['cancel_requested']
+    assert task_store.get_task('shared')['status'] == 'pending'
+    assert task_store.request_cancel('shared', 'b')['status'] == 'cancelled'
+    assert task_store.get_task('shared')['status'] == 'cancelled'
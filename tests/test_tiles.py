@@ -0,0 +1,108 @@
+import math
+import os
+
+import geopandas as gpd
+import mapbox_vector_tile
+import numpy as np
+import pytest
+import shapely
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.utils import const, disk_cache
+from api.utils.cache import TTLCache
+from api.routers.effects import effects_controller
+from api.routers.effects.services import tile_service as ts
+
+Z, X, Y = 14, 9372, 4770
+CELL = 500 # meters
+
+@pytest.fixture(autouse=True)
+def data_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(ts, '_layers', TTLCache(60, max_size=4))
+
+def _make_layer(value : float = 0.5) -> gpd.GeoDataFrame:
+    # blocks over the tile and around it, in web mercator
+    min_x, min_y, max_x, max_y = ts.get_tile_bounds(Z, X, Y)
+    xs = np.arange(min_x - 2 * CELL, max_x + 2 * CELL, CELL)
+    ys = np.arange(min_y - 2 * CELL, max_y + 2 * CELL, CELL)
+    boxes = [shapely.box(x, y, x + CELL * 0.9, y + CELL * 0.9) for x in xs for y in ys]
+    values = [math.nan if i % 3 == 0 else value for i in range(len(boxes))]
+    return gpd.GeoDataFrame({'provision': values, 'name': [f'block_{i}' for i in range(len(boxes))]},
+                            geometry=boxes, crs=ts.WEB_MERCATOR_CRS)
+
+def _decode(tile : bytes, layer_name : str = 'provision') -> list[dict]:
+    return mapbox_vector_tile.decode(tile)[layer_name]['features']
+
+def _get_tile_files() -> list[str]:
+    return [os.path.join(root, name) for root, _, names in os.walk(os.path.join(const.DATA_PATH, const.TILES_FOLDER)) for name in names]
+
+def test_encode_tile_clips_features_and_keeps_properties():
+    gdf = _make_layer()
+    features = _decode(ts.encode_tile(gdf, Z, X, Y, 'provision'))
+
+    bounds = ts.get_tile_bounds(Z, X, Y)
+    buffer = (bounds[2] - bounds[0]) * ts.TILE_BUFFER / ts.TILE_EXTENT
+    buffered = shapely.box(bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    expected = gdf[gdf.intersects(buffered)]
+    assert sorted(feature['id'] for feature in features) == sorted(expected.index)
+
+    for feature in features:
+        coordinates = np.array(shapely.geometry.shape(feature['geometry']).exterior.coords)
+        assert coordinates.min() >= -ts.TILE_BUFFER - 1
+        assert coordinates.max() <= ts.TILE_EXTENT + ts.TILE_BUFFER + 1
+        block = gdf.loc[feature['id']]
+        assert feature['properties']['name'] == block['name']
+        # missing values are left out
+        if math.isnan(block['provision']):
+            assert 'provision' not in feature['properties']
+        else:
+            assert feature['properties']['provision'] == pytest.approx(block['provision'])
+
+def test_get_tile_is_cached_by_layer_version():
+    calls = []
+    def get_layer(value):
+        calls.append(value)
+        return _make_layer(value)
+
+    tile = ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X, Y, lambda: get_layer(0.5), (1.0, 2.0))
+    # layers kept in memory are dropped, so the tile comes from disk
+    ts._layers.invalidate()
+    assert ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X, Y, lambda: get_layer(0.5), (1.0, 2.0)) == tile
+    assert calls == [0.5]
+    old_files = _get_tile_files()
+    assert len(old_files) == 1
+
+    # results rewritten since, e.g. by an evaluation finished after the tile was cached
+    new_tile = ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X, Y, lambda: get_layer(0.25), (3.0, 2.0))
+    assert calls == [0.5, 0.25]
+    assert {feature['properties'].get('provision') for feature in _decode(new_tile)} == {0.25, None}
+    new_files = _get_tile_files()
+    assert len(new_files) == 1 and new_files != old_files
+
+def test_delete_tiles():
+    ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X, Y, _make_layer, (1.0, 2.0))
+    ts.get_tile('3_2_PROJECT_provision', 'provision', Z, X, Y, _make_layer, (1.0, 2.0))
+    ts.delete_tiles(1)
+    assert [os.path.relpath(path, const.DATA_PATH).split(os.sep)[1] for path in _get_tile_files()] == ['3_2_PROJECT_provision']
+
+def test_empty_tiles_are_not_written():
+    tile = ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X + 10, Y, _make_layer, (1.0, 2.0))
+    assert not mapbox_vector_tile.decode(tile).get('provision', {}).get('features')
+    assert _get_tile_files() == []
+
+def test_tiles_count_against_cache_quota(monkeypatch):
+    ts.get_tile('1_2_PROJECT_provision', 'provision', Z, X, Y, _make_layer, (1.0, 2.0))
+    monkeypatch.setattr(const, 'CACHE_QUOTA_MB', 1e-9)
+    monkeypatch.setattr(const, 'CACHE_EVICTION_GRACE', -60)
+    assert disk_cache.evict() == 1
+    assert _get_tile_files() == []
+
+def test_tiles_above_max_zoom_are_not_found(monkeypatch):
+    monkeypatch.setattr(const, 'MAX_TILE_ZOOM', 16)
+    app = FastAPI()
+    app.include_router(effects_controller.router)
+    response = TestClient(app).get('/effects/provision/tiles/17/0/0.mvt', params={'project_scenario_id': 1, 'scale_type': 'Проект', 'service_type_id': 1},
+                                   headers={'Authorization': 'Bearer token'})
+    assert response.status_code == 404
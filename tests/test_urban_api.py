@@ -0,0 +1,61 @@
+import pytest
+
+from api.utils import const, response_cache, urban_api
+
+class _Response:
+
+    def __init__(self, status_code : int, content : bytes = b'', etag : str | None = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {} if etag is None else {'ETag': etag}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+@pytest.fixture(autouse=True)
+def data_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(const, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(const, 'URBAN_API_CACHE', 'record')
+
+@pytest.fixture
+def requests(monkeypatch):
+    """
+    Headers of requests sent, answered from the responses list in order
+    """
+    sent, responses = [], []
+    def request(url, token, params, verify, headers):
+        sent.append(dict(headers))
+        return responses.pop(0)
+    monkeypatch.setattr(urban_api, '_request', request)
+    return sent, responses
+
+@pytest.fixture
+def body_reads(monkeypatch):
+    reads = []
+    read_body = response_cache.read_body
+    def counted_read_body(entry):
+        reads.append(entry['body_hash'])
+        return read_body(entry)
+    monkeypatch.setattr(response_cache, 'read_body', counted_read_body)
+    return reads
+
+def test_stored_body_is_read_only_when_unchanged(requests, body_reads):
+    sent, responses = requests
+    responses += [_Response(200, b'[1]', etag='"1"'), _Response(200, b'[2]', etag='"2"'), _Response(304)]
+
+    assert urban_api.get('/objects') == [1]
+    assert urban_api.get('/objects') == [2]
+    assert body_reads == []
+    assert urban_api.get('/objects') == [2]
+    assert len(body_reads) == 1
+    assert [headers.get('If-None-Match') for headers in sent] == [None, '"1"', '"2"']
+
+def test_evicted_body_is_fetched_again(requests, monkeypatch):
+    sent, responses = requests
+    responses += [_Response(200, b'[1]', etag='"1"'), _Response(304), _Response(200, b'[1]', etag='"1"')]
+    urban_api.get('/objects')
+    # body deleted between sending validators and reading it back
+    monkeypatch.setattr(response_cache, 'read_body', lambda entry: None)
+    assert urban_api.get('/objects') == [1]
+    assert [headers.get('If-None-Match') for headers in sent] == [None, '"1"', None]